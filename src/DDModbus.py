@@ -1,21 +1,50 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import threading
+import asyncio
+import collections
+import datetime
 import logging
 import socket
+import struct
 import traceback
+import time
+import Metrics
 
-def calc_crc(data):
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos 
-        for i in range(8):
-            if ((crc & 1) != 0):
-                crc >>= 1
-                crc ^= 0xA001
-            else:
-                crc >>= 1
-    return crc
+#Modbus CRC16 (polynom 0xA001 reflected) lookup table, one entry per byte value
+def _crcTable():
+	table=list();
+	for byte in range(256):
+		crc=byte;
+		for i in range(8):
+			if ((crc & 1) != 0):
+				crc >>= 1
+				crc ^= 0xA001
+			else:
+				crc >>= 1
+		table.append(crc);
+	return tuple(table);
+
+CRC_TABLE=_crcTable();
+
+#table driven CRC calculation, data can be bytes, bytearray or memoryview slice (no copy)
+def _calc_crc_table(data):
+	crc=0xFFFF;
+	table=CRC_TABLE;
+	for pos in data:
+		crc=(crc >> 8) ^ table[(crc ^ pos) & 0xFF];
+	return crc;
+
+#C accelerated backend (crcmod with its C extension) is used when available
+try:
+	import crcmod._crcfunext
+	import crcmod.predefined
+	calc_crc=crcmod.predefined.mkCrcFun('modbus');
+	CRC_BACKEND='crcmod';
+except ImportError:
+	calc_crc=_calc_crc_table;
+	CRC_BACKEND='table';
 
 #class used to define a structure of several continuous registers
 class RegisterSet:
@@ -29,6 +58,60 @@ class RegisterSet:
 	def __str__(self):
 		return('Reg:'+str(self.address)+' data: '+str(self.data));
 		
+#thread safe queue of register write requests
+#only the last requested value of a register is kept and adjacent registers are written within one request
+class RegisterWriteQueue:
+	WRITE_MAX_REGISTERS=0x7B;
+	
+	def __init__(self):
+		self.lock=threading.Lock();
+		#pending values by register address
+		self.pending=dict();
+		
+	def put(self,regSet):
+		with self.lock:
+			for i,value in enumerate(regSet.data):
+				self.pending[regSet.address+i]=value;
+	
+	def empty(self):
+		with self.lock:
+			return (len(self.pending)==0);
+		
+	def qsize(self):
+		with self.lock:
+			return len(self.pending);
+	
+	#return next RegisterSet of adjacent registers to write, or None if queue is empty
+	#if currentValues dict is given, a RegisterSet whose values are all equal to current ones is skipped
+	#currentValues shall only hold values confirmed by the regulator, such as recently read ones
+	def get(self,currentValues=None):
+		with self.lock:
+			while self.pending:
+				address=min(self.pending);
+				data=list();
+				while (((address+len(data)) in self.pending) and (len(data) < self.WRITE_MAX_REGISTERS)):
+					data.append(self.pending.pop(address+len(data)));
+				if ((currentValues is None) or any(currentValues.get(address+i)!=value for i,value in enumerate(data))):
+					return RegisterSet(address,data);
+			return None;
+
+#build the list of read requests (address,register nb) covering a set of registers
+#registers separated by no more than maxGap unused registers are merged in one request of maxBlockSize registers max
+def planRegisterReads(registers,maxBlockSize,maxGap):
+	plan=list();
+	start=None;
+	last=None;
+	for address in sorted(set(registers)):
+		if ((start is not None) and ((address-last-1) <= maxGap) and ((address-start) < maxBlockSize)):
+			last=address;
+		else:
+			if (start is not None):
+				plan.append((start,last-start+1));
+			start=address;
+			last=address;
+	if (start is not None):
+		plan.append((start,last-start+1));
+	return plan;
   
 class slaveRequest:
 	FRAME_MIN_LENGTH=0x08;
@@ -44,6 +127,18 @@ class slaveRequest:
 		self.regAddress=0;
 		self.regNb=0;
 		self.data=dict();
+		self.answer=False;
+		#register values of a read answer, their addresses are given by the read request
+		self.values=list();
+		
+		#answer frames exchanged on the bus are not requests (read answers have a byte count, write acks are 8 bytes long)
+		if ((len(data)>=2) and (((data[1]==DDModbus.READ_ANALOG_HOLDING_REGISTERS) and (len(data)!=8)) or ((data[1]==DDModbus.WRITE_MULTIPLE_REGISTERS) and (len(data)==8)))):
+			self.modbusAddress=data[0];
+			self.modbusFunctionCode=data[1];
+			self.answer=True;
+			if ((data[1]==DDModbus.READ_ANALOG_HOLDING_REGISTERS) and (len(data)>=5) and (len(data)==data[2]+5)):
+				self.values=[0x100*data[3+2*i]+data[4+2*i] for i in range(data[2]//2)];
+			return;
 		
 		#check rough length
 		if ((len(data) > self.FRAME_MAX_LENGTH) or (len(data) < self.FRAME_MIN_LENGTH )):
@@ -55,7 +150,7 @@ class slaveRequest:
 		#if modBus feature is READ_ANALOG_HOLDING_REGISTERS
 		if (self.modbusFunctionCode == DDModbus.READ_ANALOG_HOLDING_REGISTERS):
 			#check CRC
-			crc=calc_crc(data[0:6]);
+			crc=calc_crc(memoryview(data)[0:6]);
 			if (crc!=0x100*data[7]+data[6]):
 				self.logger.warning('READ_ANALOG_HOLDING_REGISTERS frame CRC error ');
 				return;
@@ -87,7 +182,7 @@ class slaveRequest:
 				return;
 			
 			#check CRC
-			crc=calc_crc(data[0:frameLength-2]);
+			crc=calc_crc(memoryview(data)[0:frameLength-2]);
 			if (crc!=0x100*data[frameLength-1]+data[frameLength-2]):
 				self.logger.warning('WRITE_MULTIPLE_REGISTERS frame CRC error '+hex(crc));
 				return;
@@ -102,127 +197,477 @@ class slaveRequest:
 				self.data[self.regAddress+i]=0x100*data[7+2*i]+data[8+2*i];
 			
 	
-class DDModbus:
-	ip=None; #serial port id
-	port=None;
-	CLEANING_TIMEOUT=0.1;
-	SLAVE_RX_TIMEOUT=0.5;
-	MASTER_RX_TIMEOUT=2.5;
-	READ_ANALOG_HOLDING_REGISTERS=0x03;
-	WRITE_MULTIPLE_REGISTERS=0x10;
+#link metrics, labelled by gateway ip:port
+REQUEST_SECONDS=Metrics.histogram('diematic_modbus_request_seconds','Duration of successful master requests',('gateway','function'));
+TIMEOUTS=Metrics.counter('diematic_modbus_timeouts_total','Master requests without answer',('gateway','function'));
+CRC_ERRORS=Metrics.counter('diematic_modbus_crc_errors_total','Received frames dropped on CRC error',('gateway',));
+LENGTH_ERRORS=Metrics.counter('diematic_modbus_length_errors_total','Answers with a wrong byte number or ack',('gateway','function'));
+
+#in-memory ring of the last frame events, saved without any formatting, formatting is only done when the trace is dumped
+#event: (time, gateway, direction, status, address, function, length, frame bytes)
+TRACE_RX=0;
+TRACE_TX=1;
+TRACE_DIRECTIONS=('RX','TX');
+TRACE_OK=0;
+TRACE_SKIPPED=1;
+TRACE_TIMEOUT=2;
+TRACE_ERROR=3;
+TRACE_CRC_ERROR=4;
+TRACE_STATUS=('ok','skipped','timeout','error','crc error');
+
+class FrameTrace:
+	SIZE=1000;
 	
-	ANSWER_FRAME_MIN_LENGTH=0x07;
-	ANSWER_FRAME_MAX_LENGTH=0x100;
+	def __init__(self,size=SIZE):
+		self.events=collections.deque(maxlen=size);
+	
+	#the last events are kept
+	def resize(self,size):
+		self.events=collections.deque(self.events,maxlen=size);
+	
+	def add(self,gateway,direction,status,data):
+		self.events.append((time.time(),gateway,direction,status,data[0] if data else 0,data[1] if (len(data)>1) else 0,len(data),data));
+	
+	def clear(self):
+		self.events.clear();
+	
+	#one text line per event, oldest first
+	def dump(self):
+		lines=list();
+		for timestamp,gateway,direction,status,address,function,length,data in list(self.events):
+			lines.append(datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')+' '+gateway+' '+TRACE_DIRECTIONS[direction]+' '+TRACE_STATUS[status]+' addr:'+hex(address)+' fn:'+hex(function)+' len:'+str(length)+' '+bytes(data).hex());
+		return lines;
+
+#frame events of all gateways
+TRACE=FrameTrace();
+
+#class used to cut Modbus RTU frames out of the TCP byte stream of the gateway
+#a recv may contain part of a frame or several frames, so the remaining bytes are kept for the next read
+class RtuFrameBuffer:
+	BUFFER_MAX_LENGTH=0x400;
+	EXCEPTION_FRAME_LENGTH=5;
+	SHORT_FRAME_LENGTH=8;
+	
+	#name is the gateway label of CRC error metric
+	def __init__(self,name=''):
+		#logger
+		self.logger = logging.getLogger(__name__)
+		self.name=name;
+		self.buffer=bytearray();
+		#counter of resynchronisations on frame start, bytes are dropped until the next valid frame
+		self.resyncCount=0;
+		#True while bytes are dropped to resynchronise
+		self.resync=False;
+		#True when the last bytes were a valid frame, which may be followed by a 0 padding byte
+		self.frameEnd=False;
+	
+	def __len__(self):
+		return len(self.buffer);
+	
+	def clear(self):
+		self.buffer.clear();
+		self.resync=False;
+		self.frameEnd=False;
+	
+	#add received bytes, oldest bytes are dropped in case of overflow
+	def feed(self,data):
+		self.buffer.extend(data);
+		if (len(self.buffer) > self.BUFFER_MAX_LENGTH):
+			self.logger.warning('Rx buffer overflow');
+			del self.buffer[0:len(self.buffer)-self.BUFFER_MAX_LENGTH];
+	
+	#possible lengths of the frame at buffer start, None when not yet computable
+	def frameLengths(self):
+		functionCode=self.buffer[1];
+		if (functionCode == DDModbus.READ_ANALOG_HOLDING_REGISTERS):
+			#request or answer with byte count
+			return [self.SHORT_FRAME_LENGTH,(5+self.buffer[2]) if (len(self.buffer)>2) else None];
+		if (functionCode == DDModbus.WRITE_MULTIPLE_REGISTERS):
+			#ack or request with byte count
+			return [self.SHORT_FRAME_LENGTH,(9+self.buffer[6]) if (len(self.buffer)>6) else None];
+		if (functionCode & 0x80):
+			#exception answer
+			return [self.EXCEPTION_FRAME_LENGTH];
+		return [];
+	
+	#return next complete frame with a valid CRC, or None if more bytes are needed
+	#if silence is True, no more bytes are expected so an incomplete frame at buffer start is dropped
+	def getFrame(self,silence=False):
+		while (len(self.buffer) >= 2):
+			pending=False;
+			#length of a complete frame candidate with a wrong CRC
+			crcLength=0;
+			for frameLength in self.frameLengths():
+				if ((frameLength is None) or (frameLength > len(self.buffer))):
+					pending=True;
+				else:
+					crc=calc_crc(memoryview(self.buffer)[0:frameLength-2]);
+					if (crc==0x100*self.buffer[frameLength-1]+self.buffer[frameLength-2]):
+						frame=bytes(self.buffer[0:frameLength]);
+						del self.buffer[0:frameLength];
+						self.resync=False;
+						self.frameEnd=True;
+						return frame;
+					crcLength=max(crcLength,frameLength);
+			if (pending and not silence):
+				return None;
+			#requests are sent with a trailing 0 byte, skipped without resynchronisation
+			if (self.frameEnd and (self.buffer[0]==0)):
+				del self.buffer[0];
+				self.frameEnd=False;
+				continue;
+			self.frameEnd=False;
+			#no valid frame at buffer start: slide one byte, errors are counted once per resynchronisation
+			if (not self.resync):
+				self.resync=True;
+				self.resyncCount+=1;
+				#a complete frame candidate has a wrong CRC
+				if (crcLength and not pending):
+					CRC_ERRORS.inc(1,self.name);
+					TRACE.add(self.name,TRACE_RX,TRACE_CRC_ERROR,bytes(self.buffer[0:crcLength]));
+			del self.buffer[0];
+		if silence:
+			self.clear();
+		return None;
+		
+#Modbus request building, shared by blocking and asyncio interfaces
+def buildReadRequest(modbusAddress,regAddress,regNb):
+	request=bytearray();
+	request.append(modbusAddress);
+	request.append(DDModbus.READ_ANALOG_HOLDING_REGISTERS);
+	request.append((regAddress>>8)& 0xFF);
+	request.append(regAddress & 0xFF);
+	request.append((regNb>>8)& 0xFF);
+	request.append(regNb & 0xFF);
+	crc=calc_crc(request);
+	request.append(crc & 0xFF);
+	request.append((crc>>8)& 0xFF);
+	request.append(0);
+	return request;
+
+def buildWriteRequest(modbusAddress,regAddress,data):
+	request=bytearray();
+	#byte 0
+	request.append(modbusAddress);
+	#byte 1
+	request.append(DDModbus.WRITE_MULTIPLE_REGISTERS);
+	#byte 2 & 3
+	request.append((regAddress>>8)& 0xFF);
+	request.append(regAddress & 0xFF);
+	#byte 4 & 5 Reg Nb
+	request.append(0);
+	request.append(len(data));
+	#byte 6 byte Nb
+	request.append(2*len(data));
+	#data
+	for reg in data:
+		request.append((reg>>8)& 0xFF);
+		request.append(reg & 0xFF);
+		
+	crc=calc_crc(request);
+	request.append(crc & 0xFF);
+	request.append((crc>>8)& 0xFF);
+	request.append(0);
+	return request;
 
+#ack of a WRITE_MULTIPLE_REGISTERS request: first 6 bytes of the request followed by CRC
+def buildWriteAck(request):
+	ack=bytearray(request[0:6]);
+	crc=calc_crc(ack);
+	ack.append(crc & 0xFF);
+	ack.append((crc>>8)& 0xFF);
+	return ack;
+
+#binary capture of the bytes exchanged with a gateway, records are appended to the file after a magic header
+#record: monotonic time (float64), direction (uint8), data length (uint16), data
+CAPTURE_MAGIC=b'DDCAPTURE1\n';
+CAPTURE_RECORD=struct.Struct('<dBH');
+CAPTURE_RX=0;
+CAPTURE_TX=1;
+#connection opening, data is the gateway ip:port
+CAPTURE_CONNECT=2;
+
+class BusCapture:
+	FLUSH_PERIOD=1;
+	
+	#maxSize is the file size in bytes triggering a rotation, the previous file is kept with suffix .1 (0: no rotation)
+	def __init__(self,path,maxSize=0):
+		#logger
+		self.logger = logging.getLogger(__name__)
+		self.path=path;
+		self.maxSize=maxSize;
+		self.lock=threading.Lock();
+		self.open();
+		
+	def open(self):
+		self.file=open(self.path,'ab');
+		if (self.file.tell()==0):
+			self.file.write(CAPTURE_MAGIC);
+		self.lastFlush=time.monotonic();
+		self.logger.warning('Bus capture in '+self.path);
+	
+	def write(self,direction,data):
+		with self.lock:
+			if self.file.closed:
+				return;
+			now=time.monotonic();
+			self.file.write(CAPTURE_RECORD.pack(now,direction,len(data)));
+			self.file.write(data);
+			if ((now-self.lastFlush) >= self.FLUSH_PERIOD):
+				self.file.flush();
+				self.lastFlush=now;
+				if ((self.maxSize > 0) and (self.file.tell() >= self.maxSize)):
+					self.file.close();
+					os.replace(self.path,self.path+'.1');
+					self.open();
+	
+	def close(self):
+		with self.lock:
+			self.file.close();
+
+#directory of capture files, bus capture is disabled if None
+captureDirectory=None;
+captureMaxSize=0;
+#captures by file path, a capture is used by one connection at a time and kept for the next connections
+captures=dict();
+#paths of the captures used by an open connection
+capturesInUse=set();
+captureLock=threading.Lock();
+
+#enable the capture of all gateways in directory, one file by connection slot of each gateway
+def setCapture(directory,maxSize=0):
+	global captureDirectory,captureMaxSize;
+	os.makedirs(directory,exist_ok=True);
+	captureDirectory=directory;
+	captureMaxSize=maxSize;
+
+#capture of a connection opened to gateway ip:port, in file <ip>_<port>_<slot>.ddcap
+#connections open at the same time to a gateway get different slots, so that their records are not interleaved
+def getCapture(gateway):
+	if (captureDirectory is None):
+		return None;
+	with captureLock:
+		slot=0;
+		while True:
+			path=os.path.join(captureDirectory,gateway.replace(':','_')+'_'+str(slot)+'.ddcap');
+			if (path not in capturesInUse):
+				break;
+			slot+=1;
+		capturesInUse.add(path);
+		capture=captures.get(path);
+		if (capture is None):
+			capture=BusCapture(path,captureMaxSize);
+			captures[path]=capture;
+		return capture;
+
+#slot of a capture is freed when its connection is closed
+def releaseCapture(capture):
+	with captureLock:
+		capturesInUse.discard(capture.path);
+
+def closeCaptures():
+	with captureLock:
+		for capture in captures.values():
+			capture.close();
+		captures.clear();
+		capturesInUse.clear();
+
+#records of a capture file as (time,direction,data), a truncated last record is ignored
+def readCapture(path):
+	with open(path,'rb') as file:
+		if (file.read(len(CAPTURE_MAGIC))!=CAPTURE_MAGIC):
+			raise ValueError('Not a bus capture file: '+path);
+		while True:
+			header=file.read(CAPTURE_RECORD.size);
+			if (len(header) < CAPTURE_RECORD.size):
+				return;
+			timestamp,direction,length=CAPTURE_RECORD.unpack(header);
+			data=file.read(length);
+			if (len(data) < length):
+				return;
+			yield (timestamp,direction,data);
+
+#acknowledge to send for a frame received in slave mode, None if the frame is not acknowledged
+def slaveAck(frame,data,modbusSlaveAddress):
+	#if slave address is correct
+	if ((modbusSlaveAddress!=0) and (frame.modbusAddress==modbusSlaveAddress)):
+		#ack for WRITE_MULTIPLE_REGISTERS request
+		if (frame.modbusFunctionCode==DDModbus.WRITE_MULTIPLE_REGISTERS):
+			tx=buildWriteAck(data);
+			tx.append(0);
+			return tx;
+		#ack for READ_ANALOG_HOLDING_REGISTERS
+		elif (frame.modbusFunctionCode==DDModbus.READ_ANALOG_HOLDING_REGISTERS):
+			#it is not possible to ack the request as there is not content to provide
+			pass;
+	return None;
+
+#asyncio interface to the RS485/TCP gateway
+class AsyncDDModbus:
 	def __init__(self,ip,port):
 		#logger
 		self.logger = logging.getLogger(__name__)
 		
-		#socket definition and connection
+		#connection parameters
 		self.ip=ip;
 		self.port=port;
-		self.socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM);
-		self.socket.connect((self.ip,self.port));
+		self.gateway=ip+':'+str(port);
+		self.reader=None;
+		self.writer=None;
 		
-	def clean(self):
+		#persistent receive buffer
+		self.rxBuffer=RtuFrameBuffer(self.gateway);
+		
+		#optional bus capture, by connection
+		self.capture=None;
+		#frames given by a gateway connection reader task, frames are read from the socket if None
+		self.frames=None;
+	
+	async def connect(self):
+		self.reader,self.writer=await asyncio.open_connection(self.ip,self.port);
+		if (self.capture is None):
+			self.capture=getCapture(self.gateway);
+		if (self.capture is not None):
+			self.capture.write(CAPTURE_CONNECT,self.gateway.encode());
+		
+	def close(self):
+		if (self.writer is not None):
+			self.writer.close();
+			self.writer=None;
+		if (self.capture is not None):
+			releaseCapture(self.capture);
+			self.capture=None;
+			
+	async def send(self,data):
+		if (self.capture is not None):
+			self.capture.write(CAPTURE_TX,data);
+		self.writer.write(data);
+		await self.writer.drain();
+		
+	async def clean(self):
 		run= True;
 		while run:
 			try:
-				self.socket.settimeout(DDModbus.CLEANING_TIMEOUT);
-				data=self.socket.recv(1024);
+				data=await asyncio.wait_for(self.reader.read(1024),DDModbus.CLEANING_TIMEOUT);
 				self.logger.debug('Cleaning of: '+str(len(data))+' bytes(s)');
-			except socket.error as exc:
+				if (data and (self.capture is not None)):
+					self.capture.write(CAPTURE_RX,data);
+				if (not data):
+					run=False;
+			except (asyncio.TimeoutError,socket.error) as exc:
 				run=False;
+		self.rxBuffer.clear();
+	
+	#wait for a complete frame until timeout, return None if no valid frame has been received
+	async def recvFrame(self,timeout):
+		if (self.frames is not None):
+			return await self.frames.getFrame(timeout);
+		return await self.readFrame(timeout);
+	
+	#bytes and frames received before a request are outdated
+	def clearFrames(self):
+		if (self.frames is not None):
+			self.frames.clear();
+		else:
+			self.rxBuffer.clear();
+	
+	#wait for a complete frame read from the socket until timeout
+	async def readFrame(self,timeout):
+		loop=asyncio.get_event_loop();
+		deadline=loop.time()+timeout;
+		while True:
+			frame=self.rxBuffer.getFrame();
+			if (frame is not None):
+				return frame;
+			remaining=deadline-loop.time();
+			if (remaining <= 0):
+				break;
+			try:
+				data=await asyncio.wait_for(self.reader.read(1024),remaining);
+			except asyncio.TimeoutError:
+				break;
+			if (not data):
+				#connection closed by the gateway, avoid a busy loop
+				self.logger.warning('Connection closed by gateway');
+				await asyncio.sleep(remaining);
+				break;
+			if (self.capture is not None):
+				self.capture.write(CAPTURE_RX,data);
+			self.rxBuffer.feed(data);
+		#bus silence, an incomplete frame is dropped
+		return self.rxBuffer.getFrame(True);
 
-	def slaveRx(self,modbusSlaveAddress):
+	async def slaveRx(self,modbusSlaveAddress):
 			try:
-				self.socket.settimeout(DDModbus.SLAVE_RX_TIMEOUT);
-				data=self.socket.recv(1024);
-				self.logger.debug('Frame received: '+data.hex());
+				data=await self.recvFrame(DDModbus.SLAVE_RX_TIMEOUT);
+				if (data is None):
+					return False;
+				TRACE.add(self.gateway,TRACE_RX,TRACE_OK,data);
 				
 				#frame consistency check
 				frame=slaveRequest(data);
 				
-				#if slave address is correct
-				if ((modbusSlaveAddress!=0) and (frame.modbusAddress==modbusSlaveAddress)):
-					#ack for WRITE_MULTIPLE_REGISTERS request
-					if (frame.modbusFunctionCode==DDModbus.WRITE_MULTIPLE_REGISTERS):
-						self.logger.debug('Ack WRITE_MULTIPLE_REGISTERS frame');
-						tx=bytearray();
-						tx.extend(data[0:6]);
-						crc=calc_crc(tx);
-						tx.append(crc & 0xFF);
-						tx.append((crc >> 8) & 0xFF);
-						tx.append(0);
-						self.socket.send(tx);
-					#ack for READ_ANALOG_HOLDING_REGISTERS
-					elif (frame.modbusFunctionCode==DDModbus.READ_ANALOG_HOLDING_REGISTERS):
-						#it is not possible to ack the request as there is not content to provide
-						self.logger.debug('No Ack for READ_ANALOG_HOLDING_REGISTERS frame');
+				ack=slaveAck(frame,data,modbusSlaveAddress);
+				if (ack is not None):
+					TRACE.add(self.gateway,TRACE_TX,TRACE_OK,ack);
+					await self.send(ack);
 
 				return frame;
 			except socket.error as exc:
 				return False;
+	
+	#wait for the answer frame of a master request, frames of other bus users are skipped
+	async def masterRx(self,modbusAddress,functionCode):
+		loop=asyncio.get_event_loop();
+		deadline=loop.time()+DDModbus.MASTER_RX_TIMEOUT;
+		while True:
+			remaining=deadline-loop.time();
+			if (remaining <= 0):
+				return None;
+			answer=await self.recvFrame(remaining);
+			if (answer is None):
+				return None;
+			#answer or exception answer of the requested slave
+			if ((answer[0] == modbusAddress) and ((answer[1] & 0x7F) == functionCode)):
+				return answer;
+			TRACE.add(self.gateway,TRACE_RX,TRACE_SKIPPED,answer);
 				
-	def masterReadAnalog(self,modbusAddress,regAddress,regNb):
+	async def masterReadAnalog(self,modbusAddress,regAddress,regNb):
 		
 		#build request
-		request=bytearray();
-		request.append(modbusAddress);
-		request.append(DDModbus.READ_ANALOG_HOLDING_REGISTERS);
-		request.append((regAddress>>8)& 0xFF);
-		request.append(regAddress & 0xFF);
-		request.append((regNb>>8)& 0xFF);
-		request.append(regNb & 0xFF);
-		crc=calc_crc(request);
-		request.append(crc & 0xFF);
-		request.append((crc>>8)& 0xFF);
-		request.append(0);
-		
-		#send it
-		self.logger.debug('Send read request: '+request.hex());
-		self.socket.send(request);
+		request=buildReadRequest(modbusAddress,regAddress,regNb);
 		
 		#wait for answer
 		try:
-			self.socket.settimeout(DDModbus.MASTER_RX_TIMEOUT);
-			answer=self.socket.recv(1024);
-			self.logger.debug('Answer received: '+answer.hex());
-			
-			#check answer
+			#send it, bytes received before are outdated
+			TRACE.add(self.gateway,TRACE_TX,TRACE_OK,request);
+			self.clearFrames();
+			start=time.monotonic();
+			await self.send(request);
 			
-			#check rough length
-			if ((len(answer) > self.ANSWER_FRAME_MAX_LENGTH) or (len(answer) < self.ANSWER_FRAME_MIN_LENGTH )):
-				self.logger.warning('Rough Answer Length Error');
-				return;
-		
-			#check  modBus address
-			if (answer[0] != modbusAddress):
-				self.logger.warning('Answer modbus address Error');
+			answer=await self.masterRx(modbusAddress,DDModbus.READ_ANALOG_HOLDING_REGISTERS);
+			if (answer is None):
+				self.logger.warning('No answer to masterReadAnalog');
+				TRACE.add(self.gateway,TRACE_TX,TRACE_TIMEOUT,request);
+				TIMEOUTS.inc(1,self.gateway,'read');
 				return;
 			
+			#check answer, frame CRC has already been checked
+			
 			#check  modBus feature
 			if (answer[1] != DDModbus.READ_ANALOG_HOLDING_REGISTERS):
 				self.logger.warning('Answer modbus feature Error');
+				TRACE.add(self.gateway,TRACE_RX,TRACE_ERROR,answer);
 				return;
 				
 			#check byte nb
-			if (answer[2] != 2*regNb):
+			if ((answer[2] != 2*regNb) or (len(answer) != 5+answer[2])):
 				self.logger.warning('Answer byte number Error');
+				TRACE.add(self.gateway,TRACE_RX,TRACE_ERROR,answer);
+				LENGTH_ERRORS.inc(1,self.gateway,'read');
 				return;
-				
-			#check length
-			answerLength=5+answer[2];
-			if ((len(answer) < answerLength )):
-				self.logger.warning('Answer Length Error');
-				return;
-				
-			#check CRC
-			crc=calc_crc(answer[0:answerLength-2]);
-			if (crc!=0x100*answer[answerLength-1]+answer[answerLength-2]):
-				self.logger.warning('Answer CRC error ');
-				return;
-			self.logger.debug('Answer valid ');
+			TRACE.add(self.gateway,TRACE_RX,TRACE_OK,answer);
+			REQUEST_SECONDS.observe(time.monotonic()-start,self.gateway,'read');
 			
 			#return answer as dict
 			data=dict();
@@ -234,50 +679,34 @@ class DDModbus:
 			self.logger.warning('No answer to masterReadAnalog');
 			return;
 			
-	def masterWriteAnalog(self,modbusAddress,regAddress,data):
+	async def masterWriteAnalog(self,modbusAddress,regAddress,data):
 		#build request
-		request=bytearray();
-		#byte 0
-		request.append(modbusAddress);
-		#byte 1
-		request.append(DDModbus.WRITE_MULTIPLE_REGISTERS);
-		#byte 2 & 3
-		request.append((regAddress>>8)& 0xFF);
-		request.append(regAddress & 0xFF);
-		#byte 4 & 5 Reg Nb
-		request.append(0);
-		request.append(len(data));
-		#byte 6 byte Nb
-		request.append(2*len(data));
-		#data
-		for reg in data:
-			request.append((reg>>8)& 0xFF);
-			request.append(reg & 0xFF);
-			
-		crc=calc_crc(request);
-		request.append(crc & 0xFF);
-		request.append((crc>>8)& 0xFF);
-		request.append(0);
-		
-		#send it
-		self.logger.info('Send write request: '+request.hex());
-		self.socket.send(request);
+		request=buildWriteRequest(modbusAddress,regAddress,data);
 		
 		#wait for ack
 		try:
-			self.socket.settimeout(DDModbus.MASTER_RX_TIMEOUT);
-			answer=self.socket.recv(1024);
-			self.logger.debug('Ack received: '+answer.hex());
+			#send it, bytes received before are outdated
+			TRACE.add(self.gateway,TRACE_TX,TRACE_OK,request);
+			self.clearFrames();
+			start=time.monotonic();
+			await self.send(request);
+			
+			answer=await self.masterRx(modbusAddress,DDModbus.WRITE_MULTIPLE_REGISTERS);
+			if (answer is None):
+				self.logger.warning('No ack  to master write request');
+				TRACE.add(self.gateway,TRACE_TX,TRACE_TIMEOUT,request);
+				TIMEOUTS.inc(1,self.gateway,'write');
+				return(False);
 			#check ack
-			waited_ack=request[0:6];
-			crc=calc_crc(waited_ack);
-			waited_ack.append(crc & 0xFF);
-			waited_ack.append((crc>>8)& 0xFF);
+			waited_ack=buildWriteAck(request);
 			if (waited_ack==answer[0:8]):
-				self.logger.info('Ack OK');
+				TRACE.add(self.gateway,TRACE_RX,TRACE_OK,answer);
+				REQUEST_SECONDS.observe(time.monotonic()-start,self.gateway,'write');
 				return(True);
 			else:
 				self.logger.warning('Ack KO. Waited Ack was : '+waited_ack.hex());
+				TRACE.add(self.gateway,TRACE_RX,TRACE_ERROR,answer);
+				LENGTH_ERRORS.inc(1,self.gateway,'write');
 				return(False);
 			
 			
@@ -285,3 +714,335 @@ class DDModbus:
 			self.logger.warning('No ack  to master write request');
 			return(False);
 
+#queue of received frames, the oldest frame is dropped when the queue is full
+class FrameQueue(asyncio.Queue):
+	SIZE=64;
+	
+	def __init__(self):
+		super().__init__(self.SIZE);
+	
+	def putFrame(self,frame):
+		if self.full():
+			self.get_nowait();
+		self.put_nowait(frame);
+	
+	def clear(self):
+		while not self.empty():
+			self.get_nowait();
+	
+	#next frame within timeout, None if no frame has been received
+	async def getFrame(self,timeout):
+		try:
+			return await asyncio.wait_for(self.get(),timeout);
+		except asyncio.TimeoutError:
+			return None;
+
+#connection to a RS485/TCP gateway shared by all regulators of the bus, shall be used from a single event loop
+#frames received from the bus are read by a single task and dispatched to all links, so that each regulator loop sees all bus frames
+#master transactions and slave acknowledges of all users are serialised in request order, the connection is opened again once for all users
+class GatewayConnection:
+	def __init__(self,ip,port,key):
+		#logger
+		self.logger = logging.getLogger(__name__)
+		
+		#connection parameters
+		self.ip=ip;
+		self.port=port;
+		self.key=key;
+		self.gateway=ip+':'+str(port);
+		self.interface=None;
+		#number of links using the connection, and open links
+		self.users=0;
+		self.links=list();
+		#incremented at each connection opening
+		self.generation=0;
+		#asyncio locks are created by open, within the event loop
+		self.transactionLock=None;
+		self.connectLock=None;
+		#task reading received frames, and link of the master transaction in progress
+		self.readerTask=None;
+		self.masterLink=None;
+	
+	#open a link to the gateway, the connection is opened by the first user
+	async def open(self):
+		if (self.transactionLock is None):
+			self.transactionLock=asyncio.Lock();
+			self.connectLock=asyncio.Lock();
+		self.users+=1;
+		link=GatewayLink(self);
+		self.links.append(link);
+		try:
+			async with self.connectLock:
+				if (self.interface is None):
+					await self.connect();
+		except BaseException:
+			self.release(link);
+			raise;
+		link.generation=self.generation;
+		return link;
+	
+	#connection is (re)opened between two transactions
+	async def connect(self):
+		async with self.transactionLock:
+			self.stopReader();
+			if (self.interface is not None):
+				self.interface.close();
+				self.interface=None;
+			interface=AsyncDDModbus(self.ip,self.port);
+			await interface.connect();
+			self.interface=interface;
+			self.generation+=1;
+			self.logger.warning('Gateway '+self.gateway+' connected, users: '+str(self.users));
+			await self.interface.clean();
+			#frames of master transactions are received from the reader task
+			self.interface.frames=FrameQueue();
+			self.readerTask=asyncio.ensure_future(self.readFrames(self.interface));
+	
+	def stopReader(self):
+		if (self.readerTask is not None):
+			self.readerTask.cancel();
+			self.readerTask=None;
+	
+	#reader task, each frame is given to all links, or to the interface for the link of the master transaction in progress
+	async def readFrames(self,interface):
+		while True:
+			try:
+				frame=await interface.readFrame(DDModbus.SLAVE_RX_TIMEOUT);
+			except socket.error as exc:
+				self.logger.warning('Gateway '+self.gateway+' read error: '+str(exc));
+				await asyncio.sleep(DDModbus.SLAVE_RX_TIMEOUT);
+				continue;
+			if (frame is None):
+				continue;
+			#frames of master transactions are traced by the transaction
+			if (self.masterLink is None):
+				TRACE.add(self.gateway,TRACE_RX,TRACE_OK,frame);
+			for link in self.links:
+				if (link is self.masterLink):
+					interface.frames.putFrame(frame);
+				else:
+					link.frames.putFrame(frame);
+	
+	#open the connection again, unless another user did it since generation
+	async def reconnect(self,generation):
+		async with self.connectLock:
+			if ((self.interface is None) or (generation==self.generation)):
+				await self.connect();
+			else:
+				self.logger.info('Gateway '+self.gateway+' already reconnected');
+		return self.generation;
+	
+	#release a link, the connection is closed with its last user
+	def release(self,link):
+		self.users-=1;
+		if (link in self.links):
+			self.links.remove(link);
+		if (self.users<=0):
+			self.stopReader();
+			if (self.interface is not None):
+				self.interface.close();
+				self.interface=None;
+			gatewayConnections.pop(self.key,None);
+	
+	#master transaction of a link on the gateway, transactions are serialised in request order
+	#frames received during the transaction are given to the transaction instead of the link
+	async def transaction(self,link,method,*args):
+		async with self.transactionLock:
+			if (self.interface is None):
+				return None;
+			self.masterLink=link;
+			link.frames.clear();
+			try:
+				return await getattr(self.interface,method)(*args);
+			finally:
+				self.masterLink=None;
+	
+	#acknowledge of a link in slave mode, sent between master transactions
+	async def send(self,data):
+		async with self.transactionLock:
+			if (self.interface is None):
+				return;
+			TRACE.add(self.gateway,TRACE_TX,TRACE_OK,data);
+			await self.interface.send(data);
+
+#link of a regulator to a shared gateway connection, provides the AsyncDDModbus interface
+class GatewayLink:
+	def __init__(self,connection):
+		self.connection=connection;
+		#generation of the connection when the link was last (re)connected
+		self.generation=connection.generation;
+		#frames received from the bus while the link is not master
+		self.frames=FrameQueue();
+		
+	async def reconnect(self):
+		self.generation=await self.connection.reconnect(self.generation);
+		
+	def close(self):
+		if (self.connection is not None):
+			self.connection.release(self);
+			self.connection=None;
+	
+	#frames received before are dropped
+	async def clean(self):
+		self.frames.clear();
+		
+	async def slaveRx(self,modbusSlaveAddress):
+		try:
+			data=await self.frames.getFrame(DDModbus.SLAVE_RX_TIMEOUT);
+			if (data is None):
+				return False;
+			frame=slaveRequest(data);
+			ack=slaveAck(frame,data,modbusSlaveAddress);
+			if (ack is not None):
+				await self.connection.send(ack);
+			return frame;
+		except socket.error as exc:
+			return False;
+		
+	async def masterReadAnalog(self,modbusAddress,regAddress,regNb):
+		return await self.connection.transaction(self,'masterReadAnalog',modbusAddress,regAddress,regNb);
+		
+	async def masterWriteAnalog(self,modbusAddress,regAddress,data):
+		return await self.connection.transaction(self,'masterWriteAnalog',modbusAddress,regAddress,data);
+
+#shared gateway connections, keyed by event loop, ip and port
+gatewayConnections=dict();
+
+#open a link to the gateway ip:port, the connection is shared with other regulators of the same event loop
+async def openGateway(ip,port):
+	key=(asyncio.get_event_loop(),ip,port);
+	connection=gatewayConnections.get(key);
+	if (connection is None):
+		connection=GatewayConnection(ip,port,key);
+		gatewayConnections[key]=connection;
+	return await connection.open();
+
+#replay of a bus capture, provides the GatewayLink interface to a regulator loop
+#received bytes are delivered at their original times divided by speed, speed shall be positive as panel loops depend on bus timing
+#a sent frame is matched with the next identical frame sent in the capture, bytes received before it are skipped
+#an unmatched frame gets no answer, a frame sent in the capture and not by the loop is skipped after a silence
+#finished event is set once all records are consumed
+class ReplayDDModbus(AsyncDDModbus):
+	#max number of captured sent frames searched for a match
+	LOOKAHEAD=64;
+	
+	def __init__(self,path,speed=1.0):
+		if (speed <= 0):
+			raise ValueError('Replay speed shall be positive: '+str(speed));
+		super().__init__(path,0);
+		self.capture=None;
+		self.records=list(readCapture(path));
+		self.speed=speed;
+		self.index=0;
+		#index of a captured sent frame already answered by a silence, forced silence after an unmatched frame
+		self.silentIndex=None;
+		self.silence=False;
+		self.finished=None;
+		self.stats={'records':len(self.records),'rxChunks':0,'matched':0,'unmatched':0,'skipped':0};
+		
+	async def connect(self):
+		loop=asyncio.get_event_loop();
+		if (self.finished is None):
+			self.finished=asyncio.Event();
+			self.start=loop.time();
+			self.origin=self.records[0][0] if self.records else 0;
+		#the replay stands for the stream reader
+		self.reader=self;
+		
+	async def reconnect(self):
+		await self.connect();
+		
+	def close(self):
+		pass;
+		
+	#wait until the replay time of a record
+	async def waitRecord(self,record):
+		delay=self.start+(record[0]-self.origin)/self.speed-asyncio.get_event_loop().time();
+		if (delay > 0):
+			await asyncio.sleep(delay);
+	
+	#stream reader interface, the next received bytes
+	async def read(self,size=-1):
+		while (self.index < len(self.records)):
+			if self.silence:
+				self.silence=False;
+				raise asyncio.TimeoutError();
+			record=self.records[self.index];
+			if (record[1]==CAPTURE_RX):
+				await self.waitRecord(record);
+				self.index+=1;
+				self.stats['rxChunks']+=1;
+				if (self.index==len(self.records)):
+					self.finished.set();
+				return record[2];
+			if ((record[1]==CAPTURE_TX) and (self.silentIndex!=self.index)):
+				await self.waitRecord(record);
+				self.silentIndex=self.index;
+				raise asyncio.TimeoutError();
+			if (record[1]==CAPTURE_TX):
+				self.stats['skipped']+=1;
+			self.index+=1;
+		self.finished.set();
+		return b'';
+		
+	async def send(self,data):
+		found=0;
+		for i in range(self.index,len(self.records)):
+			if (self.records[i][1]!=CAPTURE_TX):
+				continue;
+			if (self.records[i][2]==data):
+				self.stats['matched']+=1;
+				self.stats['skipped']+=found;
+				self.index=i+1;
+				if (self.index==len(self.records)):
+					self.finished.set();
+				return;
+			found+=1;
+			if (found >= self.LOOKAHEAD):
+				break;
+		TRACE.add(self.gateway,TRACE_TX,TRACE_SKIPPED,data);
+		self.stats['unmatched']+=1;
+		self.silence=True;
+
+#blocking interface to the RS485/TCP gateway, thin wrapper running AsyncDDModbus on a private event loop
+class DDModbus:
+	ip=None; #serial port id
+	port=None;
+	CLEANING_TIMEOUT=0.1;
+	SLAVE_RX_TIMEOUT=0.5;
+	MASTER_RX_TIMEOUT=1.5;
+	READ_ANALOG_HOLDING_REGISTERS=0x03;
+	WRITE_MULTIPLE_REGISTERS=0x10;
+	
+	ANSWER_FRAME_MIN_LENGTH=0x07;
+	ANSWER_FRAME_MAX_LENGTH=0x100;
+
+	def __init__(self,ip,port):
+		#logger
+		self.logger = logging.getLogger(__name__)
+		
+		#connection
+		self.ip=ip;
+		self.port=port;
+		self.loop=asyncio.new_event_loop();
+		self.interface=AsyncDDModbus(ip,port);
+		self.loop.run_until_complete(self.interface.connect());
+	
+	def close(self):
+		self.interface.close();
+		self.loop.close();
+		
+	def clean(self):
+		return self.loop.run_until_complete(self.interface.clean());
+
+	def recvFrame(self,timeout):
+		return self.loop.run_until_complete(self.interface.recvFrame(timeout));
+
+	def slaveRx(self,modbusSlaveAddress):
+		return self.loop.run_until_complete(self.interface.slaveRx(modbusSlaveAddress));
+				
+	def masterReadAnalog(self,modbusAddress,regAddress,regNb):
+		return self.loop.run_until_complete(self.interface.masterReadAnalog(modbusAddress,regAddress,regNb));
+			
+	def masterWriteAnalog(self,modbusAddress,regAddress,data):
+		return self.loop.run_until_complete(self.interface.masterWriteAnalog(modbusAddress,regAddress,data));
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import threading,queue
+import asyncio
 import logging, logging.config
 import DDModbus
+import Metrics
 import time,datetime,pytz
 from enum import IntEnum
 
@@ -15,6 +17,18 @@ TEMP_MAX_ECS=80
 TEMP_MIN_INT=5
 TEMP_MAX_INT=30
 
+#decoding of Modbus encoded float values, 0xFFFF means no value and bit 15 is the sign
+def float10(reg):
+	if (reg==0xFFFF):
+		return None;
+	if (reg >= 0x8000):
+		reg=-(reg & 0x7FFF)
+	return(reg*0.1);
+
+#default register read planning: max registers per read request and max unused registers merged in a request
+READ_BLOCK_SIZE=64
+READ_GAP_TOLERANCE=16
+
 	
 #definition of Diematic Register used to read/write functionnal attributes values
 
@@ -54,12 +68,120 @@ class DDREGISTER(IntEnum):
 	BOILER_TYPE=457;
 	PUMP_POWER=463;
 	ALARME=465;
+
+#panel metrics, labelled by boiler id
+SYNCHRO_TIMEOUTS=Metrics.counter('diematic_synchro_timeouts_total','Synchro timeouts followed by a reconnection',('boiler',));
+QUEUE_DEPTH=Metrics.gauge('diematic_queue_depth','Pending write requests',('boiler','queue'));
+
+#definition of polling tiers, ONCHANGE registers are only read at start and after a write
+class POLLTIER(IntEnum):
+	FAST=0;
+	NORMAL=1;
+	SLOW=2;
+	ONCHANGE=3;
+
+#default polling tier of registers, other registers are polled with NORMAL tier
+DEFAULT_POLLTIER={
+	DDREGISTER.CTRL:POLLTIER.SLOW,
+	DDREGISTER.BOILER_TYPE:POLLTIER.SLOW,
+	DDREGISTER.NB_JOUR_ANTIGEL:POLLTIER.ONCHANGE,
+	DDREGISTER.CONS_JOUR_A:POLLTIER.SLOW,
+	DDREGISTER.CONS_NUIT_A:POLLTIER.SLOW,
+	DDREGISTER.CONS_ANTIGEL_A:POLLTIER.SLOW,
+	DDREGISTER.CONS_JOUR_B:POLLTIER.SLOW,
+	DDREGISTER.CONS_NUIT_B:POLLTIER.SLOW,
+	DDREGISTER.CONS_ANTIGEL_B:POLLTIER.SLOW,
+	DDREGISTER.CONS_ECS:POLLTIER.SLOW,
+	DDREGISTER.CONS_ECS_NUIT:POLLTIER.SLOW,
+	DDREGISTER.TEMP_CHAUD:POLLTIER.FAST,
+	DDREGISTER.BASE_ECS:POLLTIER.FAST,
+	DDREGISTER.IONIZATION_CURRENT:POLLTIER.FAST,
+	DDREGISTER.RETURN_TEMP:POLLTIER.FAST,
+	DDREGISTER.SMOKE_TEMP:POLLTIER.FAST,
+	DDREGISTER.FAN_SPEED:POLLTIER.FAST,
+	DDREGISTER.PUMP_POWER:POLLTIER.FAST,
+}
+
+#registers read back after a write in addition of the written one
+WRITE_DEPENDENCIES={
+	DDREGISTER.MODE_A:(DDREGISTER.MODE_B,),
+	DDREGISTER.MODE_B:(DDREGISTER.MODE_A,),
+	DDREGISTER.NB_JOUR_ANTIGEL:(DDREGISTER.MODE_A,DDREGISTER.MODE_B),
+	DDREGISTER.CONS_JOUR_A:(DDREGISTER.TCALC_A,),
+	DDREGISTER.CONS_NUIT_A:(DDREGISTER.TCALC_A,),
+	DDREGISTER.CONS_ANTIGEL_A:(DDREGISTER.TCALC_A,),
+	DDREGISTER.CONS_JOUR_B:(DDREGISTER.TCALC_B,),
+	DDREGISTER.CONS_NUIT_B:(DDREGISTER.TCALC_B,),
+	DDREGISTER.CONS_ANTIGEL_B:(DDREGISTER.TCALC_B,),
+}
+
+#definition of register value sources: master read, bus snooping or acknowledged write
+class REGSOURCE(IntEnum):
+	READ=0;
+	SNOOP=1;
+	WRITE_ECHO=2;
+
+#class used to save register values, with the time and source of the last update of each register
+class RegisterStore(dict):
+	def __init__(self):
+		super().__init__();
+		self.timestamps=dict();
+		self.sources=dict();
+	
+	#merge register values of a dict address:value, returns the set of changed registers
+	def merge(self,values,source=REGSOURCE.READ,timestamp=None):
+		if (timestamp is None):
+			timestamp=time.time();
+		changed=set();
+		for address,value in values.items():
+			self.timestamps[address]=timestamp;
+			self.sources[address]=source;
+			if (self.get(address)!=value):
+				self[address]=value;
+				changed.add(address);
+		return changed;
+	
+	#age in s of a register, None if it has never been updated
+	def age(self,address,now=None):
+		timestamp=self.timestamps.get(address);
+		if (timestamp is None):
+			return None;
+		return (time.time() if (now is None) else now)-timestamp;
+	
+	#dict address:value of registers read from the regulator less than maxAge s ago
+	def readValues(self,maxAge,now=None):
+		now=time.time() if (now is None) else now;
+		return {address:value for address,value in self.items() if ((self.sources.get(address)==REGSOURCE.READ) and (self.age(address,now) <= maxAge))};
+
+#class used to define a read request of the register read plan
+class ReadBlock:
+	def __init__(self,address,regNb,tier,registers=()):
+		self.address=address;
+		self.regNb=regNb;
+		self.tier=tier;
+		#planned registers of the block
+		self.registers=frozenset(registers);
+		
+	def __str__(self):
+		return('Reg:'+str(self.address)+' nb: '+str(self.regNb)+' tier: '+self.tier.name);
 	
 #This class allow to read/write parameters to Diematic regulator with the helo of a RS485/TCPIP converter
 #refresh of attributes From regulator is done roughly every minute
 #update request to the regulator are done within 10 s and trigger a whole read refresh
 class Diematic:
 	updateCallback=None;
+	#a block is read if its period will be over within this tolerance in seconds
+	POLL_TOLERANCE=5;
+	#max number of times a refresh is interrupted by user commands, so that polling is not starved
+	MAX_PREEMPTIONS=3;
+	#default TTL of registers in polling periods of their tier, an attribute is unavailable once one of its registers is out of date (0: no TTL)
+	TTL_PERIODS=0;
+	#period in s of attribute expiry check
+	EXPIRY_CHECK_PERIOD=1;
+	#max age in s of a register read from the regulator for a write of the same value to be skipped
+	WRITE_SKIP_AGE=10;
+	#max number of read plans kept by set of planned registers
+	READ_PLAN_CACHE_SIZE=16;
 
 	def __init__(self,ip,port,regulatorAddress,interfaceAddress,boilerTimezone='',syncTime=False):
 		#default refresh period
@@ -72,6 +194,9 @@ class Diematic:
 		self.ip=ip;
 		self.port=port;
 		
+		#boiler identifier, used as metrics label
+		self.boilerId='';
+		
 		#regulator modbus address
 		self.regulatorAddress=regulatorAddress;
 		self.interfaceAddress=interfaceAddress;
@@ -93,16 +218,36 @@ class Diematic:
 		#this variable to count successive excess of boiler clock
 		self.overDriftCounter=0;
 		
-		#queue for generic register write request
-		self.regUpdateRequest=queue.Queue();
+		#queue for generic register write request, keeping last value of each register
+		self.regUpdateRequest=DDModbus.RegisterWriteQueue();
 		
 		#queues for specific Mode register request
 		self.zoneAModeUpdateRequest=queue.Queue();
 		self.zoneBModeUpdateRequest=queue.Queue();
 		self.hotWaterModeUpdateRequest=queue.Queue();	
 		
-		#dictionnary used to save registers data read from the regulator
-		self.registers=dict();
+		#store used to save registers data read from the regulator, with time and source of their last update
+		self.registers=RegisterStore();
+		
+		#attribute TTL settings, in polling periods and by attribute in s
+		self.ttlPeriods=self.TTL_PERIODS;
+		self.attributeTtls=dict();
+		self.nextExpiryCheck=0;
+		
+		#snooping of register values exchanged on the bus by the regulator, and last read request observed
+		self.snooping=False;
+		self.snoopedRead=None;
+		
+		#optional history recorder of attributes
+		self.history=None;
+		
+		#RS485 converter connexion, opened by the Modbus loop
+		self.modBusInterface=None;
+		self.loopThread=None;
+		
+		#event loop running the Modbus loop and event waking it up on user commands
+		self.eventLoop=None;
+		self.commandEvent=None;
 		
 		#init values of functionnal attributes
 		self.initRegulator();
@@ -112,14 +257,78 @@ class Diematic:
 		
 		#init refreshRequest flag
 		self.refreshRequest=False;
+		
+		#registers to read back after a write
+		self.readBackRequest=set();
+		
+		#register read planning parameters, read registers are computed at first refresh
+		self.readBlockSize=READ_BLOCK_SIZE;
+		self.readGapTolerance=READ_GAP_TOLERANCE;
+		self.extraRegisters=set();
+		self._pollRegisters=None;
+		#read plans by frozenset of planned registers, there are only a few tier combinations
+		self.readPlans=dict();
+		#time of last read or observation on the bus by register address
+		self.lastReads=dict();
+		#start of a refresh continued over several bus windows or interrupted by user commands
+		self.refreshStart=None;
+		self.refreshDeferred=False;
+		self.refreshPreemptions=0;
+		
+		#register polling tiers, FAST and SLOW periods default to refresh period
+		self.pollTiers=dict(DEFAULT_POLLTIER);
+		self.fastPeriod=None;
+		self.slowPeriod=None;
 	
-	def initConnection(self):
-		#RS485 converter connexion init
-		self.modBusInterface=DDModbus.DDModbus(self.ip,self.port);
+	async def initConnection(self):
+		#user commands wake up the event loop running the Modbus loop
+		if (self.eventLoop is not asyncio.get_event_loop()):
+			self.commandEvent=asyncio.Event();
+			self.eventLoop=asyncio.get_event_loop();
+		#RS485 converter connexion init, the connexion is shared with regulators of the same gateway and opened again once for all of them
+		if (self.modBusInterface is None):
+			self.modBusInterface=await DDModbus.openGateway(self.ip,self.port);
+		else:
+			await self.modBusInterface.reconnect();
 		self.logger.warning('Init Link with Regulator');
-		self.modBusInterface.clean();
+	
+	def closeConnection(self):
+		if (self.modBusInterface is not None):
+			self.modBusInterface.close();
+			self.modBusInterface=None;
+
+#this property returns True if user commands are pending
+	def commandPending(self):
+		return (not(self.zoneAModeUpdateRequest.empty()) or not(self.zoneBModeUpdateRequest.empty()) or not(self.hotWaterModeUpdateRequest.empty()) or not(self.regUpdateRequest.empty()));
+
+#this property is used to wake up the Modbus loop, it may be called from any thread
+	def wakeUp(self):
+		if (self.eventLoop is not None):
+			try:
+				self.eventLoop.call_soon_threadsafe(self.commandEvent.set);
+			except RuntimeError:
+				#event loop closed
+				pass;
+
+#this property is used by the Modbus loop to wait for a user command during timeout seconds, it returns True if a command is pending
+	async def waitCommand(self,timeout):
+		self.commandEvent.clear();
+		if (self.commandPending()):
+			return True;
+		try:
+			await asyncio.wait_for(self.commandEvent.wait(),timeout);
+		except asyncio.TimeoutError:
+			pass;
+		return self.commandPending();
 	
 	def initAttributes(self):
+		#all attributes shall be decoded at next refresh, attributes changed outside of decoding are saved for next callback
+		self.decodeAll=True;
+		self.changedRegisters=set();
+		self.changedAttributes=set();
+		#attributes set unavailable on TTL expiry, decoded again once their registers are updated
+		self.expiredAttributes=set();
+		
 		#regulator attributes
 		self.availability=False;
 		self._datetime=None;
@@ -157,24 +366,21 @@ class Diematic:
 		self._zoneBAntiiceTargetTemp=None;
 		
 	def initRegulator(self):
-		#RS485 converter connexion init
-		self.initConnection();
-		#Attributes init
+		#Attributes init, RS485 converter connexion is opened by the Modbus loop
 		self.initAttributes();
 		
 
 
 
 #this setter/getter are used to read or change values of the regulator
+#setpoint values are encoded with the codec table (step rounding and min/max clamping)
 	@property
 	def hotWaterNightTargetTemp(self):
 			return self._hotWaterNightTargetTemp;
 			
 	@hotWaterNightTargetTemp.setter
 	def hotWaterNightTargetTemp(self,x):
-			#register structure creation, only 5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_ECS_NUIT.value,[min(max(round(x/5)*50,TEMP_MIN_ECS*10),TEMP_MAX_ECS*10)]);
-			self.regUpdateRequest.put(reg);
+			self.writeAttribute('hotWaterNightTargetTemp',x);
 			
 	@property
 	def hotWaterDayTargetTemp(self):
@@ -182,9 +388,7 @@ class Diematic:
 			
 	@hotWaterDayTargetTemp.setter
 	def hotWaterDayTargetTemp(self,x):
-			#register structure creation, only 5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_ECS.value,[min(max(round(x/5)*50,TEMP_MIN_ECS*10),TEMP_MAX_ECS*10)]);
-			self.regUpdateRequest.put(reg);
+			self.writeAttribute('hotWaterDayTargetTemp',x);
 			
 	@property
 	def zoneAAntiiceTargetTemp(self):
@@ -192,9 +396,7 @@ class Diematic:
 			
 	@zoneAAntiiceTargetTemp.setter
 	def zoneAAntiiceTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_ANTIGEL_A.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);
-			self.regUpdateRequest.put(reg);
+			self.writeAttribute('zoneAAntiiceTargetTemp',x);
 			
 	@property
 	def zoneANightTargetTemp(self):
@@ -202,9 +404,7 @@ class Diematic:
 			
 	@zoneANightTargetTemp.setter
 	def zoneANightTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_NUIT_A.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);	
-			self.regUpdateRequest.put(reg);
+			self.writeAttribute('zoneANightTargetTemp',x);
 			
 	@property
 	def zoneADayTargetTemp(self):
@@ -212,29 +412,23 @@ class Diematic:
 			
 	@zoneADayTargetTemp.setter
 	def zoneADayTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_JOUR_A.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);
-			self.regUpdateRequest.put(reg);
-
+			self.writeAttribute('zoneADayTargetTemp',x);
+			
 	@property
 	def zoneBAntiiceTargetTemp(self):
 			return self._zoneBAntiiceTargetTemp;
 			
 	@zoneBAntiiceTargetTemp.setter
 	def zoneBAntiiceTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_ANTIGEL_B.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);
-			self.regUpdateRequest.put(reg);
-
+			self.writeAttribute('zoneBAntiiceTargetTemp',x);
+			
 	@property
 	def zoneBNightTargetTemp(self):
 			return self._zoneBNightTargetTemp;
 			
 	@zoneBNightTargetTemp.setter
 	def zoneBNightTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_NUIT_B.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);
-			self.regUpdateRequest.put(reg);
+			self.writeAttribute('zoneBNightTargetTemp',x);
 			
 	@property
 	def zoneBDayTargetTemp(self):
@@ -242,52 +436,33 @@ class Diematic:
 			
 	@zoneBDayTargetTemp.setter
 	def zoneBDayTargetTemp(self,x):
-			#register structure creation, only 0.5 multiple are usable, temp is in tenth of degree
-			reg=DDModbus.RegisterSet(DDREGISTER.CONS_JOUR_B.value,[min(max(round(2*x)*5,TEMP_MIN_INT*10),TEMP_MAX_INT*10)]);	
-			self.regUpdateRequest.put(reg);
-
+			self.writeAttribute('zoneBDayTargetTemp',x);
+			
 	@property
 	def zoneAMode(self):
 			return self._zoneAMode;
 			
 	@zoneAMode.setter
 	def zoneAMode(self,x):
-		
-		#request mode A register change depending mode requested
-		self.logger.debug('zone A mode requested:'+str(x));	
-		if (x=='AUTO'):
-			self.zoneAModeUpdateRequest.put(8);
-		elif (x=='TEMP JOUR'):
-			self.zoneAModeUpdateRequest.put(36);
-		elif (x=='TEMP NUIT'):
-			self.zoneAModeUpdateRequest.put(34);
-		elif (x=='PERM JOUR'):
-			self.zoneAModeUpdateRequest.put(4);
-		elif (x=='PERM NUIT'):
-			self.zoneAModeUpdateRequest.put(2);
-		elif (x=='ANTIGEL'):
-			self.zoneAModeUpdateRequest.put(1);
+		#request mode register change depending mode requested
+		self.logger.debug('zone A mode requested:'+str(x));
+		mode=ATTRIBUTE_CODECS['zoneAMode'].encode(x);
+		if (mode is not None):
+			self.zoneAModeUpdateRequest.put(mode);
+			self.wakeUp();
+			
 	@property
 	def zoneBMode(self):
 			return self._zoneBMode;
 			
 	@zoneBMode.setter
 	def zoneBMode(self,x):
-		
-		#request mode B register change depending mode requested
-		self.logger.debug('zone B mode requested:'+str(x));	
-		if (x=='AUTO'):
-			self.zoneBModeUpdateRequest.put(8);
-		elif (x=='TEMP JOUR'):
-			self.zoneBModeUpdateRequest.put(36);
-		elif (x=='TEMP NUIT'):
-			self.zoneBModeUpdateRequest.put(34);
-		elif (x=='PERM JOUR'):
-			self.zoneBModeUpdateRequest.put(4);
-		elif (x=='PERM NUIT'):
-			self.zoneBModeUpdateRequest.put(2);
-		elif (x=='ANTIGEL'):
-			self.zoneBModeUpdateRequest.put(1);
+		#request mode register change depending mode requested
+		self.logger.debug('zone B mode requested:'+str(x));
+		mode=ATTRIBUTE_CODECS['zoneBMode'].encode(x);
+		if (mode is not None):
+			self.zoneBModeUpdateRequest.put(mode);
+			self.wakeUp();
 			
 	@property
 	def hotWaterMode(self):
@@ -295,15 +470,12 @@ class Diematic:
 			
 	@hotWaterMode.setter
 	def hotWaterMode(self,x):
-			
-		#request hotwater mode register change depending mode requested
-		self.logger.debug('hot water mode requested:'+str(x));	
-		if (x=='AUTO'):
-			self.hotWaterModeUpdateRequest.put(0);
-		elif (x=='TEMP'):
-			self.hotWaterModeUpdateRequest.put(0x50);
-		elif (x=='PERM'):
-			self.hotWaterModeUpdateRequest.put(0x10);
+		#request mode register change depending mode requested
+		self.logger.debug('hot water mode requested:'+str(x));
+		mode=ATTRIBUTE_CODECS['hotWaterMode'].encode(x);
+		if (mode is not None):
+			self.hotWaterModeUpdateRequest.put(mode);
+			self.wakeUp();
 	
 	@property
 	def datetime(self):
@@ -314,6 +486,7 @@ class Diematic:
 		#switch time to boiler timezone
 		x=x.astimezone(self.tzinfo);
 		self.lastTimeSync=x;
+		self.changedAttributes.add('lastTimeSync');
 		#request hour/minute/weekday registers change
 		self.logger.debug('datetime requested:'+x.isoformat());
 		reg=DDModbus.RegisterSet(DDREGISTER.HEURE.value,[x.hour,x.minute,x.isoweekday()]);
@@ -322,139 +495,336 @@ class Diematic:
 		#request day/month/year registers change
 		reg=DDModbus.RegisterSet(DDREGISTER.JOUR.value,[x.day,x.month,(x.year % 100)]);
 		self.regUpdateRequest.put(reg);
+		self.wakeUp();
 
 #decoding property to decode Modbus encoded float values	
 	def float10(self,reg):
-		if (reg==0xFFFF):
-			return None;
-		if (reg >= 0x8000):
-			reg=-(reg & 0x7FFF)
-		return(reg*0.1);
+		return float10(reg);
 
-#this property is used to refresh class functionnal attributes with data extracted from the regulator	
-	def refreshAttributes(self):
-		FAN_SPEED_MAX=5900;
-		
-		#boiler
-		self.availability=True;
-		self._datetime=datetime.datetime(self.registers[DDREGISTER.ANNEE]+2000,self.registers[DDREGISTER.MOIS],self.registers[DDREGISTER.JOUR],self.registers[DDREGISTER.HEURE],self.registers[DDREGISTER.MINUTE],0,0);
+#this property is used to request the write of an attribute encoded with the codec table
+	def writeAttribute(self,attribute,x):
+		codec=ATTRIBUTE_CODECS[attribute];
+		value=codec.encode(x);
+		if (value is not None):
+			reg=DDModbus.RegisterSet(codec.register,[value]);
+			self.regUpdateRequest.put(reg);
+			self.wakeUp();
+
+#decoding of attributes depending on several registers
+	def decodeDatetime(self):
+		value=datetime.datetime(self.registers[DDREGISTER.ANNEE]+2000,self.registers[DDREGISTER.MOIS],self.registers[DDREGISTER.JOUR],self.registers[DDREGISTER.HEURE],self.registers[DDREGISTER.MINUTE],0,0);
 		if self.tzinfo is not None:
-			self._datetime=self.tzinfo.localize(self._datetime);
+			return self.tzinfo.localize(value);
 		else:
-			self._datetime=self._datetime.astimezone();
-
-		self.type=self.registers[DDREGISTER.BOILER_TYPE];
-		self.release=self.registers[DDREGISTER.CTRL];
-		self.extTemp=self.float10(self.registers[DDREGISTER.TEMP_EXT]);
-		self.temp=self.float10(self.registers[DDREGISTER.TEMP_CHAUD]);
-		self.targetTemp=self.float10(self.registers[DDREGISTER.TCALC_A]);
-		self.returnTemp=self.float10(self.registers[DDREGISTER.RETURN_TEMP]);
-		self.waterPressure=self.float10(self.registers[DDREGISTER.PRESSION_EAU]);
-		self.smokeTemp=self.float10(self.registers[DDREGISTER.SMOKE_TEMP]);
-		self.ionizationCurrent=self.float10(self.registers[DDREGISTER.IONIZATION_CURRENT]);
-		self.fanSpeed=self.registers[DDREGISTER.FAN_SPEED];
-		self.burnerStatus=(self.registers[DDREGISTER.BASE_ECS] & 0x08) >>3;
+			return value.astimezone();
+
+	def decodeBurnerPower(self):
+		FAN_SPEED_MAX=5900;
 		#burner power calculation with fanspeed and ionization current
-		if (self.ionizationCurrent is not None):
-			self.burnerPower=round((self.registers[DDREGISTER.FAN_SPEED] / FAN_SPEED_MAX)*100) if (self.ionizationCurrent>0) else 0;
-		self.alarm={'id':None,'txt':None}
-		self.alarm['id']=self.registers[DDREGISTER.ALARME];
-		if (self.alarm['id']==0):
-			self.alarm['txt']='OK';
-		elif (self.alarm['id']==10):
-			self.alarm['txt']='Défaut Sonde Retour';
-		elif (self.alarm['id']==21):
-			self.alarm['txt']='Pression d\'eau basse';
-		elif (self.alarm['id']==26):
-			self.alarm['txt']='Défaut Allumage';
-		elif (self.alarm['id']==27):
-			self.alarm['txt']='Flamme Parasite';
-		elif (self.alarm['id']==28):
-			self.alarm['txt']='STB Chaudière';
-		elif (self.alarm['id']==30):
-			self.alarm['txt']='Rearm. Coffret';	
-		elif (self.alarm['id']==31):
-			self.alarm['txt']='Défaut Sonde Fumée';
-		else:
-			self.alarm['txt']='Défaut inconnu';
+		ionizationCurrent=float10(self.registers[DDREGISTER.IONIZATION_CURRENT]);
+		if (ionizationCurrent is None):
+			return KEEP_VALUE;
+		return round((self.registers[DDREGISTER.FAN_SPEED] / FAN_SPEED_MAX)*100) if (ionizationCurrent>0) else 0;
+
+	def decodePumpPower(self):
+		if (not self.zoneAEnabled()):
+			return KEEP_VALUE;
+		return self.registers[DDREGISTER.PUMP_POWER] if (self.registers[DDREGISTER.BASE_ECS] & 0x10) else 0;
+
+	def decodeAlarm(self):
+		alarmId=self.registers[DDREGISTER.ALARME];
+		return {'id':alarmId,'txt':ALARM_TEXT.get(alarmId,'Défaut inconnu')};
+
+#zone enabling, zone attributes are None if the zone is not used
+	def zoneAEnabled(self):
+		return ((float10(self.registers[DDREGISTER.TEMP_AMB_A]) is not None) or self.forceCircuitA);
+
+	def zoneBEnabled(self):
+		return ((float10(self.registers[DDREGISTER.TEMP_AMB_B]) is not None) or self.forceCircuitB);
+
+#this property is used to save register values read from the regulator and to keep track of changed ones
+	def updateRegisters(self,reg,source=REGSOURCE.READ):
+		self.changedRegisters.update(self.registers.merge(reg,source));
+
+#this property is used to merge register values observed on the bus, it returns the set of merged registers
+#write requests to the regulator or from the regulator to the interface, and regulator answers to read requests of another master are merged
+#writes to other peripherals hold registers of these peripherals, they are skipped, frames shall be received in bus order
+	def snoopFrame(self,frame):
+		values=dict();
+		if (frame.valid and (frame.modbusFunctionCode==DDModbus.DDModbus.WRITE_MULTIPLE_REGISTERS)):
+			if (frame.modbusAddress in (self.regulatorAddress,self.interfaceAddress)):
+				values=frame.data;
+		elif (frame.valid and (frame.modbusFunctionCode==DDModbus.DDModbus.READ_ANALOG_HOLDING_REGISTERS)):
+			#read request, its answer is merged if the regulator is requested
+			self.snoopedRead=frame if (frame.modbusAddress==self.regulatorAddress) else None;
+			return set();
+		elif (frame.answer and (self.snoopedRead is not None) and (frame.modbusAddress==self.snoopedRead.modbusAddress) and (len(frame.values)==self.snoopedRead.regNb)):
+			values={self.snoopedRead.regAddress+i:value for i,value in enumerate(frame.values)};
+		self.snoopedRead=None;
+		if (not values):
+			return set();
+		self.logger.debug('Snooped registers: '+str(values));
+		self.updateRegisters(values,REGSOURCE.SNOOP);
 		
-		#hotwater
-		self.hotWaterPump=(self.registers[DDREGISTER.BASE_ECS] & 0x20) >>5;
-		self.hotWaterTemp=self.float10(self.registers[DDREGISTER.TEMP_ECS]);
-		if ((self.registers[DDREGISTER.MODE_A] & 0x50) ==0):
-			self._hotWaterMode='AUTO';
-		elif ((self.registers[DDREGISTER.MODE_A] & 0x50) ==0x50):
-			self._hotWaterMode='TEMP';
-		elif ((self.registers[DDREGISTER.MODE_A] & 0x50) ==0x10):
-			self._hotWaterMode='PERM';
+		#registers observed on the bus are not read before their next period
+		for reg in self.pollRegisters().intersection(values):
+			self.lastReads[reg]=self.registers.timestamps[reg];
+		return set(values);
+
+#this property is used to refresh class functionnal attributes with data extracted from the regulator
+#only attributes depending on registers changed since last refresh are decoded, callback receives the set of changed attributes
+	def refreshAttributes(self):
+		now=time.time();
+		changed=self.changedAttributes;
+		self.changedAttributes=set();
+		
+		#codecs of attributes depending on changed registers, and of expired attributes
+		if self.decodeAll:
+			codecs=CODECS;
 		else:
-			self._hotWaterMode=None;
-		self._hotWaterDayTargetTemp=self.float10(self.registers[DDREGISTER.CONS_ECS]);
-		self._hotWaterNightTargetTemp=self.float10(self.registers[DDREGISTER.CONS_ECS_NUIT]);
+			codecs=set();
+			for reg in self.changedRegisters:
+				codecs.update(REGISTER_CODECS.get(reg,()));
+			for attribute in self.expiredAttributes:
+				codecs.add(ATTRIBUTE_CODECS[attribute]);
+		self.changedRegisters=set();
 		
-		#Area A
-		self.zoneATemp=self.float10(self.registers[DDREGISTER.TEMP_AMB_A]);
-		if ( (self.zoneATemp is not None ) or self.forceCircuitA):
-			modeA=self.registers[DDREGISTER.MODE_A]& 0x2F;
-			
-			if (modeA==8):
-				self._zoneAMode='AUTO';
-			elif (modeA==36):
-				self._zoneAMode='TEMP JOUR';
-			elif (modeA==34):
-				self._zoneAMode='TEMP NUIT';
-			elif (modeA==4):
-				self._zoneAMode='PERM JOUR';
-			elif (modeA==2):
-				self._zoneAMode='PERM NUIT';
-			elif (modeA==1):
-				self._zoneAMode='ANTIGEL';			
-			self.zoneAPump=(self.registers[DDREGISTER.BASE_ECS] & 0x10) >>4;
-			self.pumpPower=self.registers[DDREGISTER.PUMP_POWER] if (self.zoneAPump==1) else 0;
-			self._zoneADayTargetTemp=self.float10(self.registers[DDREGISTER.CONS_JOUR_A]);
-			self._zoneANightTargetTemp=self.float10(self.registers[DDREGISTER.CONS_NUIT_A]);
-			self._zoneAAntiiceTargetTemp=self.float10(self.registers[DDREGISTER.CONS_ANTIGEL_A]);
+		#boiler
+		if (not self.availability):
+			changed.add('availability');
+		self.availability=True;
+		for codec in codecs:
+			#attribute is decoded if all its registers are available and up to date
+			if (all((reg in self.registers) for reg in codec.registers) and not self.attributeExpired(codec,now)):
+				self.expiredAttributes.discard(codec.attribute);
+				value=codec.decode(self);
+				if (value is KEEP_VALUE):
+					value=getattr(self,codec.storage);
+				if (self.decodeAll or (getattr(self,codec.storage)!=value)):
+					setattr(self,codec.storage,value);
+					changed.add(codec.attribute);
+		self.decodeAll=False;
+		
+		#sample of all attributes recorded in history, at most once per history interval
+		if ((self.history is not None) and self.history.due(now)):
+			self.history.record(now,{codec.attribute:getattr(self,codec.storage) for codec in CODECS});
 
-		else:
-			self._zoneAMode=None;
-			self.zoneAPump=None;
-			self._zoneADayTargetTemp=None;
-			self._zoneANightTargetTemp=None;
-			self._zoneAAntiiceTargetTemp=None;
-
-				
-		#Area B
-		self.zoneBTemp=self.float10(self.registers[DDREGISTER.TEMP_AMB_B]);
-		if ( (self.zoneBTemp is not None) or self.forceCircuitB):
-			modeB=self.registers[DDREGISTER.MODE_B]& 0x2F;
-			if (modeB==8):
-				self._zoneBMode='AUTO';
-			elif (modeB==36):
-				self._zoneBMode='TEMP JOUR';
-			elif (modeB==34):
-				self._zoneBMode='TEMP NUIT';
-			elif (modeB==4):
-				self._zoneBMode='PERM JOUR';
-			elif (modeB==2):
-				self._zoneBMode='PERM NUIT';
-			elif (modeB==1):
-				self._zoneBMode='ANTIGEL';
-				
-			self.zoneBPump=(self.registers[DDREGISTER.OPTIONS_B_C] & 0x10) >>4;
-			self._zoneBDayTargetTemp=self.float10(self.registers[DDREGISTER.CONS_JOUR_B]);
-			self._zoneBNightTargetTemp=self.float10(self.registers[DDREGISTER.CONS_NUIT_B]);
-			self._zoneBAntiiceTargetTemp=self.float10(self.registers[DDREGISTER.CONS_ANTIGEL_B]);
+		self.updateCallback(changed);
+
+#this property is used to set attribute TTL, periods is the TTL of registers in polling periods of their tier (0: no TTL)
+#ttls is a dict attribute:TTL in s of the oldest register of the attribute (0: no TTL), overriding periods
+	def setTtl(self,periods=TTL_PERIODS,ttls=None):
+		self.ttlPeriods=max(periods,0);
+		if (ttls is not None):
+			self.attributeTtls.update(ttls);
+
+#this property returns the age in s of an attribute, which is the age of its oldest register, None if a register has never been updated
+	def attributeAge(self,attribute,now=None):
+		ages=[self.registers.age(reg,now) for reg in ATTRIBUTE_CODECS[attribute].registers];
+		return None if (None in ages) else max(ages);
+
+#this property returns True if attributes expire with a TTL
+	def ttlEnabled(self):
+		return bool(self.ttlPeriods or any(self.attributeTtls.values()));
+
+#this property returns True if an attribute has not expired, its value may not have been read yet
+	def attributeAvailable(self,attribute):
+		return (attribute not in self.expiredAttributes);
+
+#this property returns True if one of the registers of an attribute is out of date, ONCHANGE registers never expire
+	def attributeExpired(self,codec,now=None):
+		if (codec.attribute in self.attributeTtls):
+			ttl=self.attributeTtls[codec.attribute];
+			age=self.attributeAge(codec.attribute,now);
+			return (bool(ttl) and (age is not None) and (age > ttl));
+		if (not self.ttlPeriods):
+			return False;
+		for reg in codec.registers:
+			period=self.tierPeriod(self.pollTiers.get(reg,POLLTIER.NORMAL));
+			age=self.registers.age(reg,now);
+			if ((period is not None) and (age is not None) and (age > self.ttlPeriods*period)):
+				return True;
+		return False;
 
+#this property is used by the Modbus loop to set out of date attributes unavailable, the boiler availability only depends on the link
+	def expireAttributes(self):
+		now=time.time();
+		if (now < self.nextExpiryCheck):
+			return;
+		self.nextExpiryCheck=now+self.EXPIRY_CHECK_PERIOD;
+		changed=set();
+		for codec in CODECS:
+			if ((getattr(self,codec.storage) is not None) and self.attributeExpired(codec,now)):
+				self.logger.info('Attribute expired: '+codec.attribute+', age: '+str(self.attributeAge(codec.attribute,now)));
+				setattr(self,codec.storage,None);
+				self.expiredAttributes.add(codec.attribute);
+				changed.add(codec.attribute);
+		if (changed):
+			self.updateCallback(changed);
+
+#this property is used by the Modbus loop on synchro timeout, the boiler is unavailable
+#attributes are kept until their TTL expires, or reset at once without TTL
+	def synchroLost(self):
+		if self.ttlEnabled():
+			if self.availability:
+				self.availability=False;
+				self.updateCallback({'availability'});
+			self.expireAttributes();
 		else:
-			self._zoneBMode=None;
-			self.zoneBPump=None;
-			self._zoneBDayTargetTemp=None;
-			self._zoneBNightTargetTemp=None;
-			self._zoneBAntiiceTargetTemp=None;
+			#init regulator register
+			self.initAttributes();
+			#publish values
+			self.updateCallback();
 
-		self.updateCallback();
+#this property is used to request the read back of written registers and of registers depending on them
+	def requestReadBack(self,address,regNb=1):
+		for reg in range(address,address+regNb):
+			self.readBackRequest.add(reg);
+			self.readBackRequest.update(int(dependency) for dependency in WRITE_DEPENDENCIES.get(reg,()));
+
+#this property is used to read back requested registers, it returns the set of read registers or None in case of error
+#if a bus window is given, reads not fitting in it are left for next call
+	async def readBackRegisters(self,window=None):
+		readRegisters=set();
+		for regAddress,regNb in DDModbus.planRegisterReads(self.readBackRequest,self.readBlockSize,self.readGapTolerance):
+			if ((window is not None) and not window.fits(regNb)):
+				self.logger.debug('Read back deferred: '+str(sorted(self.readBackRequest)));
+				return readRegisters;
+			start=time.time();
+			reg=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,regAddress,regNb);
+			if (reg is not None):
+				if (window is not None):
+					window.record(regNb,time.time()-start);
+				self.updateRegisters(reg);
+				readRegisters.update(reg.keys());
+				self.readBackRequest.difference_update(reg.keys());
+			else:
+				if (window is not None):
+					window.collision(start);
+				return None;
+		self.logger.debug('Read back registers: '+str(sorted(readRegisters)));
+		self.readBackRequest.clear();
+		return readRegisters;
+
+#this property is used to set register read planning parameters, extraRegisters are read in addition of DDREGISTER ones
+	def setReadPlanning(self,blockSize=READ_BLOCK_SIZE,gapTolerance=READ_GAP_TOLERANCE,extraRegisters=()):
+		self.readBlockSize=max(blockSize,1);
+		self.readGapTolerance=max(gapTolerance,0);
+		self.extraRegisters=set(extraRegisters);
+		#read registers and plans will be computed again
+		self._pollRegisters=None;
+		self.readPlans.clear();
+
+#this property is used to set polling periods and tiers, tiers is a dict register address:POLLTIER
+	def setPolling(self,fastPeriod=None,slowPeriod=None,tiers=None):
+		self.fastPeriod=fastPeriod;
+		self.slowPeriod=slowPeriod;
+		if (tiers is not None):
+			self.pollTiers.update(tiers);
+			#block tiers of read plans will be computed again
+			self.readPlans.clear();
+
+#this property returns the polling period of a tier in seconds, None for ONCHANGE tier
+	def tierPeriod(self,tier):
+		if (tier==POLLTIER.FAST):
+			return self.fastPeriod if (self.fastPeriod is not None) else self.refreshPeriod;
+		elif (tier==POLLTIER.SLOW):
+			return self.slowPeriod if (self.slowPeriod is not None) else self.refreshPeriod;
+		elif (tier==POLLTIER.NORMAL):
+			return self.refreshPeriod;
+		return None;
+
+#this property returns the period of the Modbus loop, which is the shortest polling period
+	def pollPeriod(self):
+		periods=[self.tierPeriod(self.pollTiers.get(reg,POLLTIER.NORMAL)) for reg in self.pollRegisters()];
+		periods=[period for period in periods if period is not None];
+		return min(periods) if periods else self.refreshPeriod;
 
+#this property returns the set of registers read from the regulator
+	def pollRegisters(self):
+		if (self._pollRegisters is None):
+			self._pollRegisters=frozenset({reg.value for reg in DDREGISTER} | self.extraRegisters);
+		return self._pollRegisters;
 
+#this property returns the set of registers never read or whose polling period is over at the start of the refresh
+	def dueRegisters(self):
+		due=set();
+		for reg in self.pollRegisters():
+			lastRead=self.lastReads.get(reg);
+			period=self.tierPeriod(self.pollTiers.get(reg,POLLTIER.NORMAL));
+			if ((lastRead is None) or ((period is not None) and ((self.refreshStart-lastRead) >= (period-self.POLL_TOLERANCE)))):
+				due.add(reg);
+		return due;
+
+#this property returns the list of ReadBlock needed to get registers, all registers by default
+#registers of all tiers are planned together so that adjacent registers are read by a single request, the block tier is the most frequent one
+#plans are computed once by set of registers
+	def readPlan(self,registers=None):
+		registers=self.pollRegisters() if (registers is None) else frozenset(registers);
+		plan=self.readPlans.get(registers);
+		if (plan is None):
+			plan=list();
+			for regAddress,regNb in DDModbus.planRegisterReads(registers,self.readBlockSize,self.readGapTolerance):
+				blockRegisters=[reg for reg in registers if (regAddress <= reg < regAddress+regNb)];
+				plan.append(ReadBlock(regAddress,regNb,min(self.pollTiers.get(reg,POLLTIER.NORMAL) for reg in blockRegisters),blockRegisters));
+			#snooped registers may give unusual sets, the cache is emptied when full
+			if (len(self.readPlans) >= self.READ_PLAN_CACHE_SIZE):
+				self.readPlans.clear();
+			self.readPlans[registers]=plan;
+		return plan;
+
+#this property is used to get register values from the regulator, only registers whose polling period is over are read unless force is set
+#if a bus window is given, blocks not fitting in it are left for next call and None is returned
+#pending user commands also interrupt the refresh, up to MAX_PREEMPTIONS times, and None is returned
+#due registers are planned in blocks, blocks with registers never read are read first, then by polling tier priority
+	async def refreshRegisters(self,force=False,window=None):
+		now=time.time();
+		#forced refresh, all registers are due until read
+		if (force):
+			self.lastReads.clear();
+		#registers are due at the start of the refresh, registers read since then are not read again by a continued refresh
+		if (self.refreshStart is None):
+			self.refreshStart=now;
+		plan=self.readPlan(self.dueRegisters());
+		if plan:
+			self.logger.debug('Register read plan: '+', '.join(str(block) for block in plan));
+		for block in sorted(plan,key=lambda block:(block.registers.issubset(self.lastReads),block.tier)):
+			if ((window is not None) and not window.fits(block.regNb)):
+				self.logger.debug('Refresh deferred from block: '+str(block));
+				return None;
+			if (self.commandPending() and (self.refreshPreemptions < self.MAX_PREEMPTIONS)):
+				self.refreshPreemptions+=1;
+				self.logger.debug('Refresh preempted by command from block: '+str(block));
+				return None;
+			start=time.time();
+			reg=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,block.address,block.regNb);
+			if (reg is not None):
+				if (window is not None):
+					window.record(block.regNb,time.time()-start);
+				self.updateRegisters(reg);
+				#registers of other tiers within the block are read too
+				for address in self.pollRegisters().intersection(range(block.address,block.address+block.regNb)):
+					self.lastReads[address]=now;
+			else:
+				if (window is not None):
+					window.collision(start);
+				self.refreshStart=None;
+				self.refreshPreemptions=0;
+				return(False);
+		self.refreshStart=None;
+		self.refreshPreemptions=0;
+		return(True);
+
+#this property is used to export queue depths as metrics, it shall be called once boilerId is set
+	def registerMetrics(self):
+		QUEUE_DEPTH.setFunction(self.regUpdateRequest.qsize,self.boilerId,'registers');
+		QUEUE_DEPTH.setFunction(self.zoneAModeUpdateRequest.qsize,self.boilerId,'zoneAMode');
+		QUEUE_DEPTH.setFunction(self.zoneBModeUpdateRequest.qsize,self.boilerId,'zoneBMode');
+		QUEUE_DEPTH.setFunction(self.hotWaterModeUpdateRequest.qsize,self.boilerId,'hotWaterMode');
+
+#modbus loop of the thread launched by loop_start, the asyncio loop of the panel runs on a private event loop
+	def loop(self):
+		asyncio.run(self.loopAsync());
 
 #property used to launch Modbus loop
 	def loop_start(self):
@@ -462,10 +832,149 @@ class Diematic:
 			self.loopThread = threading.Thread(target=self.loop)
 			self.loopThread.start();
 			
-#property used to stop Modbus loop	
+#property used to stop Modbus loop, the asyncio loop of the panel shall be awaited by the caller if it has not been launched by loop_start
 	def loop_stop(self):
 		self.run=False;
-		self.loopThread.join();
+		self.wakeUp();
+		if (self.loopThread is not None):
+			self.loopThread.join();
+		if (self.history is not None):
+			self.history.close();
+			self.history=None;
 		#reinit Regulator
 		self.initAttributes();
 		self.updateCallback();
+
+#enum maps of mode and alarm registers
+ZONE_MODES={8:'AUTO',36:'TEMP JOUR',34:'TEMP NUIT',4:'PERM JOUR',2:'PERM NUIT',1:'ANTIGEL'};
+HOTWATER_MODES={0:'AUTO',0x50:'TEMP',0x10:'PERM'};
+ALARM_TEXT={0:'OK',10:'Défaut Sonde Retour',21:'Pression d\'eau basse',26:'Défaut Allumage',27:'Flamme Parasite',28:'STB Chaudière',30:'Rearm. Coffret',31:'Défaut Sonde Fumée'};
+
+#decoded value of an attribute whose previous value is kept
+KEEP_VALUE=object();
+
+#declarative codec table of attributes
+#codec: raw, scaled (sign and magnitude with scale), bits (mask and shift), enum (mask, enum map and default value of unknown values, None by default), method (Diematic method using registers)
+#min/max/step are used to encode setpoints, zone is the circuit the attribute belongs to
+CODEC_TABLE=(
+	#boiler
+	{'attribute':'datetime','codec':'method','method':'decodeDatetime','registers':(DDREGISTER.ANNEE,DDREGISTER.MOIS,DDREGISTER.JOUR,DDREGISTER.HEURE,DDREGISTER.MINUTE)},
+	{'attribute':'type','register':DDREGISTER.BOILER_TYPE,'codec':'raw'},
+	{'attribute':'release','register':DDREGISTER.CTRL,'codec':'raw'},
+	{'attribute':'extTemp','register':DDREGISTER.TEMP_EXT,'codec':'scaled','scale':0.1},
+	{'attribute':'temp','register':DDREGISTER.TEMP_CHAUD,'codec':'scaled','scale':0.1},
+	{'attribute':'targetTemp','register':DDREGISTER.TCALC_A,'codec':'scaled','scale':0.1},
+	{'attribute':'returnTemp','register':DDREGISTER.RETURN_TEMP,'codec':'scaled','scale':0.1},
+	{'attribute':'waterPressure','register':DDREGISTER.PRESSION_EAU,'codec':'scaled','scale':0.1},
+	{'attribute':'smokeTemp','register':DDREGISTER.SMOKE_TEMP,'codec':'scaled','scale':0.1},
+	{'attribute':'ionizationCurrent','register':DDREGISTER.IONIZATION_CURRENT,'codec':'scaled','scale':0.1},
+	{'attribute':'fanSpeed','register':DDREGISTER.FAN_SPEED,'codec':'raw'},
+	{'attribute':'burnerStatus','register':DDREGISTER.BASE_ECS,'codec':'bits','mask':0x08,'shift':3},
+	{'attribute':'burnerPower','codec':'method','method':'decodeBurnerPower','registers':(DDREGISTER.FAN_SPEED,DDREGISTER.IONIZATION_CURRENT)},
+	{'attribute':'alarm','codec':'method','method':'decodeAlarm','registers':(DDREGISTER.ALARME,)},
+	
+	#hotwater
+	{'attribute':'hotWaterPump','register':DDREGISTER.BASE_ECS,'codec':'bits','mask':0x20,'shift':5},
+	{'attribute':'hotWaterTemp','register':DDREGISTER.TEMP_ECS,'codec':'scaled','scale':0.1},
+	{'attribute':'hotWaterMode','register':DDREGISTER.MODE_A,'codec':'enum','mask':0x50,'enum':HOTWATER_MODES},
+	{'attribute':'hotWaterDayTargetTemp','register':DDREGISTER.CONS_ECS,'codec':'scaled','scale':0.1,'min':TEMP_MIN_ECS,'max':TEMP_MAX_ECS,'step':5},
+	{'attribute':'hotWaterNightTargetTemp','register':DDREGISTER.CONS_ECS_NUIT,'codec':'scaled','scale':0.1,'min':TEMP_MIN_ECS,'max':TEMP_MAX_ECS,'step':5},
+	
+	#area A
+	{'attribute':'zoneATemp','register':DDREGISTER.TEMP_AMB_A,'codec':'scaled','scale':0.1},
+	{'attribute':'zoneAMode','register':DDREGISTER.MODE_A,'codec':'enum','mask':0x2F,'enum':ZONE_MODES,'default':KEEP_VALUE,'zone':'A'},
+	{'attribute':'zoneAPump','register':DDREGISTER.BASE_ECS,'codec':'bits','mask':0x10,'shift':4,'zone':'A'},
+	{'attribute':'pumpPower','codec':'method','method':'decodePumpPower','registers':(DDREGISTER.BASE_ECS,DDREGISTER.PUMP_POWER,DDREGISTER.TEMP_AMB_A)},
+	{'attribute':'zoneADayTargetTemp','register':DDREGISTER.CONS_JOUR_A,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'A'},
+	{'attribute':'zoneANightTargetTemp','register':DDREGISTER.CONS_NUIT_A,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'A'},
+	{'attribute':'zoneAAntiiceTargetTemp','register':DDREGISTER.CONS_ANTIGEL_A,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'A'},
+	
+	#area B
+	{'attribute':'zoneBTemp','register':DDREGISTER.TEMP_AMB_B,'codec':'scaled','scale':0.1},
+	{'attribute':'zoneBMode','register':DDREGISTER.MODE_B,'codec':'enum','mask':0x2F,'enum':ZONE_MODES,'default':KEEP_VALUE,'zone':'B'},
+	{'attribute':'zoneBPump','register':DDREGISTER.OPTIONS_B_C,'codec':'bits','mask':0x10,'shift':4,'zone':'B'},
+	{'attribute':'zoneBDayTargetTemp','register':DDREGISTER.CONS_JOUR_B,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'B'},
+	{'attribute':'zoneBNightTargetTemp','register':DDREGISTER.CONS_NUIT_B,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'B'},
+	{'attribute':'zoneBAntiiceTargetTemp','register':DDREGISTER.CONS_ANTIGEL_B,'codec':'scaled','scale':0.1,'min':TEMP_MIN_INT,'max':TEMP_MAX_INT,'step':0.5,'zone':'B'},
+);
+
+#registers used to know if a zone is enabled
+ZONE_REGISTERS={'A':DDREGISTER.TEMP_AMB_A,'B':DDREGISTER.TEMP_AMB_B};
+
+#class used to hold the decoder and encoder of an attribute compiled from the codec table
+class AttributeCodec:
+	__slots__=('attribute','storage','register','registers','decode','encode');
+	
+	def __init__(self,entry):
+		self.attribute=entry['attribute'];
+		#attributes with a property are stored in a private attribute
+		self.storage=('_'+self.attribute) if isinstance(getattr(Diematic,self.attribute,None),property) else self.attribute;
+		self.register=entry['register'].value if ('register' in entry) else None;
+		registers={reg.value for reg in entry.get('registers',(entry.get('register'),))};
+		if ('zone' in entry):
+			registers.add(ZONE_REGISTERS[entry['zone']].value);
+		self.registers=frozenset(registers);
+		self.decode=self.compileDecoder(entry);
+		self.encode=self.compileEncoder(entry);
+	
+	def compileDecoder(self,entry):
+		codec=entry['codec'];
+		register=self.register;
+		if (codec=='raw'):
+			def decode(panel):
+				return panel.registers[register];
+		elif (codec=='scaled'):
+			scale=entry['scale'];
+			def decode(panel):
+				value=panel.registers[register];
+				if (value==0xFFFF):
+					return None;
+				if (value >= 0x8000):
+					value=-(value & 0x7FFF);
+				return value*scale;
+		elif (codec=='bits'):
+			mask=entry['mask'];
+			shift=entry['shift'];
+			def decode(panel):
+				return (panel.registers[register] & mask) >> shift;
+		elif (codec=='enum'):
+			mask=entry['mask'];
+			enum=entry['enum'];
+			default=entry.get('default');
+			def decode(panel):
+				return enum.get(panel.registers[register] & mask,default);
+		elif (codec=='method'):
+			decode=getattr(Diematic,entry['method']);
+		else:
+			raise ValueError('Unknown codec: '+codec);
+		
+		#zone attributes are None if the zone is not enabled
+		if ('zone' in entry):
+			enabled=getattr(Diematic,'zone'+entry['zone']+'Enabled');
+			zoneDecode=decode;
+			def decode(panel):
+				return zoneDecode(panel) if enabled(panel) else None;
+		return decode;
+	
+	def compileEncoder(self,entry):
+		codec=entry['codec'];
+		if ((codec=='scaled') and ('step' in entry)):
+			#only step multiple are usable, clamped between min and max
+			scale=entry['scale'];
+			stepRaw=round(entry['step']/scale);
+			minRaw=round(entry['min']/scale);
+			maxRaw=round(entry['max']/scale);
+			step=entry['step'];
+			return lambda x:min(max(round(x/step)*stepRaw,minRaw),maxRaw);
+		elif (codec=='enum'):
+			reverse={text:value for value,text in entry['enum'].items()};
+			return lambda x:reverse.get(x);
+		return lambda x:None;
+
+#compiled codecs, by attribute and by register they depend on
+CODECS=tuple(AttributeCodec(entry) for entry in CODEC_TABLE);
+ATTRIBUTE_CODECS={codec.attribute:codec for codec in CODECS};
+REGISTER_CODECS=dict();
+for codec in CODECS:
+	for reg in codec.registers:
+		REGISTER_CODECS.setdefault(reg,list()).append(codec);
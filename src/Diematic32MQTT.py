@@ -1,170 +1,390 @@
 ﻿#!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys,signal,threading
+import os,sys,signal,threading
+import asyncio
 import configparser
 import logging, logging.config
-import DDModbus,Diematic3Panel,Diematic4Panel,DiematicDeltaPanel,Hassio
+import DDModbus,Diematic,Diematic3Panel,Diematic4Panel,DiematicDeltaPanel,Hassio,Metrics,History
 import paho.mqtt.client as mqtt
 import json
+import math
 import time,datetime
+#optional MessagePack support for aggregated state topic
+try:
+	import msgpack
+except ImportError:
+	msgpack=None
 
 
 ONLINE = 'Online'
 OFFLINE = 'Offline'
 
+#MQTT publications by topic
+MQTT_PUBLISH=Metrics.counter('diematic_mqtt_publish_total','MQTT messages published',('topic',));
+
+#publish modes: one topic per attribute, one aggregated state topic, or both
+PUBLISH_TOPICS = 'topics'
+PUBLISH_AGGREGATED = 'aggregated'
+PUBLISH_BOTH = 'both'
+
+#sub topic of an attribute topic giving its availability, when attributes expire with a TTL
+AVAILABILITY_TOPIC='availability'
+
+#float parsing of aggregated state values, non finite values are not valid in JSON
+def finiteFloat(text):
+	value=float(text);
+	return value if math.isfinite(value) else None;
+
 class MessageBuffer:
-	def __init__(self,mqtt):
+	#topics published without throttling, as availability topics of attributes
+	IMMEDIATE_TOPICS={'status'};
+	
+	#minInterval: min time in s between two publications of a topic, maxInterval: time in s after which a topic is published again (0 to disable)
+	#deadbands: dict of lowercase topic:(deadband,relative), a numeric value is not published if it is within the deadband of the published one
+	#publishMode: PUBLISH_TOPICS, PUBLISH_AGGREGATED or PUBLISH_BOTH, stateTopic and stateFormat (json or msgpack) are used for aggregated publication
+	def __init__(self,mqtt,topicPrefix,minInterval=0,maxInterval=0,deadbands=None,publishMode=PUBLISH_TOPICS,stateTopic='state',stateFormat='json'):
 		#logger
 		self.logger = logging.getLogger(__name__);
 		
 		self.buffer=dict();
 		self.mqtt=mqtt;
+		self.topicPrefix=topicPrefix;
+		#topics waiting to be published
+		self.pending=set();
+		#False when all topics have to be updated again
+		self.complete=False;
+		
+		#publication settings
+		self.minInterval=minInterval;
+		self.maxInterval=maxInterval;
+		self.deadbands=deadbands if (deadbands is not None) else dict();
+		self.nextHeartbeat=None;
+		self.publishMode=publishMode;
+		self.stateTopic=stateTopic;
+		self.stateFormat=stateFormat;
 	
 	#clear buffer
 	def clear(self):
 		self.buffer=dict();
+		self.pending=set();
+		self.complete=False;
+	
+	#check if value is within the deadband of the published value
+	def inDeadband(self,entry,value):
+		if (entry['deadband'] is None):
+			return False;
+		try:
+			new=float(value);
+			published=float(entry['value']);
+		except (TypeError,ValueError):
+			return False;
+		deadband,relative=entry['deadband'];
+		if relative:
+			deadband=deadband*abs(published)/100;
+		return (abs(new-published) < deadband);
 		
+	#status and availability topics are published at once, as topics whatever the publish mode
+	def immediate(self,topic):
+		return ((topic in self.IMMEDIATE_TOPICS) or topic.endswith('/'+AVAILABILITY_TOPIC));
+	
 	#update or create a message in the buffer
 	def update(self,topic,value):
+		entry=self.buffer.get(topic);
 		#if the topic is not in buffer
-		if ((topic not in self.buffer) or (self.buffer[topic]['value']!=value)):
-			self.buffer[topic]={'value':value,'update':True};
+		if (entry is None):
+			self.buffer[topic]={'value':None,'latest':value,'time':None,'deadband':self.deadbands.get(topic.lower())};
+			self.pending.add(topic);
+		else:
+			entry['latest']=value;
+			#publish if value is out of the deadband of the published one
+			if ((value==entry['value']) or self.inDeadband(entry,value)):
+				self.pending.discard(topic);
+			else:
+				self.pending.add(topic);
 			
+	#payload values are converted to number or object in the aggregated state, empty and non finite ones to null
+	def stateValue(self,value):
+		if (value==''):
+			return None;
+		try:
+			return json.loads(value,parse_constant=lambda constant:None,parse_float=finiteFloat);
+		except ValueError:
+			return value;
+	
+	#publish one aggregated message with published topics
+	def sendState(self,state):
+		state={topic:self.stateValue(value) for topic,value in state.items()};
+		if ((self.stateFormat=='msgpack') and (msgpack is not None)):
+			payload=msgpack.packb(state);
+		else:
+			payload=json.dumps(state,separators=(',',':'),ensure_ascii=False,allow_nan=False);
+		self.mqtt.publish(self.topicPrefix+'/'+self.stateTopic,payload,1,False);
+		MQTT_PUBLISH.inc(1,self.topicPrefix+'/'+self.stateTopic);
+		self.logger.info('Publish :'+self.topicPrefix+'/'+self.stateTopic+' '+str(len(state))+' value(s)');
+		
 	#publish buffer content to MQTT broker	
 	def send(self):
 		#if broker connected
 		if self.mqtt.brokerConnected:
-			#for each topic
-			for topic in self.buffer:
-				if self.buffer[topic]['update']:
-					#send message without trailing / on topic
+			now=time.monotonic();
+			
+			#heartbeat, topics not published since maxInterval are published again
+			if (self.maxInterval and ((self.nextHeartbeat is None) or (now >= self.nextHeartbeat))):
+				self.nextHeartbeat=now+self.maxInterval;
+				for topic,entry in self.buffer.items():
+					if (entry['time'] is not None):
+						if ((now-entry['time']) >= self.maxInterval):
+							self.pending.add(topic);
+						else:
+							self.nextHeartbeat=min(self.nextHeartbeat,entry['time']+self.maxInterval);
+			
+			#for each topic to publish
+			state=dict();
+			for topic in list(self.pending):
+				entry=self.buffer[topic];
+				#throttling of topics published less than minInterval ago, they stay pending
+				if (self.minInterval and (entry['time'] is not None) and ((now-entry['time']) < self.minInterval) and not self.immediate(topic)):
+					continue;
+				#send message without trailing / on topic, status topic is always published as it is used for availability
+				if ((self.publishMode!=PUBLISH_AGGREGATED) or self.immediate(topic)):
 					if (topic!=''):
-						self.mqtt.publish(mqttTopicPrefix+'/'+topic,self.buffer[topic]['value'],1,True);
-						self.logger.info('Publish :'+mqttTopicPrefix+'/'+topic+' '+self.buffer[topic]['value'])
+						self.mqtt.publish(self.topicPrefix+'/'+topic,entry['latest'],1,True);
+						MQTT_PUBLISH.inc(1,self.topicPrefix+'/'+topic);
+						self.logger.info('Publish :'+self.topicPrefix+'/'+topic+' '+entry['latest'])
 					else:
-						self.mqtt.publish(mqttTopicPrefix,self.buffer[topic]['value'],1,True);
-						self.logger.info('Publish :'+mqttTopicPrefix+' '+self.buffer[topic]['value'])
-					#set the flag to False
-					self.buffer[topic]['update']=False;
+						self.mqtt.publish(self.topicPrefix,entry['latest'],1,True);
+						MQTT_PUBLISH.inc(1,self.topicPrefix);
+						self.logger.info('Publish :'+self.topicPrefix+' '+entry['latest'])
+				state[topic]=entry['latest'];
+				#save published value
+				entry['value']=entry['latest'];
+				entry['time']=now;
+				self.pending.discard(topic);
+			
+			#aggregated state message of published topics
+			if (state and (self.publishMode!=PUBLISH_TOPICS)):
+				self.sendState(state);
 		#if broker not connected
 		else:
 			logger.error("Not connected to broker, can't publish messages");
 	
 	
-def diematicPublish(self):
-	def floatValue(parameter):
-		return (f"{parameter:.1f}" if parameter is not None else '');
-	def intValue(parameter):
-		return (f"{parameter:d}" if parameter is not None else '');
+#MQTT client loop driven by an asyncio event loop instead of the paho thread, socket events are handled by event loop readers and writers
+class AsyncioMqttLoop:
+	#period in s of paho housekeeping (keepalive, retries)
+	MISC_PERIOD=1;
+	#delay in s before a new broker connexion attempt
+	RECONNECT_DELAY=5;
+	
+	def __init__(self,loop,client):
+		#logger
+		self.logger = logging.getLogger(__name__);
+		
+		self.loop=loop;
+		#thread of the event loop, the loop is created within it
+		self.thread=threading.current_thread();
+		self.client=client;
+		self.client.on_socket_open=self.on_socket_open;
+		self.client.on_socket_close=self.on_socket_close;
+		self.client.on_socket_register_write=self.on_socket_register_write;
+		self.client.on_socket_unregister_write=self.on_socket_unregister_write;
+		
+	#socket callbacks are also called by the reconnexion executor thread, the event loop is then called thread safe
+	#the file descriptor is used as the socket may be closed once the call is done
+	def call(self,method,*args):
+		if (threading.current_thread() is self.thread):
+			method(*args);
+		else:
+			self.loop.call_soon_threadsafe(method,*args);
+	
+	def on_socket_open(self,client,userdata,sock):
+		self.call(self.loop.add_reader,sock.fileno(),client.loop_read);
+		
+	def on_socket_close(self,client,userdata,sock):
+		self.call(self.loop.remove_reader,sock.fileno());
+		
+	def on_socket_register_write(self,client,userdata,sock):
+		self.call(self.loop.add_writer,sock.fileno(),client.loop_write);
 		
+	def on_socket_unregister_write(self,client,userdata,sock):
+		self.call(self.loop.remove_writer,sock.fileno());
+	
+	#paho housekeeping, broker connexion is opened again when lost
+	#name resolution and TCP connexion are blocking, they are run in an executor so that modbus loops are not stalled
+	async def misc(self):
+		while True:
+			if (self.client.loop_misc()==mqtt.MQTT_ERR_NO_CONN):
+				try:
+					await self.loop.run_in_executor(None,self.client.reconnect);
+				except Exception as exc:
+					self.logger.warning('MQTT broker connexion error: '+repr(exc));
+					await asyncio.sleep(self.RECONNECT_DELAY);
+			await asyncio.sleep(self.MISC_PERIOD);
+
+#run MQTT client and modbus loops on a single asyncio event loop, returns when one of the modbus loops is over
+async def asyncioLoop(panels,client):
+	mqttLoop=AsyncioMqttLoop(asyncio.get_event_loop(),client);
+	miscTask=asyncio.ensure_future(mqttLoop.misc());
+	panelTasks=[asyncio.ensure_future(panel.loopAsync()) for panel in panels];
+	try:
+		await asyncio.wait(panelTasks,return_when=asyncio.FIRST_COMPLETED);
+	finally:
+		for task in panelTasks:
+			task.cancel();
+		miscTask.cancel();
+	
+#formatting of attribute values into MQTT payloads
+def floatValue(parameter):
+	return (f"{parameter:.1f}" if parameter is not None else '');
+def intValue(parameter):
+	return (f"{parameter:d}" if parameter is not None else '');
+def textValue(parameter):
+	return (parameter if parameter is not None else '');
+def dateValue(parameter):
+	return (parameter.isoformat() if parameter is not None else '');
+def jsonValue(parameter):
+	return (json.dumps(parameter) if parameter is not None else '');
+def statusValue(parameter):
+	return (ONLINE if parameter else OFFLINE);
+
+#panels of all boilers, each panel has its own topicPrefix, MQTT message buffer and HomeAssistant discovery instance
+panels=list();
+
+#published topics with their attribute and formatting
+PUBLISH_TABLE=(
 	#boiler
-	buffer.update('status',ONLINE if self.availability else OFFLINE);
-	buffer.update('date',self.datetime.isoformat() if self.datetime is not None else '');
-	buffer.update('lastTimeSync',self.lastTimeSync.isoformat() if self.lastTimeSync is not None else '');
-	buffer.update('type',intValue(self.type));
-	buffer.update('ctrl',intValue(self.release));
-	buffer.update('ext/temp',floatValue(self.extTemp));
-	buffer.update('temp',floatValue(self.temp));
-	buffer.update('targetTemp',floatValue(self.targetTemp));
-	buffer.update('returnTemp',floatValue(self.returnTemp));
-	buffer.update('waterPressure',floatValue(self.waterPressure));
-	buffer.update('power',intValue(self.burnerPower));
-	buffer.update('smokeTemp',floatValue(self.smokeTemp));
-	buffer.update('ionizationCurrent',floatValue(self.ionizationCurrent));
-	buffer.update('fanSpeed',intValue(self.fanSpeed));
-	buffer.update('burnerStatus',intValue(self.burnerStatus));
-	buffer.update('pumpPower',intValue(self.pumpPower));
-	buffer.update('alarm',json.dumps(self.alarm) if self.alarm is not None else '');
+	('status','availability',statusValue),
+	('date','datetime',dateValue),
+	('lastTimeSync','lastTimeSync',dateValue),
+	('type','type',intValue),
+	('ctrl','release',intValue),
+	('ext/temp','extTemp',floatValue),
+	('temp','temp',floatValue),
+	('targetTemp','targetTemp',floatValue),
+	('returnTemp','returnTemp',floatValue),
+	('waterPressure','waterPressure',floatValue),
+	('power','burnerPower',intValue),
+	('smokeTemp','smokeTemp',floatValue),
+	('ionizationCurrent','ionizationCurrent',floatValue),
+	('fanSpeed','fanSpeed',intValue),
+	('burnerStatus','burnerStatus',intValue),
+	('pumpPower','pumpPower',intValue),
+	('alarm','alarm',jsonValue),
 	
 	#hotwater
-	buffer.update('hotWater/pump',intValue(self.hotWaterPump));
-	buffer.update('hotWater/temp',floatValue(self.hotWaterTemp));
-	buffer.update('hotWater/mode',self.hotWaterMode if self.hotWaterMode is not None else '');
-	buffer.update('hotWater/dayTemp',floatValue(self.hotWaterDayTargetTemp));
-	buffer.update('hotWater/nightTemp',floatValue(self.hotWaterNightTargetTemp));
+	('hotWater/pump','hotWaterPump',intValue),
+	('hotWater/temp','hotWaterTemp',floatValue),
+	('hotWater/mode','hotWaterMode',textValue),
+	('hotWater/dayTemp','hotWaterDayTargetTemp',floatValue),
+	('hotWater/nightTemp','hotWaterNightTargetTemp',floatValue),
 	
 	#area A
-	buffer.update('zoneA/temp',floatValue(self.zoneATemp));
-	buffer.update('zoneA/mode',self.zoneAMode if self.zoneAMode is not None else '');
-	buffer.update('zoneA/pump',intValue(self.zoneAPump));
-	buffer.update('zoneA/dayTemp',floatValue(self.zoneADayTargetTemp));
-	buffer.update('zoneA/nightTemp',floatValue(self.zoneANightTargetTemp));
-	buffer.update('zoneA/antiiceTemp',floatValue(self.zoneAAntiiceTargetTemp));
+	('zoneA/temp','zoneATemp',floatValue),
+	('zoneA/mode','zoneAMode',textValue),
+	('zoneA/pump','zoneAPump',intValue),
+	('zoneA/dayTemp','zoneADayTargetTemp',floatValue),
+	('zoneA/nightTemp','zoneANightTargetTemp',floatValue),
+	('zoneA/antiiceTemp','zoneAAntiiceTargetTemp',floatValue),
 
 	#area B
-	buffer.update('zoneB/temp',floatValue(self.zoneBTemp));
-	buffer.update('zoneB/mode',self.zoneBMode if self.zoneBMode is not None else '');
-	buffer.update('zoneB/pump',intValue(self.zoneBPump));
-	buffer.update('zoneB/dayTemp',floatValue(self.zoneBDayTargetTemp));
-	buffer.update('zoneB/nightTemp',floatValue(self.zoneBNightTargetTemp));
-	buffer.update('zoneB/antiiceTemp',floatValue(self.zoneBAntiiceTargetTemp));
+	('zoneB/temp','zoneBTemp',floatValue),
+	('zoneB/mode','zoneBMode',textValue),
+	('zoneB/pump','zoneBPump',intValue),
+	('zoneB/dayTemp','zoneBDayTargetTemp',floatValue),
+	('zoneB/nightTemp','zoneBNightTargetTemp',floatValue),
+	('zoneB/antiiceTemp','zoneBAntiiceTargetTemp',floatValue),
+);
+
+#changed is the set of changed attributes, None means all attributes
+def diematicPublish(self,changed=None):
+	#all topics are updated after a buffer clear
+	if (not self.buffer.complete):
+		changed=None;
+		self.buffer.complete=True;
+	ttlEnabled=self.ttlEnabled();
+	for topic,attribute,format in PUBLISH_TABLE:
+		if ((changed is None) or (attribute in changed)):
+			self.buffer.update(topic,format(getattr(self,attribute)));
+			#availability of attributes expiring with a TTL, an expired value is published empty
+			if (ttlEnabled and (attribute!='availability')):
+				self.buffer.update(topic+'/'+AVAILABILITY_TOPIC,statusValue(self.attributeAvailable(attribute)));
 	
 	#send MQTT messages
-	buffer.send();
+	self.buffer.send();
 
 def haSendDiscoveryMessages(client, userdata, message):
 	if (message.payload.decode()=='online'):
-		logger.info('Sending HA discovery messages');
-		
-		#boiler
-		hassio.addSensor('heater_datetime',"Horloge Chaudière",None,'date',"{{ as_timestamp(value) |timestamp_custom ('%d/%m/%Y %H:%M') }}",None);
-		hassio.addSwitch('heater_datetime_set',"Synchro Horloge",'unknown','date/set','--','Now');
-		hassio.addSensor('type',"Type",None,'type',None,None);
-		hassio.addSensor('ctrl',"Controleur",None,'ctrl',None,None);
-		hassio.addSensor('ext_temp',"Température Extérieure",'temperature','ext/temp',None,"°C");
-		hassio.addSensor('boiler_temp',"Température Chaudière",'temperature','temp',None,"°C");	
-		hassio.addSensor('target_temp',"Température Cible",'temperature','targetTemp',None,"°C");
-		hassio.addSensor('return_temp',"Température Retour",'temperature','returnTemp',None,"°C");
-		hassio.addSensor('water_pressure',"Pression d'eau",'pressure','waterPressure',None,"bar");
-		hassio.addSensor('power',"Puissance",'power_factor','power',None,"%");
-		hassio.addSensor('smoke_temp',"Température Fumées",'temperature','smokeTemp',None,"°C");
-		hassio.addSensor('ionization_current',"Courant Ionisation",'current','ionizationCurrent',None,"µA");	
-		hassio.addSensor('fan_speed',"Vitesse Ventilateur",None,'fanSpeed',None,"RPM");	
-		hassio.addBinarySensor('burner_status',"Etat Bruleur",None,'burnerStatus',"1","0");	
-		hassio.addSensor('pump_power',"Puissance Pompe",'power_factor','pumpPower',None,"%");
-		hassio.addSensor('alarm',"Etat",None,'alarm',"{{ value_json.txt}}",None);
-		hassio.addSensor('alarm_id',"N° Erreur",None,'alarm',"{{ value_json.id}}",None);
-		
-		#hot water
-		hassio.addBinarySensor('hot_water_pump',"Pompe ECS",None,'hotWater/pump',"1","0");	
-		hassio.addSensor('hot_water_temp',"Température ECS",'temperature','hotWater/temp',None,"°C");
-		hassio.addSelect('hot_water_mode',"Mode ECS",'hotWater/mode','hotWater/mode/set',['AUTO','TEMP','PERM']);
-		hassio.addSensor('hot_water_mode',"Mode ECS",None,'hotWater/mode',None,None);
-		hassio.addNumber('hot_water_temp_day',"Température ECS Jour",'hotWater/dayTemp','hotWater/dayTemp/set',10,80,5,"°C");
-		hassio.addNumber('hot_water_temp_night',"Température ECS Nuit",'hotWater/nightTemp','hotWater/nightTemp/set',10,80,5,"°C");
-		
-		#area A
-		hassio.addSensor('zone_A_temp',"Température Zone A",'temperature','zoneA/temp',None,"°C");
-		hassio.addSelect('zone_A_mode',"Mode Zone A",'zoneA/mode','zoneA/mode/set',['AUTO','TEMP JOUR','PERM JOUR','TEMP NUIT','PERM NUIT','ANTIGEL']);
-		hassio.addSensor('zone_A_mode',"Mode Zone A",None,'zoneA/mode',None,None);
-		hassio.addBinarySensor('zone_A_pump',"Pompe Zone A",None,'zoneA/pump',"1","0");
-		hassio.addNumber('zone_A_temp_day',"Température Jour Zone A",'zoneA/dayTemp','zoneA/dayTemp/set',5,30,0.5,"°C");
-		hassio.addNumber('zone_A_temp_night',"Température Nuit Zone A",'zoneA/nightTemp','zoneA/nightTemp/set',5,30,0.5,"°C");
-		hassio.addNumber('zone_A_temp_antiice',"Température Antigel Zone A",'zoneA/antiiceTemp','zoneA/antiiceTemp/set',5,20,0.5,"°C");
-		
-		#area B
-		hassio.addSensor('zone_B_temp',"Température Zone B",'temperature','zoneB/temp',None,"°C");
-		hassio.addSelect('zone_B_mode',"Mode Zone B",'zoneB/mode','zoneB/mode/set',['AUTO','TEMP JOUR','PERM JOUR','TEMP NUIT','PERM NUIT','ANTIGEL']);
-		hassio.addSensor('zone_B_mode',"Mode Zone B",None,'zoneB/mode',None,None);
-		hassio.addBinarySensor('zone_B_pump',"Pompe Zone B",None,'zoneB/pump',"1","0");
-		hassio.addNumber('zone_B_temp_day',"Température Jour Zone B",'zoneB/dayTemp','zoneB/dayTemp/set',5,30,0.5,"°C");
-		hassio.addNumber('zone_B_temp_night',"Température Nuit Zone B",'zoneB/nightTemp','zoneB/nightTemp/set',5,30,0.5,"°C");
-		hassio.addNumber('zone_B_temp_antiice',"Température Antigel Zone B",'zoneB/antiiceTemp','zoneB/antiiceTemp/set',5,20,0.5,"°C");		
-		
+		#discovery messages are retained, only the ones missing or changed on the broker are sent unless republishOnline is set
+		discoverySender.send(hassioRepublish);
+
+#discovery messages of one boiler, built once at startup
+def haBoilerDiscoveryMessages(hassio):
+	#boiler
+	hassio.addSensor('heater_datetime',"Horloge Chaudière",None,'date',"{{ as_timestamp(value) |timestamp_custom ('%d/%m/%Y %H:%M') }}",None);
+	hassio.addSwitch('heater_datetime_set',"Synchro Horloge",'unknown','date/set','--','Now');
+	hassio.addSensor('type',"Type",None,'type',None,None);
+	hassio.addSensor('ctrl',"Controleur",None,'ctrl',None,None);
+	hassio.addSensor('ext_temp',"Température Extérieure",'temperature','ext/temp',None,"°C");
+	hassio.addSensor('boiler_temp',"Température Chaudière",'temperature','temp',None,"°C");	
+	hassio.addSensor('target_temp',"Température Cible",'temperature','targetTemp',None,"°C");
+	hassio.addSensor('return_temp',"Température Retour",'temperature','returnTemp',None,"°C");
+	hassio.addSensor('water_pressure',"Pression d'eau",'pressure','waterPressure',None,"bar");
+	hassio.addSensor('power',"Puissance",'power_factor','power',None,"%");
+	hassio.addSensor('smoke_temp',"Température Fumées",'temperature','smokeTemp',None,"°C");
+	hassio.addSensor('ionization_current',"Courant Ionisation",'current','ionizationCurrent',None,"µA");	
+	hassio.addSensor('fan_speed',"Vitesse Ventilateur",None,'fanSpeed',None,"RPM");	
+	hassio.addBinarySensor('burner_status',"Etat Bruleur",None,'burnerStatus',"1","0");	
+	hassio.addSensor('pump_power',"Puissance Pompe",'power_factor','pumpPower',None,"%");
+	hassio.addSensor('alarm',"Etat",None,'alarm',"{{ value_json.txt}}",None);
+	hassio.addSensor('alarm_id',"N° Erreur",None,'alarm',"{{ value_json.id}}",None);
+	
+	#hot water
+	hassio.addBinarySensor('hot_water_pump',"Pompe ECS",None,'hotWater/pump',"1","0");	
+	hassio.addSensor('hot_water_temp',"Température ECS",'temperature','hotWater/temp',None,"°C");
+	hassio.addSelect('hot_water_mode',"Mode ECS",'hotWater/mode','hotWater/mode/set',['AUTO','TEMP','PERM']);
+	hassio.addSensor('hot_water_mode',"Mode ECS",None,'hotWater/mode',None,None);
+	hassio.addNumber('hot_water_temp_day',"Température ECS Jour",'hotWater/dayTemp','hotWater/dayTemp/set',10,80,5,"°C");
+	hassio.addNumber('hot_water_temp_night',"Température ECS Nuit",'hotWater/nightTemp','hotWater/nightTemp/set',10,80,5,"°C");
+	
+	#area A
+	hassio.addSensor('zone_A_temp',"Température Zone A",'temperature','zoneA/temp',None,"°C");
+	hassio.addSelect('zone_A_mode',"Mode Zone A",'zoneA/mode','zoneA/mode/set',['AUTO','TEMP JOUR','PERM JOUR','TEMP NUIT','PERM NUIT','ANTIGEL']);
+	hassio.addSensor('zone_A_mode',"Mode Zone A",None,'zoneA/mode',None,None);
+	hassio.addBinarySensor('zone_A_pump',"Pompe Zone A",None,'zoneA/pump',"1","0");
+	hassio.addNumber('zone_A_temp_day',"Température Jour Zone A",'zoneA/dayTemp','zoneA/dayTemp/set',5,30,0.5,"°C");
+	hassio.addNumber('zone_A_temp_night',"Température Nuit Zone A",'zoneA/nightTemp','zoneA/nightTemp/set',5,30,0.5,"°C");
+	hassio.addNumber('zone_A_temp_antiice',"Température Antigel Zone A",'zoneA/antiiceTemp','zoneA/antiiceTemp/set',5,20,0.5,"°C");
+	
+	#area B
+	hassio.addSensor('zone_B_temp',"Température Zone B",'temperature','zoneB/temp',None,"°C");
+	hassio.addSelect('zone_B_mode',"Mode Zone B",'zoneB/mode','zoneB/mode/set',['AUTO','TEMP JOUR','PERM JOUR','TEMP NUIT','PERM NUIT','ANTIGEL']);
+	hassio.addSensor('zone_B_mode',"Mode Zone B",None,'zoneB/mode',None,None);
+	hassio.addBinarySensor('zone_B_pump',"Pompe Zone B",None,'zoneB/pump',"1","0");
+	hassio.addNumber('zone_B_temp_day',"Température Jour Zone B",'zoneB/dayTemp','zoneB/dayTemp/set',5,30,0.5,"°C");
+	hassio.addNumber('zone_B_temp_night',"Température Nuit Zone B",'zoneB/nightTemp','zoneB/nightTemp/set',5,30,0.5,"°C");
+	hassio.addNumber('zone_B_temp_antiice',"Température Antigel Zone B",'zoneB/antiiceTemp','zoneB/antiiceTemp/set',5,20,0.5,"°C");		
+	
 	
 def on_connect(client, userdata, flags, reason_code, properties=None):
 	client.brokerConnected=True;
 	logger.critical('Connected to MQTT broker');
 	#subscribe to control messages with Q0s of 2
-	client.subscribe(mqttTopicPrefix+'/+/+/set',2);
-	client.subscribe(mqttTopicPrefix+'/date/set',2);
+	for panel in panels:
+		client.subscribe(panel.topicPrefix+'/+/+/set',2);
+		client.subscribe(panel.topicPrefix+'/date/set',2);
+	client.subscribe(mqttTopicPrefix+'/trace/get',2);
+	if (bridgeStatusTopic is not None):
+		client.publish(bridgeStatusTopic,ONLINE,1,True);
 	if hassioDiscoveryEnable:
 		client.subscribe(hassioDiscoveryPrefix+'/status',2);
-	#clear buffer and inform client that status is still Offline
-	buffer.clear();
-	buffer.update('status','Offline');
-	buffer.send();
+		#discovery messages are compared with the ones kept by the broker
+		discoverySender.connected();
+	#clear buffers and inform client that status is still Offline
+	for panel in panels:
+		panel.buffer.clear();
+		panel.buffer.update('status','Offline');
+		panel.buffer.send();
 
 	
 	
@@ -172,14 +392,14 @@ def on_disconnect(client, userdata, flags, reason_code, properties=None):
 	client.brokerConnected=False;
 	logger.critical('Diconnected from MQTT broker');
 	
-def modeSet(client, userdata, message):
+def modeSet(panel, message):
 	#table for topic to attribute bind
 	table={'/hotWater/mode/set':'hotWaterMode',
 		'/zoneA/mode/set':'zoneAMode',
 		'/zoneB/mode/set':'zoneBMode'};
 		
 	#remove root of the topic
-	shortTopic=message.topic[len(mqttTopicPrefix):]
+	shortTopic=message.topic[len(panel.topicPrefix):]
 	
 	#if topic exist
 	if shortTopic in table:
@@ -189,7 +409,7 @@ def modeSet(client, userdata, message):
 	else:
 		logger.warning('Unknown topic : '+shortTopic);
 
-def tempSet(client, userdata, message):	
+def tempSet(panel, message):	
 	#table for topic to attribute bind
 	table={'/hotWater/dayTemp/set':'hotWaterDayTargetTemp',
 		'/hotWater/nightTemp/set':'hotWaterNightTargetTemp',
@@ -201,7 +421,7 @@ def tempSet(client, userdata, message):
 		'/zoneB/antiiceTemp/set':'zoneBAntiiceTargetTemp'};
 		
 	#remove root of the topic
-	shortTopic=message.topic[len(mqttTopicPrefix):]
+	shortTopic=message.topic[len(panel.topicPrefix):]
 	
 	try:
 		value=float(message.payload);
@@ -217,12 +437,12 @@ def tempSet(client, userdata, message):
 	else:
 		logger.warning('Unknown topic : '+shortTopic);
 
-def dateSet(client, userdata, message):
+def dateSet(panel, message):
 	#table for topic to attribute bind
 	table={'/date/set':'datetime'};
 		
 	#remove root of the topic
-	shortTopic=message.topic[len(mqttTopicPrefix):]
+	shortTopic=message.topic[len(panel.topicPrefix):]
 	
 	#if topic exist
 	if shortTopic in table:
@@ -233,15 +453,24 @@ def dateSet(client, userdata, message):
 	else:
 		logger.warning('Unknown topic : '+shortTopic);
 
+#panel of a command topic, the longest matching topic prefix is used
+def topicPanel(topic):
+	matching=[panel for panel in panels if topic.startswith(panel.topicPrefix+'/')];
+	return max(matching,key=lambda panel:len(panel.topicPrefix)) if matching else None;
+
 def paramSet(client, userdata, message):
 	try:
 		logger.debug('MQTT msg received :'+message.topic+' '+str(message.payload));
+		panel=topicPanel(message.topic);
+		if (panel is None):
+			logger.warning('Unknown topic : '+message.topic);
+			return;
 		if (message.topic[-8:]=='Temp/set'):
-			tempSet(client, userdata, message);
+			tempSet(panel, message);
 		elif (message.topic[-8:]=='mode/set'):
-			modeSet(client, userdata, message);
+			modeSet(panel, message);
 		elif (message.topic[-8:]=='date/set'):
-			dateSet(client, userdata, message);
+			dateSet(panel, message);
 	except BaseException as exc:	
 		logger.exception(exc);
 
@@ -249,6 +478,17 @@ def sigterm_exit(signum, frame):
 		logger.critical('Stop requested by SIGTERM, raising KeyboardInterrupt');
 		raise KeyboardInterrupt;
 
+#Modbus frame trace is written in log on SIGUSR1
+def sigusr1_traceDump(signum, frame):
+	logger.critical('Modbus frame trace:\n'+'\n'.join(DDModbus.TRACE.dump()));
+
+#Modbus frame trace is published as a JSON list of lines on <topicPrefix>/trace when <topicPrefix>/trace/get is received
+def traceDump(client, userdata, message):
+	try:
+		client.publish(mqttTopicPrefix+'/trace',json.dumps(DDModbus.TRACE.dump()),qos=0,retain=False);
+	except BaseException as exc:	
+		logger.exception(exc);
+
 
 if __name__ == '__main__':
 
@@ -258,28 +498,29 @@ if __name__ == '__main__':
 	
 	#Sigterm trapping
 	signal.signal(signal.SIGTERM, sigterm_exit);
+	if hasattr(signal,'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, sigusr1_traceDump);
 	try:
 		#Initialisation config
 		config = configparser.ConfigParser()
 		config.read('./conf/Diematic32MQTT.conf')
 
-		#Modbus settings
-		modbusAddress=config.get('Modbus','ip');
-		modbusPort=config.get('Modbus','port');
-		modbusRegulatorAddress=int(config.get('Modbus','regulatorAddress'),0);
-		modbusInterfaceAddress=int(config.get('Modbus','interfaceAddress',fallback='0'),0);
-		logger.critical('Modbus interface address: '+modbusAddress+' : '+modbusPort);
-		logger.critical('Modbus regulator address: '+ hex(modbusRegulatorAddress));
+		#Modbus settings shared by all boilers
+		modbusAsyncio=config.getboolean('Modbus','asyncio',fallback=False);
 		
-		#regulator type
-		regulatorType=config.get('Boiler','regulatorType',fallback='Diematic3');
+		#optional capture of the bytes exchanged with gateways, replayed by tools/replay.py
+		captureDirectory=config.get('Modbus','capture',fallback='');
+		if captureDirectory:
+			DDModbus.setCapture(captureDirectory,int(config.getfloat('Modbus','captureMaxSize',fallback=0)*1000000));
 		
-		#boiler time timezone and automatic time synchro
-		boilerTimezone=config.get('Boiler','timezone');
-		boilerTimeSync=config.get('Boiler','timeSync');
+		#number of frame events kept in memory, dumped on SIGUSR1 or MQTT request
+		DDModbus.TRACE.resize(config.getint('Modbus','traceSize',fallback=DDModbus.FrameTrace.SIZE));
 		
-		#refresh period
-		period=int(config.get('Boiler','period'),0);
+		#optional metrics endpoint
+		metricsEnable=config.getboolean('Metrics','enable',fallback=False);
+		
+		#optional history recorder, files of a boiler are saved in a sub directory named by boiler id
+		historyEnable=config.getboolean('History','enable',fallback=False);
 		
 		#MQTT settings
 		mqttBrokerHost=config.get('MQTT','brokerHost');
@@ -292,6 +533,14 @@ if __name__ == '__main__':
 		
 		logger.critical('Broker: '+mqttBrokerHost+' : '+mqttBrokerPort);
 		logger.critical('Topic Root: '+mqttTopicPrefix);	
+		#bridge availability, set Offline by the last will, boilers are only available with the bridge
+		#a single boiler without [Boiler:<id>] section keeps the last will on its status topic, which covers the bridge
+		if any(section.startswith('Boiler:') for section in config.sections()):
+			bridgeStatusTopic=mqttTopicPrefix+'/bridge/status';
+			willTopic=bridgeStatusTopic;
+		else:
+			bridgeStatusTopic=None;
+			willTopic=mqttTopicPrefix+'/status';
 		
 		#Home Assistant discovery settings
 		hassioDiscoveryEnable=config.getboolean('Home Assistant','MQTT_DiscoveryEnable');
@@ -300,28 +549,6 @@ if __name__ == '__main__':
 		logger.critical('Hassio Discovery Enable: '+ str(hassioDiscoveryEnable));
 		logger.critical('Hassio Discovery Prefix: '+ hassioDiscoveryPrefix);
 		
-
-		#init panel
-		if (regulatorType=='DiematicDelta'):
-			logger.critical('Regulator type is Diematic Delta');
-			DiematicDeltaPanel.DiematicDeltaPanel.updateCallback=diematicPublish;
-			panel=DiematicDeltaPanel.DiematicDeltaPanel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
-		elif (regulatorType=='Diematic4'):
-			logger.critical('Regulator type is Diematic4');
-			Diematic4Panel.Diematic4Panel.updateCallback=diematicPublish;
-			panel=Diematic4Panel.Diematic4Panel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
-		else:
-			logger.critical('Regulator type is Diematic3');
-			Diematic3Panel.Diematic3Panel.updateCallback=diematicPublish;
-			panel=Diematic3Panel.Diematic3Panel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
-		
-		#set refresh period, with a minimum of 10s
-		panel.refreshPeriod=max(period,10);
-		
-		#force circuit A or B to be enables if requested
-		panel.forceCircuitA=config.getboolean('Boiler','enable_circuit_A',fallback=False);
-		panel.forceCircuitB=config.getboolean('Boiler','enable_circuit_B',fallback=False);
-
 		#init mqtt brooker
 		if 'CallbackAPIVersion' in dir(mqtt):
 			logger.debug('Paho MQTT version 2.XX or more detected, using callback API version2');
@@ -334,43 +561,208 @@ if __name__ == '__main__':
 		client.on_disconnect = on_disconnect
 		client.username_pw_set(mqttBrokerLogin,mqttBrokerPassword)
 		#last will
-		client.will_set(mqttTopicPrefix+'/status',"Offline",1,True)
+		client.will_set(willTopic,OFFLINE,1,True)
 		client.connect_async(mqttBrokerHost, int(mqttBrokerPort))
-		client.message_callback_add(mqttTopicPrefix+'/+/+/set',paramSet)
-		client.message_callback_add(mqttTopicPrefix+'/date/set',paramSet)
+		client.message_callback_add(mqttTopicPrefix+'/trace/get',traceDump)
 		if hassioDiscoveryEnable:
 			client.message_callback_add(hassioDiscoveryPrefix+'/status',haSendDiscoveryMessages)
 		
-		#create HomeAssistant discovery instance
-
-		hassio=Hassio.Hassio(client,mqttTopicPrefix,mqttClientId,hassioDiscoveryPrefix);
-		hassio.availabilityInfo('status',ONLINE,OFFLINE);
-		hassio.setDevice("De Dietrich",regulatorType,mqttClientId)
-	
-		#create mqtt message buffer
-		buffer=MessageBuffer(client);
+		#retained discovery messages, sent by a specific thread at a limited rate
+		hassioRepublish=config.getboolean('Home Assistant','republishOnline',fallback=False);
+		#single device discovery message by boiler instead of one message by entity
+		hassioDeviceDiscovery=config.getboolean('Home Assistant','deviceDiscovery',fallback=False);
+		discoverySender=Hassio.DiscoverySender(client,config.getfloat('Home Assistant','discoveryRate',fallback=5),mqttTopicPrefix);
+		
+		#mqtt message buffer publication settings, shared by all boilers
+		deadbands=dict();
+		if config.has_section('Publish Deadband'):
+			for topic,deadband in config.items('Publish Deadband'):
+				try:
+					deadband=deadband.strip();
+					deadbands[topic.lower()]=(float(deadband.rstrip('%')),deadband.endswith('%'));
+				except ValueError:
+					logger.warning('Deadband error : '+topic+' : '+deadband);
+		publishMode=config.get('MQTT','publishMode',fallback=PUBLISH_TOPICS);
+		if (publishMode not in (PUBLISH_TOPICS,PUBLISH_AGGREGATED,PUBLISH_BOTH)):
+			logger.warning('Unknown publish mode : '+publishMode);
+			publishMode=PUBLISH_TOPICS;
+		#HA discovery entities are subscribed to attribute topics
+		if ((publishMode==PUBLISH_AGGREGATED) and hassioDiscoveryEnable):
+			logger.warning('Publish mode aggregated is not compatible with HA discovery, publish mode both is used');
+			publishMode=PUBLISH_BOTH;
+		stateFormat=config.get('MQTT','stateFormat',fallback='json');
+		if ((stateFormat=='msgpack') and (msgpack is None)):
+			logger.warning('msgpack module not found, state topic is published in json');
+		logger.critical('Publish mode: '+publishMode);
+		
+		#one panel per [Boiler:<id>] section, [Modbus] and [Boiler] sections are used as default settings
+		#without [Boiler:<id>] section, a single boiler is defined by [Modbus] and [Boiler] sections
+		boilerSections=[section for section in config.sections() if section.startswith('Boiler:')];
+		if (not boilerSections):
+			boilerSections=['Boiler'];
+		#boiler ids by gateway ip:port
+		gateways=dict();
+		for section in boilerSections:
+			boilerId=section[len('Boiler:'):] if (section!='Boiler') else mqttClientId;
+			settings=configparser.ConfigParser(interpolation=None);
+			settings.read_dict({'Boiler':{option:value for defaultSection in ('Modbus','Boiler',section) if config.has_section(defaultSection) for option,value in config.items(defaultSection)}});
+			
+			#Modbus settings
+			modbusAddress=settings.get('Boiler','ip');
+			modbusPort=settings.get('Boiler','port');
+			modbusRegulatorAddress=int(settings.get('Boiler','regulatorAddress'),0);
+			modbusInterfaceAddress=int(settings.get('Boiler','interfaceAddress',fallback='0'),0);
+			logger.critical('Boiler: '+boilerId);
+			logger.critical('Modbus interface address: '+modbusAddress+' : '+modbusPort);
+			logger.critical('Modbus regulator address: '+ hex(modbusRegulatorAddress));
+			gateways.setdefault(modbusAddress+':'+modbusPort,list()).append(boilerId);
+			
+			#regulator type
+			regulatorType=settings.get('Boiler','regulatorType',fallback='Diematic3');
+			
+			#boiler time timezone and automatic time synchro
+			boilerTimezone=settings.get('Boiler','timezone');
+			boilerTimeSync=settings.get('Boiler','timeSync');
+			
+			#refresh period
+			period=int(settings.get('Boiler','period'),0);
+			
+			#topic root of the boiler, clientId and topicPrefix of the boiler section override MQTT ones
+			boilerClientId=config.get(section,'clientId',fallback=boilerId);
+			boilerTopicPrefix=config.get(section,'topicPrefix',fallback=config.get('MQTT','topicPrefix'))+'/'+boilerClientId;
+			logger.critical('Boiler Topic Root: '+boilerTopicPrefix);
+
+			#init panel
+			if (regulatorType=='DiematicDelta'):
+				logger.critical('Regulator type is Diematic Delta');
+				DiematicDeltaPanel.DiematicDeltaPanel.updateCallback=diematicPublish;
+				panel=DiematicDeltaPanel.DiematicDeltaPanel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
+			elif (regulatorType=='Diematic4'):
+				logger.critical('Regulator type is Diematic4');
+				Diematic4Panel.Diematic4Panel.updateCallback=diematicPublish;
+				panel=Diematic4Panel.Diematic4Panel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
+			else:
+				logger.critical('Regulator type is Diematic3');
+				Diematic3Panel.Diematic3Panel.updateCallback=diematicPublish;
+				panel=Diematic3Panel.Diematic3Panel(modbusAddress,int(modbusPort),modbusRegulatorAddress,modbusInterfaceAddress,boilerTimezone,boilerTimeSync);
+				panel.setBusWindow(settings.getfloat('Boiler','busPhaseGap',fallback=Diematic3Panel.BusWindowScheduler.PHASE_GAP),settings.getfloat('Boiler','busSwitchDelay',fallback=Diematic3Panel.BusWindowScheduler.SWITCH_DELAY));
+			panel.boilerId=boilerId;
+			panel.topicPrefix=boilerTopicPrefix;
+			panel.registerMetrics();
+			
+			#set refresh period, with a minimum of 10s
+			panel.refreshPeriod=max(period,10);
+			
+			#force circuit A or B to be enables if requested
+			panel.forceCircuitA=settings.getboolean('Boiler','enable_circuit_A',fallback=False);
+			panel.forceCircuitB=settings.getboolean('Boiler','enable_circuit_B',fallback=False);
+			
+			#merge register values observed on the bus, always done by DiematicDelta
+			panel.snooping=settings.getboolean('Boiler','snooping',fallback=False);
+			
+			#register polling tiers, [Polling:<id>] section is used in addition of [Polling] one
+			pollTiers=dict();
+			for pollingSection in ('Polling','Polling:'+boilerId):
+				if config.has_section(pollingSection):
+					for register,tier in config.items(pollingSection):
+						try:
+							address=Diematic.DDREGISTER[register.upper()].value if (register.upper() in Diematic.DDREGISTER.__members__) else int(register,0);
+							pollTiers[address]=Diematic.POLLTIER[tier.strip().upper()];
+						except (KeyError,ValueError):
+							logger.warning('Polling tier error : '+register+' : '+tier);
+			panel.setPolling(max(settings.getint('Boiler','fastPeriod',fallback=period),10),max(settings.getint('Boiler','slowPeriod',fallback=period),10),pollTiers);
+			
+			#attribute TTL, [TTL:<id>] section is used in addition of [TTL] one
+			ttls=dict();
+			for ttlSection in ('TTL','TTL:'+boilerId):
+				if config.has_section(ttlSection):
+					for attribute,ttl in config.items(ttlSection):
+						#option names are lower case
+						codec=next((codec for codec in Diematic.CODECS if (codec.attribute.lower()==attribute)),None);
+						try:
+							ttls[codec.attribute]=float(ttl);
+						except (AttributeError,ValueError):
+							logger.warning('TTL error : '+attribute+' : '+ttl);
+			panel.setTtl(settings.getint('Boiler','ttlPeriods',fallback=Diematic.Diematic.TTL_PERIODS),ttls);
+			
+			#register read planning
+			extraRegisters=[int(reg,0) for reg in settings.get('Boiler','extraRegisters',fallback='').split(',') if reg.strip()!=''];
+			panel.setReadPlanning(settings.getint('Boiler','readBlockSize',fallback=64),settings.getint('Boiler','readGapTolerance',fallback=16),extraRegisters);
+			
+			#attribute history
+			if historyEnable:
+				panel.history=History.HistoryRecorder(os.path.join(config.get('History','path',fallback='history'),boilerId),config.getfloat('History','interval',fallback=10),config.getfloat('History','rawWindow',fallback=7*86400),config.getfloat('History','bucket',fallback=900));
+			
+			#command topics of the boiler
+			client.message_callback_add(boilerTopicPrefix+'/+/+/set',paramSet)
+			client.message_callback_add(boilerTopicPrefix+'/date/set',paramSet)
+			
+			#create HomeAssistant discovery instance
+			panel.hassio=Hassio.Hassio(client,boilerTopicPrefix,boilerClientId,hassioDiscoveryPrefix,discoverySender if hassioDiscoveryEnable else None,hassioDeviceDiscovery);
+			panel.hassio.availabilityInfo('status',ONLINE,OFFLINE);
+			if (bridgeStatusTopic is not None):
+				panel.hassio.addAvailability(bridgeStatusTopic,ONLINE,OFFLINE);
+			if panel.ttlEnabled():
+				panel.hassio.attributeAvailability(AVAILABILITY_TOPIC,{topic for topic,attribute,format in PUBLISH_TABLE if (attribute!='availability')},ONLINE,OFFLINE);
+			panel.hassio.setDevice("De Dietrich",regulatorType,boilerClientId)
+			if hassioDiscoveryEnable:
+				haBoilerDiscoveryMessages(panel.hassio);
+			
+			#create mqtt message buffer
+			panel.buffer=MessageBuffer(client,boilerTopicPrefix,config.getfloat('Publish','minInterval',fallback=0),config.getfloat('Publish','maxInterval',fallback=0),deadbands,publishMode,config.get('MQTT','stateTopic',fallback='state'),stateFormat);
+			panels.append(panel);
+		
+		#boilers on the same bus share one gateway connection, which is only possible on a single event loop
+		#concurrent connections would interleave their frames on the bus
+		sharedGateways=[gateway for gateway,boilerIds in gateways.items() if (len(boilerIds) > 1)];
+		if (sharedGateways and not modbusAsyncio):
+			logger.warning('Gateways shared by several boilers: '+', '.join(gateway+' ('+', '.join(gateways[gateway])+')' for gateway in sharedGateways)+', asyncio mode is used');
+			modbusAsyncio=True;
+		
+		#launch metrics endpoint
+		if metricsEnable:
+			metricsServer=Metrics.startServer(config.getint('Metrics','port',fallback=9100),config.get('Metrics','address',fallback=''));
+		if hassioDiscoveryEnable:
+			discoverySender.start();
 		
-		#launch MQTT client
 		client.brokerConnected=False;
-		client.loop_start();
-
-		#start modbus thread
-		panel.loop_start();
-		run=True;
-		while run:
-			#check every 10s that all threads are living
-			time.sleep(5);
-			if (threading.active_count()!=3):
-				logger.critical('At least one process has been killed, stop launched');
-				run=False;
-		#stop modbus thread
-		panel.loop_stop();		
+		if (modbusAsyncio):
+			#launch MQTT client and modbus loops on a single event loop
+			logger.critical('Modbus and MQTT loops running on asyncio event loop');
+			asyncio.run(asyncioLoop(panels,client));
+			logger.critical('Modbus loop has been stopped, stop launched');
+		else:
+			#launch MQTT client
+			client.loop_start();
+
+			#start modbus threads
+			for panel in panels:
+				panel.loop_start();
+			#MQTT, metrics and HA discovery threads and one thread per boiler, other threads such as resolver executors may come and go
+			threads=[client._thread]+[panel.loopThread for panel in panels];
+			if metricsEnable:
+				threads.append(metricsServer.thread);
+			if hassioDiscoveryEnable:
+				threads.append(discoverySender.thread);
+			run=True;
+			while run:
+				#check every 5s that all threads are living
+				time.sleep(5);
+				if (not all(thread.is_alive() for thread in threads)):
+					logger.critical('At least one process has been killed, stop launched');
+					run=False;
+		#stop modbus threads
+		for panel in panels:
+			panel.loop_stop();		
+		DDModbus.closeCaptures();
 		#disconnect mqtt server
 		client.loop_stop();
 		logger.critical('Stopped');
 	except KeyboardInterrupt:
-		#stop modbus thread
-		panel.loop_stop();
+		#stop modbus threads
+		for panel in panels:
+			panel.loop_stop();
+		DDModbus.closeCaptures();
 
 		#disconnect mqtt server
 		client.loop_stop();
@@ -2,11 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import threading,queue
+import asyncio
 import logging, logging.config
 import DDModbus
 import time,datetime,pytz
+import collections
 from enum import IntEnum
-from Diematic import Diematic,DDREGISTER
+from Diematic import Diematic,DDREGISTER,REGSOURCE,SYNCHRO_TIMEOUTS
+import Metrics
+
+#duration of master windows, from switch to MASTER to the end of exchanges
+MASTER_WINDOW_SECONDS=Metrics.histogram('diematic_master_window_seconds','Duration of bus master windows used by the interface',('boiler',));
 
 #definition for state machine used for modBus data exchange
 class DDModBusStatus(IntEnum):
@@ -14,6 +20,115 @@ class DDModBusStatus(IntEnum):
 	SLAVE=1;
 	MASTER=2;
 
+#This class learns the bus cadence of the regulator from received frame timestamps
+#the regulator alternates busy phases, where it is master of the bus, and free windows where the interface can be master
+#it predicts the length of the next free window and the transfer time of requests, so that exchanges stop before the regulator talks again
+class BusWindowScheduler:
+	#default silence in s separating two regulator busy phases
+	PHASE_GAP=1.5;
+	#default min duration in s of slave mode before switching to master, also once the cadence is learned
+	SWITCH_DELAY=5;
+	#number of busy phases and free windows kept
+	HISTORY=8;
+	#number of free windows to learn before predicting windows
+	MIN_SAMPLES=2;
+	#margin in s kept at the end of a free window and added to the max silence inside a busy phase
+	SAFETY_MARGIN=0.3;
+	#default transfer time estimates in s, a request and its answer, and each register at 9600 bauds
+	REQUEST_TIME=0.1;
+	REGISTER_TIME=0.0025;
+	#weight of the last measure in request time estimate
+	EWMA_WEIGHT=0.3;
+
+	#phaseGap: silence in s separating two busy phases, switchDelay: min duration in s of slave mode before switching to master
+	def __init__(self,phaseGap=PHASE_GAP,switchDelay=SWITCH_DELAY):
+		self.phaseGap=phaseGap;
+		self.switchDelay=switchDelay;
+		self.busyDurations=collections.deque(maxlen=self.HISTORY);
+		self.freeDurations=collections.deque(maxlen=self.HISTORY);
+		self.frameGaps=collections.deque(maxlen=self.HISTORY*8);
+		self.phaseStart=None;
+		#the first phase is seen partially, its duration is not learned
+		self.firstPhase=True;
+		self.lastFrame=None;
+		#end of last exchange of the interface, frames of the regulator received meanwhile are not seen
+		self.lastExchange=None;
+		self.requestTime=self.REQUEST_TIME;
+		#end of current free window, None if unknown, and number of exchanges done in it
+		self.deadline=None;
+		self.windowExchanges=0;
+
+	def learned(self):
+		return (len(self.freeDurations) >= self.MIN_SAMPLES);
+
+	#frame received from the bus at time t
+	def frame(self,t):
+		if (self.lastFrame is not None):
+			gap=t-self.lastFrame;
+			#the gap is only measured if no frame may have been missed during an exchange of the interface
+			maxGap=max(self.frameGaps) if self.frameGaps else 0;
+			measured=((self.lastExchange is None) or (self.lastExchange <= self.lastFrame) or ((t-self.lastExchange) > (maxGap+self.SAFETY_MARGIN)));
+			if (gap >= self.phaseGap):
+				#end of a busy phase and of a free window
+				if (not self.firstPhase):
+					self.busyDurations.append(self.lastFrame-self.phaseStart);
+				self.firstPhase=False;
+				if (measured):
+					self.freeDurations.append(gap);
+				self.phaseStart=t;
+			elif (measured):
+				self.frameGaps.append(gap);
+		else:
+			self.phaseStart=t;
+		self.lastFrame=t;
+		self.deadline=None;
+
+	#return True if the regulator busy phase can be considered as over at time now
+	#the interface shall have been slave during at least switchDelay, the learned cadence can only delay the switch
+	def masterAllowed(self,now,slaveDuration):
+		if (slaveDuration<=self.switchDelay):
+			return False;
+		if ((not self.learned()) or (not self.busyDurations)):
+			return True;
+		#silence longer than any silence of a busy phase and busy phase long enough
+		maxGap=max(self.frameGaps) if self.frameGaps else 0;
+		return (((now-self.lastFrame) >= (maxGap+self.SAFETY_MARGIN)) and ((self.lastFrame-self.phaseStart) >= 0.5*min(self.busyDurations)));
+
+	#start of a free window, its end is predicted from the shortest learned window
+	def openWindow(self):
+		self.windowExchanges=0;
+		if (self.learned()):
+			self.deadline=self.lastFrame+min(self.freeDurations)-self.SAFETY_MARGIN;
+		else:
+			self.deadline=None;
+		return self.deadline;
+
+	#estimated duration in s of requests transferring regNb registers
+	def estimate(self,regNb,requests=1):
+		return requests*self.requestTime+regNb*self.REGISTER_TIME;
+
+	#return True if requests transferring regNb registers, plus extra delay in s, end before the predicted end of the window
+	#the first exchange of a window is always allowed so that exchanges longer than the window are not delayed forever
+	def fits(self,regNb,requests=1,extra=0):
+		if ((self.deadline is None) or (self.windowExchanges==0)):
+			return True;
+		return ((time.time()+self.estimate(regNb,requests)+extra) <= self.deadline);
+
+	#measured duration of a request transferring regNb registers
+	def record(self,regNb,duration):
+		self.lastExchange=time.time();
+		self.windowExchanges+=1;
+		sample=max(0,duration-regNb*self.REGISTER_TIME);
+		self.requestTime=(1-self.EWMA_WEIGHT)*self.requestTime+self.EWMA_WEIGHT*sample;
+
+	#failed exchange started at time t, the free window was over, no more exchange fits in current window
+	def collision(self,t):
+		self.lastExchange=time.time();
+		self.windowExchanges+=1;
+		if (self.lastFrame is not None):
+			self.freeDurations.append(max(0,t-self.lastFrame));
+		self.deadline=t;
+
 #This class allow to read/write parameters to Diematic3 regulator with the helo of a RS485/TCPIP converter
 #refresh of attributes From regulator is done roughly every minute
 #update request to the regulator are done within 10 s and trigger a whole read refresh
@@ -22,74 +137,22 @@ class Diematic3Panel(Diematic):
 		
 		#state machine initialisation
 		self.busStatus=DDModBusStatus.INIT;
+		#bus cadence learning
+		self.busWindow=BusWindowScheduler();
 		
 		super().__init__(ip,port,regulatorAddress,0,boilerTimezone,syncTime)
 
-#this property is used to get register values from the regulator Diematic3
-	def refreshRegisters(self):
-		#update registers 1->63
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,1,63);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		#update registers 64->127
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,64,64);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-			
-		#update registers 128->191
-		#reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,128,64);
-		#if (reg is not None):
-		#	self.registers.update(reg);
-		#else:
-		#	return(False);
-			
-		#update registers 191->255
-		#reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,192,64);
-		#if (reg is not None):
-		#	self.registers.update(reg);
-		#else:
-		#	return(False);
-			
-		#update registers 384->447
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,384,64);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		#update registers 448->470
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,448,23);	
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		
-		#display register table on standard output
-		#regLine="";
-		#for index in range(256):
-		#	try:
-		#		regLine+='{:04X}'.format(self.registers[index])+' '
-		#	except KeyError:
-		#		regLine+='---- ';
-				
-		#	if (index % 16)==15:
-		#		regLine= '{:01X}'.format(index >>4)+'0: '+regLine
-		#		print(regLine);
-		#		regLine='';
-
-		#print('==========================================')
-		return(True);
-
+#this property is used to set bus cadence learning, phaseGap is the silence in s separating two regulator busy phases
+#switchDelay is the min duration in s of slave mode before switching to master, the learned cadence can only delay the switch
+	def setBusWindow(self,phaseGap=BusWindowScheduler.PHASE_GAP,switchDelay=BusWindowScheduler.SWITCH_DELAY):
+		self.busWindow=BusWindowScheduler(phaseGap,switchDelay);
 
 #this property is used by the Modbus loop to set register dedicated to Mode A and hotwater mode (in case of no usage of B area)		
-	def modeAUpdate(self):
+	async def modeAUpdate(self):
 		#if mode A register update request is pending
 		if (not(self.zoneAModeUpdateRequest.empty()) or (not(self.hotWaterModeUpdateRequest.empty()) and (self.zoneBMode is None))):
 			#get current mode
-			currentMode=self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,1);
+			currentMode=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,1);
 			#in case of success
 			if (currentMode):
 				mode=currentMode[DDREGISTER.MODE_A];
@@ -107,37 +170,38 @@ class Diematic3Panel(Diematic):
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				if (mode==1):
 					#set antiice day number to 1
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
-					time.sleep(0.5);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
+					await asyncio.sleep(0.5);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 					#set mode A number to requested value
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
 
 				#general case
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				else:
 					#set mode A
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
 					#set antiice day number to 1
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
 					#set mode A again
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
-					time.sleep(0.5);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await asyncio.sleep(0.5);
 					#set mode A again
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 			
-				#request register refresh
-				self.refreshRequest=True;
+				#request read back of written registers
+				self.requestReadBack(DDREGISTER.MODE_A.value);
+				self.requestReadBack(DDREGISTER.NB_JOUR_ANTIGEL.value);
 
 #this property is used by the Modbus loop to set register dedicated to Mode B and hotwater mode (in case of usage of B area)					
-	def modeBUpdate(self):
+	async def modeBUpdate(self):
 		#if mode B register update request is pending
 		if (not(self.zoneBModeUpdateRequest.empty()) or (not(self.hotWaterModeUpdateRequest.empty()) and (self.zoneBMode))):
 			#get current mode
-			currentMode=self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,1);
+			currentMode=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,1);
 			#in case of success
 			if (currentMode):
 				mode=currentMode[DDREGISTER.MODE_B];
@@ -155,44 +219,93 @@ class Diematic3Panel(Diematic):
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				if (mode==1):
 					#set antiice day number to 1
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
-					time.sleep(0.5);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
+					await asyncio.sleep(0.5);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 					#set mode B number to requested value
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 
 				#general case
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				else:
 					#set mode B
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 					#set antiice day number to 1
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
 					#set mode B again
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
-					time.sleep(0.5);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await asyncio.sleep(0.5);
 					#set mode B again
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 			
-				#request refresh
-				self.refreshRequest=True;					
+				#request read back of written registers
+				self.requestReadBack(DDREGISTER.MODE_B.value);
+				self.requestReadBack(DDREGISTER.NB_JOUR_ANTIGEL.value);					
+
+#this property is used by the Modbus loop in master mode to send user commands: mode updates, writes and read back, while they fit in the bus window
+	async def commandExchanges(self):
+		#mode A register update if needed, 1 read and up to 5 writes
+		if (self.busWindow.fits(6,6,0.5)):
+			await self.modeAUpdate();
+		
+		#mode B register update if needed
+		if (self.busWindow.fits(6,6,0.5)):
+			await self.modeBUpdate();
+				
+		#while general register update request are pending and fit in the window (Master mode started since less than 2s until the window is learned)
+		while (not(self.regUpdateRequest.empty()) and (((time.time()-self.masterTime) < 2) if (self.busWindow.deadline is None) else self.busWindow.fits(1))):
+			#get next write, skipping values equal to the ones recently read from the regulator, as a write echo or an old value may be out of date
+			regSet=self.regUpdateRequest.get(self.registers.readValues(self.WRITE_SKIP_AGE));
+			if (regSet is None):
+				break;
+			self.logger.debug('Write Request :'+str(regSet.address)+':'+str(regSet.data));
+			#write to Analog registers
+			start=time.time();
+			if ( not await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,regSet.address,regSet.data)):
+				#And cancel Master Slave Synchro Flag in case of error
+
+				self.logger.warning('ModBus Master Slave Synchro Error');
+				self.masterSlaveSynchro=False;
+				self.busWindow.collision(start);
+			else:
+				self.busWindow.record(len(regSet.data),time.time()-start);
+				#acknowledged values are saved until read back
+				self.updateRegisters({regSet.address+i:value for i,value in enumerate(regSet.data)},REGSOURCE.WRITE_ECHO);
+			#request read back of written registers
+			self.requestReadBack(regSet.address,len(regSet.data));
+		
+		#read back written registers and refresh depending attributes
+		if (self.readBackRequest and not self.refreshRequest):
+			if (await self.readBackRegisters(self.busWindow) is not None):
+				self.refreshAttributes();
+			else:
+				#Cancel Master Slave Synchro Flag in case of error
+				self.logger.warning('ModBus Master Slave Synchro Error');
+				self.masterSlaveSynchro=False;
 
-#modbus loop, shall run in a specific thread. Allow to exchange register values with the Dielatic regulator
-	def loop(self):
+#asyncio modbus loop, run by loop_start in a specific thread or awaited on the caller event loop. Allow to exchange register values with the Diematic regulator
+	async def loopAsync(self):
 		#parameter validity duration in seconds after expiration of period
 		#after this timeout, interface is reset
 		VALIDITY_TIME=30
 		try:
 			self.masterSlaveSynchro=False 
+			#RS485 converter connexion init
+			await self.initConnection();
 			self.run=True;
 			#reset timeout
 			self.lastSynchroTimestamp=time.time();
 			while self.run:
 				#wait for a frame received
-				frame=self.modBusInterface.slaveRx(self.interfaceAddress);
+				frame=await self.modBusInterface.slaveRx(self.interfaceAddress);
+				if (frame):
+					self.busWindow.frame(time.time());
+					#register values exchanged by the regulator with its peripherals, refresh regulator attribute
+					if (self.snooping and self.snoopFrame(frame)):
+						self.refreshAttributes();
 
 				#depending current bus mode	
 				if (self.busStatus!=DDModBusStatus.SLAVE):
@@ -201,49 +314,45 @@ class Diematic3Panel(Diematic):
 						self.busStatus=DDModBusStatus.SLAVE;
 						self.slaveTime=time.time();
 						self.logger.debug('Bus status switched to SLAVE');
+					#user commands received during a master window are sent if they still fit in it (2s after Master mode start until the window is learned)
+					elif ((self.busStatus==DDModBusStatus.MASTER) and self.commandPending() and (((time.time()-self.masterTime) < 2) if (self.busWindow.deadline is None) else self.busWindow.fits(6,6,0.5))):
+						self.logger.debug('User commands sent in current master window');
+						await self.commandExchanges();
 						
 				elif (self.busStatus==DDModBusStatus.SLAVE):
 					slaveModeDuration=time.time()-self.slaveTime;
-					#if no frame have been received and slave happen during at least 5s
-					if ((not frame) and (slaveModeDuration>5)):
+					#if no frame have been received and the regulator busy phase is over (at least switchDelay in slave mode)
+					if ((not frame) and self.busWindow.masterAllowed(time.time(),slaveModeDuration)):
 						#switch mode to MASTER
 						self.masterTime=time.time();
 						self.busStatus=DDModBusStatus.MASTER;
-						self.logger.debug('Bus status switched to MASTER after '+str(slaveModeDuration));
+						deadline=self.busWindow.openWindow();
+						self.logger.debug('Bus status switched to MASTER after '+str(slaveModeDuration)+(', window: '+str(deadline-self.masterTime) if (deadline is not None) else ''));
 						
 						#if the state wasn't still synchronised
 						if (not self.masterSlaveSynchro):
 							self.logger.info('ModBus Master Slave Synchro OK');
 							self.masterSlaveSynchro=True;
 							
-						#mode A register update if needed
-						self.modeAUpdate();
+						#exchanges are packed by priority in the window: user commands, then refresh
+						await self.commandExchanges();
 						
-						#mode B register update if needed
-						self.modeBUpdate();
-								
-						#while general register update request are pending and Master mode is started since less than 2s
-						while (not(self.regUpdateRequest.empty()) and ((time.time()-self.masterTime) < 2)):
-							regSet=self.regUpdateRequest.get(False)
-							self.logger.debug('Write Request :'+str(regSet.address)+':'+str(regSet.data));
-							#write to Analog registers
-							if ( not self.modBusInterface.masterWriteAnalog(self.regulatorAddress,regSet.address,regSet.data)):
-								#And cancel Master Slave Synchro Flag in case of error
-
-								self.logger.warning('ModBus Master Slave Synchro Error');
-								self.masterSlaveSynchro=False;
-							self.refreshRequest=True;
-							
-						
-						#update registers, todo condition for refresh launch
-						if (((time.time()-self.lastSynchroTimestamp) > (self.refreshPeriod-5)) or self.refreshRequest):
-							if (self.refreshRegisters()):
+						#update registers, a refresh not fitting in the window is continued in next one
+						if (((time.time()-self.lastSynchroTimestamp) > (self.pollPeriod()-5)) or self.refreshRequest or self.refreshDeferred):
+							result=await self.refreshRegisters(self.refreshRequest and not self.refreshDeferred,self.busWindow);
+							self.refreshDeferred=(result is None);
+							if (result is None):
+								#refresh attributes of registers read in this window
+								self.refreshAttributes();
+							elif (result):
 								self.lastSynchroTimestamp=time.time();
 							
 								#refresh regulator attribute
 								self.refreshAttributes();
 								
-								#clear Flag
+								#clear Flags, all registers have been read in case of forced refresh
+								if (self.refreshRequest):
+									self.readBackRequest.clear();
 								self.refreshRequest=False;
 								
 								#check time drift
@@ -270,21 +379,30 @@ class Diematic3Panel(Diematic):
 								#Cancel Master Slave Synchro Flag in case of error
 								self.logger.warning('ModBus Master Slave Synchro Error');
 								self.masterSlaveSynchro=False;
+						
+						#master window duration
+						MASTER_WINDOW_SECONDS.observe(time.time()-self.masterTime,self.boilerId);
 								
+				#out of date attributes are set unavailable
+				self.expireAttributes();
+				
 				if ((time.time()-self.lastSynchroTimestamp) > self.refreshPeriod + VALIDITY_TIME):
 					#log
 					self.logger.warning('Synchro timeout');
-					#init regulator register
-					self.initAttributes();
-					#publish values
-					self.updateCallback();
+					SYNCHRO_TIMEOUTS.inc(1,self.boilerId);
+					#attributes are kept until their TTL expires, or reset at once without TTL
+					self.synchroLost();
 					#reinit connection
-					self.initConnection();
+					await self.initConnection();
 					self.refreshRequest=True;
 					#reset timeout
 					self.lastSynchroTimestamp=time.time();
 					
 
+			self.closeConnection();
 			self.logger.critical('Modbus Thread stopped');
+		except asyncio.CancelledError:
+			self.closeConnection();
+			self.logger.critical('Modbus loop cancelled');
 		except BaseException as exc:		
 			self.logger.exception(exc)
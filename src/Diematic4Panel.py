@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import threading,queue
+import asyncio
 import logging, logging.config
 import DDModbus
 import time,datetime,pytz
 from enum import IntEnum
-from Diematic import Diematic,DDREGISTER
+from Diematic import Diematic,DDREGISTER,REGSOURCE,SYNCHRO_TIMEOUTS
 
 #definition for state machine used for modBus data exchange
 #TOREMOVE class DDModBusStatus(IntEnum):
@@ -25,71 +26,12 @@ class Diematic4Panel(Diematic):
 		
 		super().__init__(ip,port,regulatorAddress,0,boilerTimezone,syncTime)
 
-#this property is used to get register values from the regulator Diematic4
-	def refreshRegisters(self):
-		#update registers 1->63
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,1,63);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		#update registers 64->127
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,64,64);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-			
-		#update registers 128->191
-		#reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,128,64);
-		#if (reg is not None):
-		#	self.registers.update(reg);
-		#else:
-		#	return(False);
-			
-		#update registers 191->255
-		#reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,192,64);
-		#if (reg is not None):
-		#	self.registers.update(reg);
-		#else:
-		#	return(False);
-			
-		#update registers 384->447
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,384,64);
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		#update registers 448->470
-		reg=self.modBusInterface.masterReadAnalog(self.regulatorAddress,448,23);	
-		if (reg is not None):
-			self.registers.update(reg);
-		else:
-			return(False);
-		
-		#display register table on standard output
-		#regLine="";
-		#for index in range(256):
-		#	try:
-		#		regLine+='{:04X}'.format(self.registers[index])+' '
-		#	except KeyError:
-		#		regLine+='---- ';
-				
-		#	if (index % 16)==15:
-		#		regLine= '{:01X}'.format(index >>4)+'0: '+regLine
-		#		print(regLine);
-		#		regLine='';
-
-		#print('==========================================')
-		return(True);
-
-
 #this property is used by the Modbus loop to set register dedicated to Mode A and hotwater mode (in case of no usage of B area)		
-	def modeAUpdate(self):
+	async def modeAUpdate(self):
 		#if mode A register update request is pending
 		if (not(self.zoneAModeUpdateRequest.empty()) or (not(self.hotWaterModeUpdateRequest.empty()) and (self.zoneBMode is None))):
 			#get current mode
-			currentMode=self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,1);
+			currentMode=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,1);
 			#in case of success
 			if (currentMode):
 				mode=currentMode[DDREGISTER.MODE_A];
@@ -112,13 +54,13 @@ class Diematic4Panel(Diematic):
 					#set antiice day number to 0
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 					#set mode A number to requested value
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
 
 				#general case
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				else:
 					#set mode A
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_A.value,[mode]);
 					#set antiice day number to 1
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
 					#set mode A again
@@ -129,15 +71,16 @@ class Diematic4Panel(Diematic):
 					#set antiice day number to 0
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 			
-				#request register refresh
-				self.refreshRequest=True;
+				#request read back of written registers
+				self.requestReadBack(DDREGISTER.MODE_A.value);
+				self.requestReadBack(DDREGISTER.NB_JOUR_ANTIGEL.value);
 
 #this property is used by the Modbus loop to set register dedicated to Mode B and hotwater mode (in case of usage of B area)					
-	def modeBUpdate(self):
+	async def modeBUpdate(self):
 		#if mode B register update request is pending
 		if (not(self.zoneBModeUpdateRequest.empty()) or (not(self.hotWaterModeUpdateRequest.empty()) and (self.zoneBMode))):
 			#get current mode
-			currentMode=self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,1);
+			currentMode=await self.modBusInterface.masterReadAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,1);
 			#in case of success
 			if (currentMode):
 				mode=currentMode[DDREGISTER.MODE_B];
@@ -158,15 +101,15 @@ class Diematic4Panel(Diematic):
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
 					#TOREMOVE time.sleep(0.5);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 					#set mode B number to requested value
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 
 				#general case
 				#following write procedure is an empirical solution to have remote control refresh while updating mode
 				else:
 					#set mode B
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 					#set antiice day number to 1
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[1]);
 					#set mode B again
@@ -175,47 +118,77 @@ class Diematic4Panel(Diematic):
 					#set mode B again
 					#TOREMOVE self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.MODE_B.value,[mode]);
 					#set antiice day number to 0
-					self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
+					await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,DDREGISTER.NB_JOUR_ANTIGEL.value,[0]);
 			
-				#request refresh
-				self.refreshRequest=True;					
+				#request read back of written registers
+				self.requestReadBack(DDREGISTER.MODE_B.value);
+				self.requestReadBack(DDREGISTER.NB_JOUR_ANTIGEL.value);					
 
-#modbus loop, shall run in a specific thread. Allow to exchange register values with the Diematic regulator
-	def loop(self):
+#asyncio modbus loop, run by loop_start in a specific thread or awaited on the caller event loop. Allow to exchange register values with the Diematic regulator
+	async def loopAsync(self):
 		#parameter validity duration in seconds after expiration of period
 		#after this timeout, interface is reset
 		VALIDITY_TIME=30
 		try:
 			#TOREMOVE self.masterSlaveSynchro=False 
+			#RS485 converter connexion init
+			await self.initConnection();
 			self.run=True;
 			#reset timeout
 			self.nextSynchroTimestamp=time.time();
 			while self.run:
 				#clear Rx buffer
-				while self.modBusInterface.slaveRx(self.interfaceAddress):
+				while await self.modBusInterface.slaveRx(self.interfaceAddress):
 					self.logger.debug('Clear Rx buffer');
-					time.sleep(0.5);
+					await asyncio.sleep(0.5);
 
 				#mode A register update if needed
-				self.modeAUpdate();
+				await self.modeAUpdate();
 
 				#mode B register update if needed
-				self.modeBUpdate();
+				await self.modeBUpdate();
 
 				#while general register update request are pending
 				while not(self.regUpdateRequest.empty()):
-					regSet=self.regUpdateRequest.get(False)
+					#get next write, skipping values equal to the ones recently read from the regulator, as a write echo or an old value may be out of date
+					regSet=self.regUpdateRequest.get(self.registers.readValues(self.WRITE_SKIP_AGE));
+					if (regSet is None):
+						break;
 					self.logger.debug('Write Request :'+str(regSet.address)+':'+str(regSet.data));
 					#write to Analog registers
-					if ( not self.modBusInterface.masterWriteAnalog(self.regulatorAddress,regSet.address,regSet.data)):
+					if ( not await self.modBusInterface.masterWriteAnalog(self.regulatorAddress,regSet.address,regSet.data)):
 						#log in case of error
 						self.logger.warning('ModBus masterWriteAnalog Error');
+					else:
+						#acknowledged values are saved until read back
+						self.updateRegisters({regSet.address+i:value for i,value in enumerate(regSet.data)},REGSOURCE.WRITE_ECHO);
+					#request read back of written registers
+					self.requestReadBack(regSet.address,len(regSet.data));
+				
+				#read back written registers and refresh depending attributes
+				if (self.readBackRequest and not self.refreshRequest):
+					if (await self.readBackRegisters() is not None):
+						self.refreshAttributes();
+					else:
+						self.logger.warning('ModBus read back Error');
 						
-				#update registers, todo condition for refresh launch
-				if (self.refreshRegisters()):
-					self.nextSynchroTimestamp+=self.refreshPeriod;
+				#update registers when polling period is over, a refresh interrupted by user commands is continued after them
+				result=None;
+				if (self.refreshRequest or self.refreshDeferred or (time.time() >= self.nextSynchroTimestamp)):
+					result=await self.refreshRegisters(self.refreshRequest and not self.refreshDeferred);
+					self.refreshDeferred=(result is None);
+					if (result is None):
+						#refresh attributes of registers read before interruption
+						self.refreshAttributes();
+				if (result):
+					self.nextSynchroTimestamp+=self.pollPeriod();
 					#refresh regulator attribute
 					self.refreshAttributes();
+					
+					#clear Flags, all registers have been read in case of forced refresh
+					if (self.refreshRequest):
+						self.readBackRequest.clear();
+					self.refreshRequest=False;
 
 					#check time drift
 					now = datetime.datetime.now().astimezone();
@@ -237,26 +210,34 @@ class Diematic4Panel(Diematic):
 					else:
 						self.overDriftCounter=0;
 
+				#out of date attributes are set unavailable
+				self.expireAttributes();
+				
 				if ((time.time()-self.nextSynchroTimestamp) > VALIDITY_TIME):
 					#log
 					self.logger.warning('Synchro timeout');
-					#init regulator register
-					self.initAttributes();
-					#publish values
-					self.updateCallback();
+					SYNCHRO_TIMEOUTS.inc(1,self.boilerId);
+					#attributes are kept until their TTL expires, or reset at once without TTL
+					self.synchroLost();
 					#reinit connection
-					self.initConnection();
+					await self.initConnection();
+					self.refreshRequest=True;
 
 					#reset timeout
 					self.nextSynchroTimestamp=time.time();
 				
-				#sleep waiting for next refresh
+				#sleep waiting for next refresh, user commands wake up the loop
 				sleepTime=self.nextSynchroTimestamp-time.time();
-				if sleepTime>0 :
+				if ((sleepTime>0) and not self.refreshDeferred and self.run):
 					self.logger.debug('Sleep for :' + str(sleepTime));
-					time.sleep(sleepTime)
+					if (await self.waitCommand(sleepTime)):
+						self.logger.debug('Woken up by command');
 				
 
+			self.closeConnection();
 			self.logger.critical('Modbus Thread stopped');
+		except asyncio.CancelledError:
+			self.closeConnection();
+			self.logger.critical('Modbus loop cancelled');
 		except BaseException as exc:		
 			self.logger.exception(exc)
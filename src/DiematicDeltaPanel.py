@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import threading,queue
+import asyncio
 import logging, logging.config
 from DDModbus import DDModbus
 import time,datetime,pytz
 from enum import IntEnum
-from Diematic import Diematic,DDREGISTER
+from Diematic import Diematic,DDREGISTER,SYNCHRO_TIMEOUTS
 
 #This class allow to read/write parameters to Diematic3 regulator with the helo of a RS485/TCPIP converter
 #refresh of attributes From regulator is done roughly every minute
@@ -14,22 +15,25 @@ from Diematic import Diematic,DDREGISTER
 class DiematicDeltaPanel(Diematic):
 	def __init__(self,ip,port,regulatorAddress,interfaceAddress,boilerTimezone='',syncTime=False):
 		
+		#the regulator is the only master of the bus, it has no address and only its writes to the interface are snooped
 		super().__init__(ip,port,0,interfaceAddress,boilerTimezone,syncTime)
         
 
 
-#modbus loop, shall run in a specific thread. Allow to exchange register values with the Dielatic regulator
-	def loop(self):
+#asyncio modbus loop, run by loop_start in a specific thread or awaited on the caller event loop. Allow to exchange register values with the Diematic regulator
+	async def loopAsync(self):
 		#parameter validity duration in seconds after expiration of period
 		#after this timeout, interface is reset
 		VALIDITY_TIME=30
 		try:
+			#RS485 converter connexion init
+			await self.initConnection();
 			self.run=True;
 			#reset timeout
 			self.lastSynchroTimestamp=time.time();
 			while self.run:
 				#wait for a frame received
-				frame=self.modBusInterface.slaveRx(self.interfaceAddress);
+				frame=await self.modBusInterface.slaveRx(self.interfaceAddress);
 				
 				#if a frame has been received
 				if (frame):
@@ -40,11 +44,9 @@ class DiematicDeltaPanel(Diematic):
 					#reset timeout
 					self.lastSynchroTimestamp=time.time();
 
-					#todo reflesh below function specific to Diematic3 to get registers content
-					#self.refreshRegisters()
-					
-					#refresh regulator attribute
-					#self.refreshAttributes();
+					#register values are only known from frames sent by the regulator, they are always merged
+					if (self.snoopFrame(frame)):
+						self.refreshAttributes();
 
 					#check time drift
 					# check self.datetime exist before running these lines
@@ -69,19 +71,25 @@ class DiematicDeltaPanel(Diematic):
 						self.overDriftCounter=0;
 									
 								
+				#out of date attributes are set unavailable
+				self.expireAttributes();
+				
 				if ((time.time()-self.lastSynchroTimestamp) > VALIDITY_TIME):
 					#log
 					self.logger.warning('Synchro timeout');
-					#init regulator register
-					self.initAttributes();
-					#publish values
-					self.updateCallback();
+					SYNCHRO_TIMEOUTS.inc(1,self.boilerId);
+					#attributes are kept until their TTL expires, or reset at once without TTL
+					self.synchroLost();
 					#reinit connection
-					self.initConnection();
+					await self.initConnection();
 					#reset timeout
 					self.lastSynchroTimestamp=time.time();
 					
 
+			self.closeConnection();
 			self.logger.critical('Modbus Thread stopped');
+		except asyncio.CancelledError:
+			self.closeConnection();
+			self.logger.critical('Modbus loop cancelled');
 		except BaseException as exc:		
 			self.logger.exception(exc)
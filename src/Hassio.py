@@ -2,21 +2,170 @@
 # -*- coding: utf-8 -*-
 
 import logging,json
+import time
+import queue
+import threading
+
+#This class publishes the discovery messages of all Hassio instances from a specific thread, at most rate messages per second
+#discovery messages are retained, the sender subscribes to the discovery topics of its Hassio instances to know the messages kept by the broker
+#after each connection to the broker, only messages missing or changed on the broker are sent
+#messages no more defined are cleared only if their origin is the one of the sender, messages of other tools or bridges are kept
+#messages replaced by a message of the other discovery mode are migrated as required by Home Assistant instead of being cleared
+class DiscoverySender:
+	#delay in s given to the broker to send its retained messages after a subscription
+	SETTLE_DELAY=2;
+	#request comparing the messages with the broker after a connection
+	SUBSCRIBE='subscribe';
+	#payload switching a discovery topic to migration, its entities are kept by Home Assistant for the new message
+	MIGRATE=json.dumps({'migrate_discovery':True}).encode();
+
+	#bridgeId identifies the bridge in the origin of its messages
+	def __init__(self,mqttClient,rate=5,bridgeId=''):
+		
+		#logger
+		self.logger = logging.getLogger(__name__);
+		self.mqtt=mqttClient;
+		self.interval=(1/rate) if (rate > 0) else 0;
+		#origin of the discovery messages published by the bridge
+		self.origin={'name':(ORIGIN_NAME+' '+bridgeId) if bridgeId else ORIGIN_NAME};
+		#encoded payloads by discovery topic
+		self.configs=dict();
+		#topic filters of discovery messages managed by the sender
+		self.filters=list();
+		#payloads kept by the broker by discovery topic
+		self.retained=dict();
+		#topics of the other discovery mode, migrated to the defined messages
+		self.migrations=set();
+		self.lock=threading.Lock();
+		#publication requests, None stops the thread
+		self.requests=queue.Queue();
+		self.thread=None;
+	
+	def add(self,topic,payload):
+		with self.lock:
+			self.configs[topic]=payload;
+	
+	#topic of a message replaced by a defined message of the other discovery mode
+	def addMigration(self,topic):
+		with self.lock:
+			self.migrations.add(topic);
+	
+	#messages of topics matching filter received from the broker are compared to the defined messages
+	def addFilter(self,filter):
+		with self.lock:
+			if (filter not in self.filters):
+				self.filters.append(filter);
+				self.mqtt.message_callback_add(filter,self.onMessage);
+	
+	#retained messages sent by the broker on subscription, and messages published by the sender
+	def onMessage(self,client,userdata,message):
+		with self.lock:
+			if message.payload:
+				self.retained[message.topic]=message.payload;
+			else:
+				self.retained.pop(message.topic,None);
+	
+	def start(self):
+		self.thread=threading.Thread(target=self.run,daemon=True);
+		self.thread.start();
+	
+	def stop(self):
+		if (self.thread is not None):
+			self.requests.put(None);
+			self.thread.join();
+			self.thread=None;
+	
+	#True if a message kept by the broker has been published by the bridge
+	def published(self,payload):
+		try:
+			config=json.loads(payload);
+		except ValueError:
+			return False;
+		return (isinstance(config,dict) and (config.get('o',config.get('origin'))==self.origin));
+	
+	#request the comparison with the messages kept by the broker, to be called on each connection to the broker
+	def connected(self):
+		self.requests.put(self.SUBSCRIBE);
+	
+	#request the publication of messages missing or changed on the broker, or of all of them if force is True
+	#topics published by the bridge, kept by the broker and no more defined are cleared
+	def send(self,force=False):
+		self.requests.put(force);
+	
+	def run(self):
+		while True:
+			force=self.requests.get();
+			if (force is None):
+				return;
+			try:
+				if (force==self.SUBSCRIBE):
+					force=False;
+					with self.lock:
+						self.retained.clear();
+						filters=list(self.filters);
+					for filter in filters:
+						self.mqtt.subscribe(filter,1);
+					time.sleep(self.SETTLE_DELAY);
+				with self.lock:
+					stale=[topic for topic,payload in self.retained.items() if ((topic not in self.configs) and self.published(payload))];
+					migrated=[topic for topic in stale if (topic in self.migrations)];
+					#replaced topics are switched to migration before the new messages, and cleared once they are published
+					pending=[(topic,self.MIGRATE) for topic in migrated];
+					#other topics no more defined are cleared first, so that their entities are removed before being defined by other topics
+					pending+=[(topic,b'') for topic in stale if (topic not in self.migrations)];
+					pending+=[(topic,payload) for topic,payload in self.configs.items() if (force or (self.retained.get(topic)!=payload))];
+					pending+=[(topic,b'') for topic in migrated];
+				if (not pending):
+					continue;
+				self.logger.info('Sending '+str(len(pending))+' HA discovery messages');
+				#messages not kept by the broker are sent again after the next connection
+				for topic,payload in pending:
+					self.mqtt.publish(topic,payload,1,True);
+					time.sleep(self.interval);
+			except BaseException as exc:
+				self.logger.exception(exc);
+
+#origin name of discovery messages
+ORIGIN_NAME='Diematic32MQTT';
+
+#abbreviations of discovery options used in device discovery message
+ABBREVIATIONS={'availability':'avty','availability_mode':'avty_mode','availability_topic':'avty_t','command_topic':'cmd_t','device_class':'dev_cla','enabled_by_default':'en','identifiers':'ids','manufacturer':'mf','object_id':'obj_id','options':'ops','payload_available':'pl_avail','payload_not_available':'pl_not_avail','payload_off':'pl_off','payload_on':'pl_on','state_topic':'stat_t','topic':'t','unique_id':'uniq_id','unit_of_measurement':'unit_of_meas','value_template':'val_tpl'};
 
 #This class allow to interface with Home Assistant through the MQTT Discovery Protocol
+#discovery messages are built once and encoded, they are published by the sender
 class Hassio:
 
-	def __init__(self,mqttClient,topicRoot,clientId,discovery_prefix):
+	#options defined once in device discovery message
+	SHARED_OPTIONS=('device','availability','availability_mode');
+	
+	#deviceDiscovery: True to publish a single device discovery message with all components instead of one message per entity
+	def __init__(self,mqttClient,topicRoot,clientId,discovery_prefix,sender=None,deviceDiscovery=False):
 		
 		#logger
 		self.logger = logging.getLogger(__name__);
 		#attribute init
-		self.availabilityTopic=None;
+		#availability topics, an entity is available when all of them are
+		self.availability=list();
+		#state topics having their own availability sub topic, with its payloads
+		self.attributeTopics=set();
+		self.attributeAvailabilityInfo=None;
 		#mqttClient instance ref saving
 		self.mqtt=mqttClient;
 		self.topicRoot=topicRoot;
 		self.clientId=clientId;
 		self.discovery_prefix=discovery_prefix;
+		self.sender=sender;
+		#encoded discovery payloads by topic
+		self.configs=dict();
+		self.deviceDiscovery=deviceDiscovery;
+		#components of device discovery message by id
+		self.components=dict();
+		#origin of discovery messages, used by the sender to recognise its messages
+		self.origin=sender.origin if (sender is not None) else {'name':ORIGIN_NAME};
+		#entity and device discovery topics of the boiler are compared with the broker, whatever the discovery mode
+		if (sender is not None):
+			sender.addFilter(discovery_prefix+'/+/'+clientId+'/+/config');
+			sender.addFilter(discovery_prefix+'/device/'+clientId+'/config');
 		self.device = {
 			"identifiers": [""],
 			"manufacturer": "",
@@ -30,16 +179,74 @@ class Hassio:
 			"name": name
 		}
 	
+	#discovery message of an entity, or component of the device discovery message
+	#the topic of the entity in the other discovery mode is migrated to the new message
+	def addConfig(self,component,object_id,payload):
+		entityTopic=self.discovery_prefix+'/'+component+'/'+self.clientId+'/'+object_id+'/config';
+		deviceTopic=self.discovery_prefix+'/device/'+self.clientId+'/config';
+		if self.deviceDiscovery:
+			self.components[component+'_'+object_id]=self.componentConfig(component,payload);
+			self.setConfig(deviceTopic,self.deviceConfig());
+			migratedTopic=entityTopic;
+		else:
+			self.setConfig(entityTopic,dict(payload,origin=self.origin));
+			migratedTopic=deviceTopic;
+		if (self.sender is not None):
+			self.sender.addMigration(migratedTopic);
+	
+	def setConfig(self,discoveryTopic,payload):
+		#device discovery message is encoded compact in UTF-8
+		encoded=json.dumps(payload,separators=(',',':'),ensure_ascii=False).encode() if self.deviceDiscovery else json.dumps(payload).encode();
+		self.configs[discoveryTopic]=encoded;
+		if (self.sender is not None):
+			self.sender.add(discoveryTopic,encoded);
+	
+	#component of the device discovery message, options shared by all components are removed and options are abbreviated
+	#availability of a component with its own availability topic is kept
+	def componentConfig(self,component,payload):
+		config={'p':component};
+		shared=self.SHARED_OPTIONS if (payload.get('availability')==self.availability) else ('device',);
+		for key,value in payload.items():
+			if (key not in shared):
+				config[ABBREVIATIONS.get(key,key)]=self.abbreviateAvailability(value) if (key=='availability') else value;
+		return config;
+	
+	#device discovery message, availability, device and origin are defined once for all components
+	def deviceConfig(self):
+		config={'dev':{ABBREVIATIONS.get(key,key):value for key,value in self.device.items()}};
+		config['o']=self.origin;
+		if self.availability:
+			config['avty']=self.abbreviateAvailability(self.availability);
+			config['avty_mode']='all';
+		config['cmps']=self.components;
+		return config;
+	
 	def availabilityInfo(self,shortTopic,payload_available,payload_not_available):
 		#availability info saving
-		
-		self.availabilityTopic=self.topicRoot+'/'+shortTopic;
-		self.payload_available=payload_available;
-		self.payload_not_available=payload_not_available;
+		self.addAvailability(self.topicRoot+'/'+shortTopic,payload_available,payload_not_available);
+	
+	#availability topic out of the topic root, such as the bridge status
+	def addAvailability(self,topic,payload_available,payload_not_available):
+		self.availability.append({'topic':topic,'payload_available':payload_available,'payload_not_available':payload_not_available});
+	
+	#availability sub topic of state topics, an entity of these topics is available if its attribute is
+	def attributeAvailability(self,subTopic,stateTopics,payload_available,payload_not_available):
+		self.attributeTopics=set(stateTopics);
+		self.attributeAvailabilityInfo=(subTopic,payload_available,payload_not_available);
+	
+	#availability options of an entity, with the availability topic of its attribute if any
+	def availabilityOptions(self,payload,shortStateTopic=None):
+		payload["availability"]=list(self.availability);
+		if (shortStateTopic in self.attributeTopics):
+			subTopic,payload_available,payload_not_available=self.attributeAvailabilityInfo;
+			payload["availability"].append({'topic':self.topicRoot+'/'+shortStateTopic+'/'+subTopic,'payload_available':payload_available,'payload_not_available':payload_not_available});
+		payload["availability_mode"]='all';
+	
+	@staticmethod
+	def abbreviateAvailability(availability):
+		return [{ABBREVIATIONS.get(key,key):value for key,value in topic.items()} for topic in availability];
 	
 	def addSensor(self,object_id,name,deviceClass,shortStateTopic,valueTemplate,unit_of_measurement):
-		#build discovery topic
-		discoveryTopic=self.discovery_prefix+'/sensor/'+self.clientId+'/'+object_id+'/config';
 		#build discovery message payload
 		payload={"name":name};
 		payload["object_id"]=object_id;
@@ -49,18 +256,14 @@ class Hassio:
 		payload["state_topic"]=self.topicRoot+'/'+shortStateTopic;
 		if (valueTemplate is not None):
 			payload["value_template"]=valueTemplate;
-		payload["availability_topic"]=self.availabilityTopic;
-		payload["payload_available"]=self.payload_available;
-		payload["payload_not_available"]=self.payload_not_available;
+		self.availabilityOptions(payload,shortStateTopic);
 		if (unit_of_measurement is not None):
 			payload["unit_of_measurement"]=unit_of_measurement;
 		payload['device'] = self.device
-		#send discovery message
-		self.mqtt.publish(discoveryTopic,json.dumps(payload),1,False);
+		#discovery message is saved, it is published by the sender
+		self.addConfig('sensor',object_id,payload);
 
 	def addBinarySensor(self,object_id,name,deviceClass,shortStateTopic,payload_on,payload_off):
-		#build discovery topic
-		discoveryTopic=self.discovery_prefix+'/binary_sensor/'+self.clientId+'/'+object_id+'/config';
 		#build discovery message payload
 		payload={"name":name};
 		payload["object_id"]=object_id;
@@ -70,26 +273,20 @@ class Hassio:
 		payload["state_topic"]=self.topicRoot+'/'+shortStateTopic;
 		payload["payload_on"]=payload_on;
 		payload["payload_off"]=payload_off;
-		payload["availability_topic"]=self.availabilityTopic;
-		payload["payload_available"]=self.payload_available;
-		payload["payload_not_available"]=self.payload_not_available;
+		self.availabilityOptions(payload,shortStateTopic);
 		payload["enabled_by_default"]=False;
 		payload['device'] = self.device
-		#send discovery message
-		self.mqtt.publish(discoveryTopic,json.dumps(payload),1,False);
+		#discovery message is saved, it is published by the sender
+		self.addConfig('binary_sensor',object_id,payload);
 	
 	def addNumber(self,object_id,name,shortStateTopic,shortCommandTopic,min,max,step,unit_of_measurement):
-		#build discovery topic
-		discoveryTopic=self.discovery_prefix+'/number/'+self.clientId+'/'+object_id+'/config';
 		#build discovery message payload
 		payload={"name":name};
 		payload["object_id"]=object_id;
 		payload["unique_id"]=self.clientId+'.'+object_id;
 		payload["state_topic"]=self.topicRoot+'/'+shortStateTopic;
 		payload["command_topic"]=self.topicRoot+'/'+shortCommandTopic;
-		payload["availability_topic"]=self.availabilityTopic;
-		payload["payload_available"]=self.payload_available;
-		payload["payload_not_available"]=self.payload_not_available;
+		self.availabilityOptions(payload,shortStateTopic);
 		payload["qos"]=2;
 		payload["min"]=min;
 		payload["max"]=max;
@@ -97,30 +294,24 @@ class Hassio:
 		if (unit_of_measurement is not None):
 			payload["unit_of_measurement"]=unit_of_measurement;
 		payload['device'] = self.device
-		#send discovery message
-		self.mqtt.publish(discoveryTopic,json.dumps(payload),1,False);
+		#discovery message is saved, it is published by the sender
+		self.addConfig('number',object_id,payload);
 		
 	def addSelect(self,object_id,name,shortStateTopic,shortCommandTopic,options):
-		#build discovery topic
-		discoveryTopic=self.discovery_prefix+'/select/'+self.clientId+'/'+object_id+'/config';
 		#build discovery message payload
 		payload={"name":name};
 		payload["object_id"]=object_id;
 		payload["unique_id"]=self.clientId+'.'+object_id;
 		payload["state_topic"]=self.topicRoot+'/'+shortStateTopic;
 		payload["command_topic"]=self.topicRoot+'/'+shortCommandTopic;
-		payload["availability_topic"]=self.availabilityTopic;
-		payload["payload_available"]=self.payload_available;
-		payload["payload_not_available"]=self.payload_not_available;
+		self.availabilityOptions(payload,shortStateTopic);
 		payload["qos"]=2;
 		payload["options"]=options;
 		payload['device'] = self.device
-		#send discovery message
-		self.mqtt.publish(discoveryTopic,json.dumps(payload),1,False);	
+		#discovery message is saved, it is published by the sender
+		self.addConfig('select',object_id,payload);	
 
 	def addSwitch(self,object_id,name,shortStateTopic,shortCommandTopic,payload_off,payload_on):
-		#build discovery topic
-		discoveryTopic=self.discovery_prefix+'/switch/'+self.clientId+'/'+object_id+'/config';
 		#build discovery message payload
 		payload={"name":name};
 		payload["object_id"]=object_id;
@@ -128,13 +319,11 @@ class Hassio:
 		if (shortStateTopic is not None):
 			payload["state_topic"]=self.topicRoot+'/'+shortStateTopic;
 		payload["command_topic"]=self.topicRoot+'/'+shortCommandTopic;
-		payload["availability_topic"]=self.availabilityTopic;
-		payload["payload_available"]=self.payload_available;
-		payload["payload_not_available"]=self.payload_not_available;
+		self.availabilityOptions(payload,shortStateTopic);
 		payload["payload_off"]=payload_off;
 		payload["payload_on"]=payload_on;		
 		payload["qos"]=2;
 		payload['device'] = self.device
-		#send discovery message
-		self.mqtt.publish(discoveryTopic,json.dumps(payload),1,False);		
+		#discovery message is saved, it is published by the sender
+		self.addConfig('switch',object_id,payload);		
 
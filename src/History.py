@@ -0,0 +1,279 @@
+﻿#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import math
+import array
+import struct
+import bisect
+import threading
+import logging
+
+#This module records the history of numeric attributes of a boiler in memory mapped files
+#raw samples are kept during a window, older samples are downsampled into min/avg/max buckets
+#values are saved as native float64, files are not portable between platforms of different endianness
+
+#class used to save float64 values in a memory mapped file
+#the file header gives the position of the first value in the file, the value number and the index of the first value since the column creation
+#dropped values are only skipped by a header update, the file is compacted in a new file when full
+class Column:
+	HEADER=struct.Struct('QQQ');
+	ITEM_SIZE=8;
+	MIN_CAPACITY=1024;
+
+	def __init__(self,path,readOnly=False):
+		self.path=path;
+		self.readOnly=readOnly;
+		if ((not readOnly) and (not os.path.exists(path))):
+			with open(path,'wb') as file:
+				file.truncate(self.HEADER.size+self.MIN_CAPACITY*self.ITEM_SIZE);
+		self.open();
+
+	def __len__(self):
+		return self.count;
+
+	def open(self):
+		self.file=open(self.path,'rb' if self.readOnly else 'r+b');
+		self.map=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ if self.readOnly else mmap.ACCESS_WRITE);
+		self.capacity=(len(self.map)-self.HEADER.size)//self.ITEM_SIZE;
+		self.readHeader();
+
+	def readHeader(self):
+		head,count,self.index=self.HEADER.unpack_from(self.map,0);
+		self.head=min(head,self.capacity);
+		self.count=min(count,self.capacity-self.head);
+
+	#header is read again, for a reader of a file written by another process
+	def reload(self):
+		if (os.stat(self.path).st_ino!=os.fstat(self.file.fileno()).st_ino):
+			self.map.close();
+			self.file.close();
+			self.open();
+			return;
+		head,count,index=self.HEADER.unpack_from(self.map,0);
+		if ((head+count) > self.capacity):
+			self.map.close();
+			self.map=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ);
+			self.capacity=(len(self.map)-self.HEADER.size)//self.ITEM_SIZE;
+		self.readHeader();
+
+	#position in the file of a value
+	def offset(self,position):
+		return self.HEADER.size+(self.head+position)*self.ITEM_SIZE;
+
+	#file is extended, or replaced by a file starting with the first value when values were dropped
+	def resize(self,capacity):
+		if (self.head==0):
+			self.map.close();
+			self.file.truncate(self.HEADER.size+capacity*self.ITEM_SIZE);
+			self.map=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_WRITE);
+			self.capacity=capacity;
+			return;
+		temporary=self.path+'.tmp';
+		with open(temporary,'wb') as file:
+			file.write(self.HEADER.pack(0,self.count,self.index));
+			file.write(self.map[self.offset(0):self.offset(self.count)]);
+			file.truncate(self.HEADER.size+capacity*self.ITEM_SIZE);
+		os.replace(temporary,self.path);
+		self.map.close();
+		self.file.close();
+		self.open();
+
+	#the value number is updated once values are written
+	def append(self,values):
+		if ((self.head+self.count+len(values)) > self.capacity):
+			self.resize(max(self.MIN_CAPACITY,2*(self.count+len(values))));
+		struct.pack_into(str(len(values))+'d',self.map,self.offset(self.count),*values);
+		self.setRange(self.index,self.count+len(values));
+
+	#values before index are dropped and the value number set, by a single header update
+	def setRange(self,index,count):
+		self.head+=index-self.index;
+		self.index=index;
+		self.count=count;
+		if (not self.readOnly):
+			self.HEADER.pack_into(self.map,0,self.head,self.count,self.index);
+
+	#remove the first values
+	def dropHead(self,number):
+		number=min(number,self.count);
+		if (number > 0):
+			self.setRange(self.index+number,self.count-number);
+
+	#array of values start to end (excluded), copied from the file in a single operation
+	def read(self,start,end):
+		start=max(start,0);
+		end=min(end,self.count);
+		if (start >= end):
+			return array.array('d');
+		return array.array('d',self.map[self.offset(start):self.offset(end)]);
+
+	#index of value in a sorted column
+	def bisect(self,value,right=False):
+		with memoryview(self.map) as buffer:
+			with buffer[self.offset(0):self.offset(self.count)].cast('d') as values:
+				return (bisect.bisect_right if right else bisect.bisect_left)(values,value);
+
+	def flush(self):
+		if (not self.readOnly):
+			self.map.flush();
+
+	def close(self):
+		self.flush();
+		self.map.close();
+		self.file.close();
+
+#class used to record numeric attributes, a time column is shared by all raw columns and another one by all bucket columns
+#missing values are saved as NaN so that all columns have the same value number as their time column
+class HistoryRecorder:
+	RAW='raw';
+	BUCKET=('min','avg','max');
+	TIME='time';
+
+	#interval: min time between two samples in s, rawWindow: duration in s raw samples are kept, bucket: duration in s of downsampling buckets
+	def __init__(self,path,interval=10,rawWindow=7*86400,bucket=900,readOnly=False):
+		#logger
+		self.logger = logging.getLogger(__name__);
+
+		self.path=path;
+		self.interval=interval;
+		self.rawWindow=rawWindow;
+		self.bucket=bucket;
+		self.readOnly=readOnly;
+		self.lock=threading.Lock();
+		self.nextSample=0;
+		self.nextDownsample=0;
+		if (not readOnly):
+			os.makedirs(path,exist_ok=True);
+
+		#columns are saved in files <attribute>.<column>, by attribute and column
+		self.columns=dict();
+		for name in sorted(os.listdir(path)):
+			attribute,extension=os.path.splitext(name);
+			if ((extension=='.'+self.RAW) and (attribute!=self.TIME)):
+				self.openAttribute(attribute);
+		self.rawTime=Column(self.fileName(self.TIME,self.RAW),readOnly);
+		self.bucketTime=Column(self.fileName(self.TIME,'bucket'),readOnly);
+
+		#values not written in all columns by an interrupted record are dropped
+		if (not readOnly):
+			self.align();
+		self.logger.info('History of '+str(len(self.columns))+' attributes in '+path);
+
+	#columns are aligned on the values present in all columns of their group, file headers are only updated by the writer
+	#values of an interrupted record are dropped, as the raw values not yet dropped by an interrupted downsampling
+	def align(self):
+		rawColumns=[self.rawTime]+[columns[self.RAW] for columns in self.columns.values()];
+		bucketColumns=[self.bucketTime]+[columns[name] for columns in self.columns.values() for name in self.BUCKET];
+		for columns in (rawColumns,bucketColumns):
+			index=max(column.index for column in columns);
+			end=min(column.index+len(column) for column in columns);
+			for column in columns:
+				column.setRange(index,max(end-index,0));
+
+	def fileName(self,attribute,column):
+		return os.path.join(self.path,attribute+'.'+column);
+
+	def openAttribute(self,attribute):
+		self.columns[attribute]={name:Column(self.fileName(attribute,name),self.readOnly) for name in (self.RAW,)+self.BUCKET};
+
+	#columns of a new attribute are filled with NaN up to the current value number
+	def addAttribute(self,attribute):
+		self.openAttribute(attribute);
+		self.columns[attribute][self.RAW].setRange(self.rawTime.index,0);
+		self.columns[attribute][self.RAW].append([math.nan]*len(self.rawTime));
+		for name in self.BUCKET:
+			self.columns[attribute][name].setRange(self.bucketTime.index,0);
+			self.columns[attribute][name].append([math.nan]*len(self.bucketTime));
+
+	#return True if a sample shall be recorded at time now
+	def due(self,now):
+		return (now >= self.nextSample);
+
+	#record a sample of values given as a dict attribute:value, only numeric values are recorded
+	def record(self,now,values):
+		with self.lock:
+			self.nextSample=now+self.interval;
+			samples=dict();
+			for attribute,value in values.items():
+				if isinstance(value,(int,float)):
+					samples[attribute]=float(value);
+					if (attribute not in self.columns):
+						self.addAttribute(attribute);
+			for attribute,columns in self.columns.items():
+				columns[self.RAW].append([samples.get(attribute,math.nan)]);
+			self.rawTime.append([now]);
+
+			#raw samples out of window are downsampled once per bucket
+			if (now >= self.nextDownsample):
+				self.nextDownsample=now+self.bucket;
+				self.downsample(math.floor((now-self.rawWindow)/self.bucket)*self.bucket);
+
+	#raw samples before cutoff, a bucket boundary, are replaced by their buckets
+	#buckets are saved before any raw sample is dropped, align completes an interrupted downsampling
+	def downsample(self,cutoff):
+		end=self.rawTime.bisect(cutoff);
+		if (end==0):
+			return;
+		#samples of buckets saved by an interrupted downsampling are only dropped
+		first=0;
+		if (len(self.bucketTime) > 0):
+			first=min(self.rawTime.bisect(self.bucketTime.read(len(self.bucketTime)-1,len(self.bucketTime))[0]+self.bucket),end);
+		times=self.rawTime.read(0,end);
+		#sample ranges of each bucket
+		ranges=list();
+		start=first;
+		for i in range(first+1,end+1):
+			if ((i==end) or ((times[i]//self.bucket)!=(times[start]//self.bucket))):
+				ranges.append((start,i));
+				start=i;
+		for attribute,columns in self.columns.items():
+			values=columns[self.RAW].read(0,end);
+			buckets={name:list() for name in self.BUCKET};
+			for start,stop in ranges:
+				bucketValues=[value for value in values[start:stop] if not math.isnan(value)];
+				if bucketValues:
+					buckets['min'].append(min(bucketValues));
+					buckets['avg'].append(sum(bucketValues)/len(bucketValues));
+					buckets['max'].append(max(bucketValues));
+				else:
+					for name in self.BUCKET:
+						buckets[name].append(math.nan);
+			for name in self.BUCKET:
+				columns[name].append(buckets[name]);
+		self.bucketTime.append([(times[start]//self.bucket)*self.bucket for start,stop in ranges]);
+		for columns in self.columns.values():
+			columns[self.RAW].dropHead(end);
+		self.rawTime.dropHead(end);
+		self.logger.debug('History downsampling of '+str(end)+' samples in '+str(len(ranges))+' buckets');
+
+	#list of attributes with a history
+	def attributes(self):
+		with self.lock:
+			return sorted(self.columns);
+
+	#history of an attribute between start and end times, None if the attribute has no history
+	#columns are given as arrays of float64: buckets time, min, avg and max, raw time and value, NaN values are missing samples
+	def query(self,attribute,start,end):
+		with self.lock:
+			if (self.readOnly):
+				for column in [self.rawTime,self.bucketTime]+[column for columns in self.columns.values() for column in columns.values()]:
+					column.reload();
+				self.align();
+			columns=self.columns.get(attribute);
+			if (columns is None):
+				return None;
+			first=self.bucketTime.bisect(start);
+			last=self.bucketTime.bisect(end,True);
+			buckets={'time':self.bucketTime.read(first,last)};
+			for name in self.BUCKET:
+				buckets[name]=columns[name].read(first,last);
+			first=self.rawTime.bisect(start);
+			last=self.rawTime.bisect(end,True);
+			return {'buckets':buckets,'raw':{'time':self.rawTime.read(first,last),'value':columns[self.RAW].read(first,last)}};
+
+	def close(self):
+		with self.lock:
+			for column in [self.rawTime,self.bucketTime]+[column for columns in self.columns.values() for column in columns.values()]:
+				column.close();
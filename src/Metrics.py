@@ -0,0 +1,145 @@
+﻿#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import logging
+import http.server
+
+#This module provides counters, gauges and histograms exported in Prometheus text format by an optional HTTP endpoint
+#metrics are always updated, the HTTP endpoint is only launched if requested
+
+#base class of metrics, values are saved by tuple of label values
+class Metric:
+	type=None;
+
+	def __init__(self,name,help,labelNames=()):
+		self.name=name;
+		self.help=help;
+		self.labelNames=tuple(labelNames);
+		self.lock=threading.Lock();
+		self.values=dict();
+
+	def labelText(self,labels,extra=()):
+		pairs=list(zip(self.labelNames,labels))+list(extra);
+		if (not pairs):
+			return '';
+		return '{'+','.join(name+'="'+str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')+'"' for name,value in pairs)+'}';
+
+	#exposition lines of the metric
+	def samples(self):
+		with self.lock:
+			return [self.name+self.labelText(labels)+' '+repr(float(value)) for labels,value in self.values.items()];
+
+	def exposition(self):
+		return ['# HELP '+self.name+' '+self.help,'# TYPE '+self.name+' '+self.type]+self.samples();
+
+class Counter(Metric):
+	type='counter';
+
+	def inc(self,amount=1,*labels):
+		with self.lock:
+			self.values[labels]=self.values.get(labels,0)+amount;
+
+class Gauge(Metric):
+	type='gauge';
+
+	def set(self,value,*labels):
+		with self.lock:
+			self.values[labels]=value;
+
+	#the gauge value is given by function at each scrape
+	def setFunction(self,function,*labels):
+		with self.lock:
+			self.values[labels]=function;
+
+	def samples(self):
+		with self.lock:
+			values=list(self.values.items());
+		lines=list();
+		for labels,value in values:
+			try:
+				value=value() if callable(value) else value;
+			except Exception:
+				continue;
+			lines.append(self.name+self.labelText(labels)+' '+repr(float(value)));
+		return lines;
+
+class Histogram(Metric):
+	type='histogram';
+	#default buckets in seconds, suited to RS485 transactions at 9600 bauds
+	BUCKETS=(0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10);
+
+	def __init__(self,name,help,labelNames=(),buckets=BUCKETS):
+		super().__init__(name,help,labelNames);
+		self.buckets=tuple(buckets);
+
+	#values are saved as [bucket counts,sum,count]
+	def observe(self,value,*labels):
+		with self.lock:
+			entry=self.values.get(labels);
+			if (entry is None):
+				entry=[[0]*len(self.buckets),0,0];
+				self.values[labels]=entry;
+			for i,bound in enumerate(self.buckets):
+				if (value <= bound):
+					entry[0][i]+=1;
+			entry[1]+=value;
+			entry[2]+=1;
+
+	def samples(self):
+		lines=list();
+		with self.lock:
+			for labels,(counts,total,count) in self.values.items():
+				for bound,bucketCount in zip(self.buckets,counts):
+					lines.append(self.name+'_bucket'+self.labelText(labels,(('le',repr(float(bound))),))+' '+str(bucketCount));
+				lines.append(self.name+'_bucket'+self.labelText(labels,(('le','+Inf'),))+' '+str(count));
+				lines.append(self.name+'_sum'+self.labelText(labels)+' '+repr(float(total)));
+				lines.append(self.name+'_count'+self.labelText(labels)+' '+str(count));
+		return lines;
+
+#registered metrics, by name
+REGISTRY=dict();
+
+def register(metric):
+	return REGISTRY.setdefault(metric.name,metric);
+
+def counter(name,help,labelNames=()):
+	return register(Counter(name,help,labelNames));
+
+def gauge(name,help,labelNames=()):
+	return register(Gauge(name,help,labelNames));
+
+def histogram(name,help,labelNames=(),buckets=Histogram.BUCKETS):
+	return register(Histogram(name,help,labelNames,buckets));
+
+#metrics in Prometheus text exposition format
+def exposition():
+	lines=list();
+	for metric in list(REGISTRY.values()):
+		lines+=metric.exposition();
+	return '\n'.join(lines)+'\n';
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if (self.path.split('?')[0] not in ('/','/metrics')):
+			self.send_error(404);
+			return;
+		payload=exposition().encode('utf-8');
+		self.send_response(200);
+		self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8');
+		self.send_header('Content-Length',str(len(payload)));
+		self.end_headers();
+		self.wfile.write(payload);
+
+	#requests are not logged
+	def log_message(self,format,*args):
+		pass;
+
+#launch the HTTP endpoint in a specific thread, requests are served one at a time by this thread
+def startServer(port,address=''):
+	server=http.server.HTTPServer((address,port),MetricsHandler);
+	#serving thread is kept with the server, so that its liveness can be checked
+	server.thread=threading.Thread(target=server.serve_forever,daemon=True);
+	server.thread.start();
+	logging.getLogger(__name__).critical('Metrics endpoint listening on port '+str(port));
+	return server;
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#end to end benchmark of a panel loop against the boiler simulator and an in-process MQTT client stand-in
+#results are printed as JSON: refresh duration, command to confirmation latency, messages per refresh, CPU time per cycle and peak RSS
+#usage: python3 tools/benchmark.py [--mode diematic3|diematic4] [--period 10] [--commands 3] [--output result.json] [--capture directory]
+
+import os,sys
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import statistics
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'));
+import DDModbus
+import Diematic3Panel,Diematic4Panel
+import Diematic32MQTT
+import boilerSimulator
+
+TOPIC_PREFIX='bench/boiler';
+
+#MQTT message of a command topic
+class Message:
+	def __init__(self,topic,payload):
+		self.topic=topic;
+		self.payload=payload;
+
+#in-process MQTT client stand-in, retained messages are kept as a broker would do
+class MqttStandIn:
+	def __init__(self):
+		self.brokerConnected=True;
+		self.retained=dict();
+		self.published=0;
+		#callback on publication of a topic
+		self.onPublish=None;
+
+	def publish(self,topic,payload,qos=0,retain=False):
+		self.published+=1;
+		if retain:
+			self.retained[topic]=payload;
+		if (self.onPublish is not None):
+			self.onPublish(topic,payload);
+
+def summary(values):
+	if (not values):
+		return None;
+	return {'count':len(values),'mean':statistics.mean(values),'min':min(values),'max':max(values)};
+
+class Benchmark:
+	PANELS={boilerSimulator.MODE_DIEMATIC3:Diematic3Panel.Diematic3Panel,boilerSimulator.MODE_DIEMATIC4:Diematic4Panel.Diematic4Panel};
+
+	def __init__(self,args):
+		self.args=args;
+		self.mqtt=MqttStandIn();
+		self.mqtt.onPublish=self.onPublish;
+		self.refreshDurations=list();
+		self.messagesPerRefresh=list();
+		self.commandLatencies=list();
+		self.cycles=0;
+		self.pendingCommand=None;
+
+	#confirmation of a command, the retained state topic is updated with the requested value
+	def onPublish(self,topic,payload):
+		if ((self.pendingCommand is not None) and (topic==self.pendingCommand[0]) and (payload==self.pendingCommand[1])):
+			self.commandLatencies.append(time.perf_counter()-self.pendingCommand[2]);
+			self.confirmed.set();
+
+	#panel class measuring register refreshes and publications
+	def panelClass(self):
+		benchmark=self;
+		panelClass=self.PANELS[self.args.mode];
+
+		class BenchmarkPanel(panelClass):
+			async def refreshRegisters(self,force=False,window=None):
+				start=time.perf_counter();
+				result=await super().refreshRegisters(force,window);
+				if result:
+					benchmark.cycles+=1;
+					benchmark.refreshDurations.append(time.perf_counter()-start);
+				return result;
+
+			def updateCallback(self,changed=None):
+				published=benchmark.mqtt.published;
+				Diematic32MQTT.diematicPublish(self,changed);
+				benchmark.messagesPerRefresh.append(benchmark.mqtt.published-published);
+
+		return BenchmarkPanel;
+
+	async def run(self):
+		args=self.args;
+		simulator=boilerSimulator.BoilerSimulator(args.mode,masterDuration=args.masterDuration,slaveDuration=args.slaveDuration,latency=args.latency,splitRate=args.splitRate,crcErrorRate=args.crcErrorRate,silenceRate=args.silenceRate,seed=args.seed);
+		port=await simulator.start();
+
+		#panel published through a MessageBuffer as Diematic32MQTT does
+		panel=self.panelClass()('127.0.0.1',port,0x0A,0,'UTC');
+		panel.topicPrefix=TOPIC_PREFIX;
+		panel.buffer=Diematic32MQTT.MessageBuffer(self.mqtt,TOPIC_PREFIX);
+		panel.refreshPeriod=args.period;
+		panel.refreshRequest=True;
+		Diematic32MQTT.panels[:]=[panel];
+
+		#bus capture, replayed by tools/replay.py
+		if (args.capture is not None):
+			DDModbus.setCapture(args.capture);
+		
+		cpuStart=time.process_time();
+		start=time.perf_counter();
+		panelTask=asyncio.ensure_future(panel.loopAsync());
+		try:
+			#wait for the first full refresh
+			while ((self.cycles==0) and ((time.perf_counter()-start) < args.timeout)):
+				await asyncio.sleep(0.1);
+
+			#commands sent as MQTT messages, alternating two setpoints different from the simulator one
+			for i in range(args.commands):
+				value=20.5+0.5*(i % 2);
+				self.confirmed=asyncio.Event();
+				self.pendingCommand=(TOPIC_PREFIX+'/zoneA/dayTemp',f"{value:.1f}",time.perf_counter());
+				Diematic32MQTT.paramSet(self.mqtt,None,Message(TOPIC_PREFIX+'/zoneA/dayTemp/set',f"{value:.1f}".encode()));
+				try:
+					await asyncio.wait_for(self.confirmed.wait(),args.timeout);
+				except asyncio.TimeoutError:
+					logging.getLogger(__name__).warning('Command not confirmed: '+str(value));
+				self.pendingCommand=None;
+
+			#let the loop run for remaining duration
+			remaining=args.duration-(time.perf_counter()-start);
+			if (remaining > 0):
+				await asyncio.sleep(remaining);
+		finally:
+			panel.run=False;
+			panelTask.cancel();
+			await simulator.stop();
+			DDModbus.closeCaptures();
+		cpu=time.process_time()-cpuStart;
+
+		return {
+			'version':1,
+			'python':platform.python_version(),
+			'crcBackend':DDModbus.CRC_BACKEND,
+			'settings':vars(args),
+			'duration':time.perf_counter()-start,
+			'cycles':self.cycles,
+			'fullRefreshDuration':self.refreshDurations[0] if self.refreshDurations else None,
+			'refreshDuration':summary(self.refreshDurations[1:]),
+			'commandLatency':summary(self.commandLatencies),
+			'commandsConfirmed':len(self.commandLatencies),
+			'messagesPerRefresh':summary(self.messagesPerRefresh[1:]),
+			'firstPublication':self.messagesPerRefresh[0] if self.messagesPerRefresh else None,
+			'cpuTime':cpu,
+			'cpuTimePerCycle':(cpu/self.cycles) if self.cycles else None,
+			#ru_maxrss is in kB on Linux
+			'peakRss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+			'simulator':simulator.stats,
+		};
+
+if __name__ == '__main__':
+	parser=argparse.ArgumentParser(description='Diematic panel end to end benchmark');
+	parser.add_argument('--mode',choices=tuple(Benchmark.PANELS.keys()),default=boilerSimulator.MODE_DIEMATIC4);
+	parser.add_argument('--period',type=int,default=10,help='panel refresh period in s');
+	parser.add_argument('--duration',type=float,default=60,help='min benchmark duration in s');
+	parser.add_argument('--commands',type=int,default=3,help='number of setpoint commands');
+	parser.add_argument('--timeout',type=float,default=90,help='max wait in s of the first refresh and of each command confirmation');
+	parser.add_argument('--masterDuration',type=float,default=6);
+	parser.add_argument('--slaveDuration',type=float,default=5);
+	parser.add_argument('--latency',type=float,default=0);
+	parser.add_argument('--splitRate',type=float,default=0);
+	parser.add_argument('--crcErrorRate',type=float,default=0);
+	parser.add_argument('--silenceRate',type=float,default=0);
+	parser.add_argument('--seed',type=int,default=0);
+	parser.add_argument('--output',default=None,help='JSON output file, stdout by default');
+	parser.add_argument('--capture',default=None,help='directory of bus capture');
+	args=parser.parse_args();
+
+	logging.basicConfig(level=logging.WARNING,format='%(asctime)s - %(name)s - %(levelname)s - %(message)s');
+	Diematic32MQTT.logger=logging.getLogger('Diematic32MQTT');
+
+	result=asyncio.run(Benchmark(args).run());
+	output=json.dumps(result,indent=2);
+	if (args.output is None):
+		print(output);
+	else:
+		with open(args.output,'w') as file:
+			file.write(output+'\n');
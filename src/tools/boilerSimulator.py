@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#Modbus RTU over TCP boiler simulator, standing for a RS485/TCP gateway connected to a De Dietrich regulator
+#usage: python3 tools/boilerSimulator.py [--port 20108] [--mode diematic3|diematic4|delta] [fault injection options]
+
+import os,sys
+import argparse
+import asyncio
+import datetime
+import logging
+import random
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'));
+import DDModbus
+from Diematic import DDREGISTER
+
+#simulated regulator types
+MODE_DIEMATIC3='diematic3';
+MODE_DIEMATIC4='diematic4';
+MODE_DELTA='delta';
+
+#realistic register image of a boiler with circuit A only, temperatures in 0.1 degree
+DEFAULT_REGISTERS={
+	DDREGISTER.CTRL:0x0F,
+	DDREGISTER.TEMP_EXT:85,
+	DDREGISTER.NB_JOUR_ANTIGEL:0,
+	DDREGISTER.CONS_JOUR_A:200,
+	DDREGISTER.CONS_NUIT_A:180,
+	DDREGISTER.CONS_ANTIGEL_A:60,
+	DDREGISTER.MODE_A:8,
+	DDREGISTER.TEMP_AMB_A:205,
+	DDREGISTER.TCALC_A:450,
+	DDREGISTER.CONS_JOUR_B:200,
+	DDREGISTER.CONS_NUIT_B:180,
+	DDREGISTER.CONS_ANTIGEL_B:60,
+	DDREGISTER.MODE_B:8,
+	DDREGISTER.TEMP_AMB_B:0xFFFF,
+	DDREGISTER.TCALC_B:0xFFFF,
+	DDREGISTER.CONS_ECS:550,
+	DDREGISTER.TEMP_ECS:520,
+	DDREGISTER.TEMP_CHAUD:620,
+	DDREGISTER.CONS_ECS_NUIT:400,
+	DDREGISTER.BASE_ECS:0x18,
+	DDREGISTER.OPTIONS_B_C:0,
+	DDREGISTER.IONIZATION_CURRENT:45,
+	DDREGISTER.RETURN_TEMP:480,
+	DDREGISTER.SMOKE_TEMP:700,
+	DDREGISTER.FAN_SPEED:2500,
+	DDREGISTER.PRESSION_EAU:15,
+	DDREGISTER.BOILER_TYPE:0x1D,
+	DDREGISTER.PUMP_POWER:60,
+	DDREGISTER.ALARME:0,
+};
+
+def buildFrame(data):
+	frame=bytearray(data);
+	crc=DDModbus.calc_crc(frame);
+	frame.append(crc & 0xFF);
+	frame.append((crc>>8)& 0xFF);
+	return frame;
+
+#the simulator holds the register image of one regulator and serves all TCP clients as a single RS485 bus
+#frames sent on the bus (answers and regulator master frames) are received by all clients
+class BoilerSimulator:
+	#period in s between two frames sent by the regulator in master mode
+	MASTER_FRAME_PERIOD=0.3;
+	#delay in s between the two parts of a split frame
+	SPLIT_DELAY=0.05;
+
+	#mode: MODE_DIEMATIC3 (master/slave alternation), MODE_DIEMATIC4 (slave only) or MODE_DELTA (master only)
+	#masterDuration and slaveDuration: durations in s of the Diematic3 bus phases
+	#latency: answer delay in s, splitRate, crcErrorRate and silenceRate: probability of a split answer, of a wrong CRC and of no answer
+	def __init__(self,mode=MODE_DIEMATIC3,regulatorAddress=0x0A,interfaceAddress=0x32,masterDuration=6,slaveDuration=5,latency=0,splitRate=0,crcErrorRate=0,silenceRate=0,seed=None):
+		#logger
+		self.logger = logging.getLogger(__name__);
+
+		self.mode=mode;
+		self.regulatorAddress=regulatorAddress;
+		self.interfaceAddress=interfaceAddress;
+		self.masterDuration=masterDuration;
+		self.slaveDuration=slaveDuration;
+
+		#fault injection
+		self.latency=latency;
+		self.splitRate=splitRate;
+		self.crcErrorRate=crcErrorRate;
+		self.silenceRate=silenceRate;
+		self.random=random.Random(seed);
+
+		#register image
+		self.registers={int(reg):value for reg,value in DEFAULT_REGISTERS.items()};
+
+		#bus state, True while the regulator is master
+		self.master=(mode==MODE_DELTA);
+		self.writers=set();
+		self.server=None;
+		self.busTask=None;
+
+		#counters
+		self.stats={'clients':0,'reads':0,'writes':0,'masterFrames':0,'collisions':0,'crcErrors':0,'silences':0,'splits':0};
+
+	#clock registers follow local time
+	def updateClock(self):
+		now=datetime.datetime.now();
+		self.registers[DDREGISTER.HEURE]=now.hour;
+		self.registers[DDREGISTER.MINUTE]=now.minute;
+		self.registers[DDREGISTER.JOUR_SEMAINE]=now.isoweekday();
+		self.registers[DDREGISTER.JOUR]=now.day;
+		self.registers[DDREGISTER.MOIS]=now.month;
+		self.registers[DDREGISTER.ANNEE]=now.year % 100;
+
+	#answer of a request, None if the request is not for the regulator
+	def answer(self,request):
+		if (request[0]!=self.regulatorAddress):
+			return None;
+		regAddress=0x100*request[2]+request[3];
+		regNb=0x100*request[4]+request[5];
+		if (request[1]==DDModbus.DDModbus.READ_ANALOG_HOLDING_REGISTERS):
+			self.stats['reads']+=1;
+			self.updateClock();
+			data=[request[0],request[1],2*regNb];
+			for reg in range(regAddress,regAddress+regNb):
+				value=self.registers.get(reg,0);
+				data+=[(value>>8)& 0xFF,value & 0xFF];
+			return buildFrame(data);
+		if (request[1]==DDModbus.DDModbus.WRITE_MULTIPLE_REGISTERS):
+			self.stats['writes']+=1;
+			for i in range(regNb):
+				self.registers[regAddress+i]=0x100*request[7+2*i]+request[8+2*i];
+			self.logger.info('Write '+str(regAddress)+': '+str([self.registers[regAddress+i] for i in range(regNb)]));
+			return DDModbus.buildWriteAck(request);
+		return None;
+
+	#send a frame on the bus, with fault injection
+	async def send(self,frame,faults=True):
+		if (faults and (self.random.random() < self.crcErrorRate)):
+			self.stats['crcErrors']+=1;
+			frame=bytearray(frame);
+			frame[-1]^=0xFF;
+		parts=[frame];
+		if (faults and (self.random.random() < self.splitRate)):
+			self.stats['splits']+=1;
+			cut=self.random.randint(1,len(frame)-1);
+			parts=[frame[0:cut],frame[cut:]];
+		for i,part in enumerate(parts):
+			if (i>0):
+				await asyncio.sleep(self.SPLIT_DELAY);
+			for writer in list(self.writers):
+				writer.write(bytes(part));
+
+	async def handleClient(self,reader,writer):
+		self.stats['clients']+=1;
+		self.writers.add(writer);
+		rxBuffer=DDModbus.RtuFrameBuffer();
+		try:
+			while True:
+				data=await reader.read(1024);
+				if (not data):
+					break;
+				rxBuffer.feed(data);
+				frame=rxBuffer.getFrame();
+				while (frame is not None):
+					await self.handleRequest(frame);
+					frame=rxBuffer.getFrame();
+		except (ConnectionError,asyncio.CancelledError):
+			pass;
+		finally:
+			self.writers.discard(writer);
+			writer.close();
+
+	async def handleRequest(self,request):
+		self.logger.debug('Request: '+request.hex());
+		#requests sent while the regulator is master collide with its frames
+		if (self.master):
+			self.stats['collisions']+=1;
+			return;
+		answer=self.answer(request);
+		if (answer is None):
+			return;
+		if (self.random.random() < self.silenceRate):
+			self.stats['silences']+=1;
+			return;
+		if (self.latency):
+			await asyncio.sleep(self.latency);
+		await self.send(answer);
+
+	#frame sent by the regulator in master mode, write of clock and outdoor temperature to the interface
+	def masterFrame(self):
+		self.updateClock();
+		values=[self.registers[reg] for reg in range(DDREGISTER.HEURE,DDREGISTER.TEMP_EXT+1)];
+		data=[self.interfaceAddress,DDModbus.DDModbus.WRITE_MULTIPLE_REGISTERS,0,DDREGISTER.HEURE,0,len(values),2*len(values)];
+		for value in values:
+			data+=[(value>>8)& 0xFF,value & 0xFF];
+		return buildFrame(data);
+
+	#bus activity of the regulator: master phases for Diematic3 and Delta, nothing for Diematic4
+	async def busLoop(self):
+		loop=asyncio.get_event_loop();
+		while True:
+			if (self.mode==MODE_DIEMATIC4):
+				return;
+			self.master=True;
+			masterEnd=loop.time()+self.masterDuration;
+			while ((self.mode==MODE_DELTA) or (loop.time() < masterEnd)):
+				self.stats['masterFrames']+=1;
+				await self.send(self.masterFrame(),False);
+				await asyncio.sleep(self.MASTER_FRAME_PERIOD);
+			#slave window, the regulator answers requests
+			self.master=False;
+			await asyncio.sleep(self.slaveDuration);
+
+	async def start(self,host='127.0.0.1',port=0):
+		self.server=await asyncio.start_server(self.handleClient,host,port);
+		self.port=self.server.sockets[0].getsockname()[1];
+		self.busTask=asyncio.ensure_future(self.busLoop());
+		self.logger.info('Simulator '+self.mode+' listening on '+host+':'+str(self.port));
+		return self.port;
+
+	async def stop(self):
+		self.busTask.cancel();
+		self.server.close();
+		for writer in list(self.writers):
+			writer.close();
+		await self.server.wait_closed();
+
+async def main(args):
+	simulator=BoilerSimulator(args.mode,args.regulatorAddress,args.interfaceAddress,args.masterDuration,args.slaveDuration,args.latency,args.splitRate,args.crcErrorRate,args.silenceRate,args.seed);
+	await simulator.start(args.host,args.port);
+	try:
+		while True:
+			await asyncio.sleep(60);
+			logging.getLogger(__name__).info('Stats: '+str(simulator.stats));
+	finally:
+		await simulator.stop();
+
+if __name__ == '__main__':
+	parser=argparse.ArgumentParser(description='De Dietrich boiler simulator, Modbus RTU over TCP');
+	parser.add_argument('--host',default='127.0.0.1');
+	parser.add_argument('--port',type=int,default=20108);
+	parser.add_argument('--mode',choices=(MODE_DIEMATIC3,MODE_DIEMATIC4,MODE_DELTA),default=MODE_DIEMATIC3);
+	parser.add_argument('--regulatorAddress',type=lambda x:int(x,0),default=0x0A);
+	parser.add_argument('--interfaceAddress',type=lambda x:int(x,0),default=0x32);
+	parser.add_argument('--masterDuration',type=float,default=6,help='Diematic3 master phase duration in s');
+	parser.add_argument('--slaveDuration',type=float,default=5,help='Diematic3 slave window duration in s');
+	parser.add_argument('--latency',type=float,default=0,help='answer delay in s');
+	parser.add_argument('--splitRate',type=float,default=0,help='probability of an answer split in two TCP segments');
+	parser.add_argument('--crcErrorRate',type=float,default=0,help='probability of an answer with a wrong CRC');
+	parser.add_argument('--silenceRate',type=float,default=0,help='probability of no answer');
+	parser.add_argument('--seed',type=int,default=None);
+	parser.add_argument('--debug',action='store_true');
+	args=parser.parse_args();
+
+	logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,format='%(asctime)s - %(name)s - %(levelname)s - %(message)s');
+	try:
+		asyncio.run(main(args));
+	except KeyboardInterrupt:
+		pass;
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#micro benchmark of the Modbus CRC16 calculation used by DDModbus
+#usage: python3 tools/crcBench.py [iterations]
+
+import os,sys
+import timeit
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'));
+import DDModbus
+
+#previous bit by bit implementation, kept as reference
+def calc_crc_bitwise(data):
+	crc = 0xFFFF
+	for pos in data:
+		crc ^= pos
+		for i in range(8):
+			if ((crc & 1) != 0):
+				crc >>= 1
+				crc ^= 0xA001
+			else:
+				crc >>= 1
+	return crc
+
+if __name__ == '__main__':
+	iterations=int(sys.argv[1]) if (len(sys.argv)>1) else 20000;
+
+	#typical frames: read request, answer of 64 registers, sniffed write of 32 registers
+	frames={'readRequest':bytes([0x0A,0x03,0x00,0x01,0x00,0x3F]),
+		'answer64':bytes(range(131)),
+		'write32':bytes((7*i) & 0xFF for i in range(71))};
+
+	implementations={'bitwise':calc_crc_bitwise,'table':DDModbus._calc_crc_table};
+	if (DDModbus.CRC_BACKEND!='table'):
+		implementations[DDModbus.CRC_BACKEND]=DDModbus.calc_crc;
+
+	print('CRC backend in use: '+DDModbus.CRC_BACKEND);
+	for name,frame in frames.items():
+		#check all implementations agree, memoryview slices included
+		ref=calc_crc_bitwise(frame);
+		for impl in implementations.values():
+			assert impl(frame)==ref and impl(memoryview(frame)[0:len(frame)])==ref;
+
+		line=f"{name:12s} {len(frame):4d} bytes";
+		refDuration=None;
+		for implName,impl in implementations.items():
+			duration=timeit.timeit(lambda:impl(frame),number=iterations)/iterations;
+			if refDuration is None:
+				refDuration=duration;
+			line+=f" | {implName}: {duration*1e6:8.2f} us (x{refDuration/duration:5.1f})";
+		print(line);
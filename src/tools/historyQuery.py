@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#query of the attribute history recorded by Diematic32MQTT, results are printed as JSON
+#usage: python3 tools/historyQuery.py <boiler history directory> [attribute] [--start -86400] [--end 0]
+#without attribute, recorded attributes are listed
+#python3 tools/historyQuery.py --bench <directory> fills a new directory with a year of 10s samples and measures query durations
+
+import os,sys
+import argparse
+import json
+import math
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'));
+import History
+
+#relative times are negative offsets from now
+def absoluteTime(value,now):
+	return (now+value) if (value <= 0) else value;
+
+def bench(path,days,attributes):
+	interval=10;
+	end=time.time();
+	start=end-days*86400;
+	recorder=History.HistoryRecorder(path,interval);
+	fillStart=time.perf_counter();
+	now=start;
+	while (now < end):
+		recorder.record(now,{'attr'+str(i):20+10*math.sin(now/86400+i) for i in range(attributes)});
+		now+=interval;
+	fill=time.perf_counter()-fillStart;
+
+	durations=dict();
+	for name,duration in (('day',86400),('week',7*86400),('month',30*86400),('year',365*86400)):
+		iterations=20;
+		queryStart=time.perf_counter();
+		for i in range(iterations):
+			result=recorder.query('attr0',end-duration,end);
+		durations[name]={'duration':(time.perf_counter()-queryStart)/iterations,'buckets':len(result['buckets']['time']),'raw':len(result['raw']['time'])};
+	#narrow range query in downsampled and raw history
+	for name,offset in (('hourOld',300*86400),('hourRecent',86400)):
+		iterations=1000;
+		queryStart=time.perf_counter();
+		for i in range(iterations):
+			result=recorder.query('attr0',end-offset,end-offset+3600);
+		durations[name]={'duration':(time.perf_counter()-queryStart)/iterations,'buckets':len(result['buckets']['time']),'raw':len(result['raw']['time'])};
+	recorder.close();
+	size=sum(os.path.getsize(os.path.join(path,name)) for name in os.listdir(path));
+	return {'samples':int(days*86400/interval),'attributes':attributes,'fillDuration':fill,'size':size,'queries':durations};
+
+if __name__ == '__main__':
+	parser=argparse.ArgumentParser(description='Diematic attribute history query');
+	parser.add_argument('path',help='history directory of a boiler');
+	parser.add_argument('attribute',nargs='?',default=None);
+	parser.add_argument('--start',type=float,default=-86400,help='start time, negative values are relative to now');
+	parser.add_argument('--end',type=float,default=0,help='end time, negative values are relative to now');
+	parser.add_argument('--bench',action='store_true',help='fill path with synthetic samples and measure queries');
+	parser.add_argument('--days',type=float,default=365,help='synthetic history duration in days');
+	parser.add_argument('--attributes',type=int,default=4,help='synthetic attribute number');
+	args=parser.parse_args();
+
+	if args.bench:
+		print(json.dumps(bench(args.path,args.days,args.attributes),indent=2));
+		sys.exit(0);
+
+	recorder=History.HistoryRecorder(args.path,readOnly=True);
+	if (args.attribute is None):
+		print(json.dumps(recorder.attributes()));
+	else:
+		now=time.time();
+		queryStart=time.perf_counter();
+		result=recorder.query(args.attribute,absoluteTime(args.start,now),absoluteTime(args.end,now));
+		duration=time.perf_counter()-queryStart;
+		if (result is None):
+			sys.exit('Unknown attribute: '+args.attribute);
+		#arrays are printed as lists, missing samples as NaN
+		output={part:{name:values.tolist() for name,values in columns.items()} for part,columns in result.items()};
+		output['duration']=duration;
+		print(json.dumps(output));
+	recorder.close();
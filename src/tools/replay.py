@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#replay of a bus capture recorded by Diematic32MQTT ([Modbus] capture option), results are printed as JSON
+#by default the capture is fed to the panel loop by a replay transport, at original speed or faster (--speed)
+#panel loops run on real time: their own timers (Diematic4 refresh period) are not accelerated by --speed, and Diematic3 master windows need the original silences (--speed 1)
+#with --decode, captured frames are parsed, merged and decoded without panel loop, as fast as possible: it is the fast path for regression checks
+#usage: python3 tools/replay.py <capture file> [--mode diematic3|diematic4|delta] [--speed 1] [--period 10] [--decode] [--output result.json]
+
+import os,sys
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'));
+import DDModbus
+import Diematic
+import Diematic3Panel,Diematic4Panel,DiematicDeltaPanel
+
+PANELS={'diematic3':Diematic3Panel.Diematic3Panel,'diematic4':Diematic4Panel.Diematic4Panel,'delta':DiematicDeltaPanel.DiematicDeltaPanel};
+
+class Replay:
+	#delay in s given to the panel loop to process the last records
+	FINISH_DELAY=1;
+	
+	def __init__(self,args):
+		self.args=args;
+		self.changes=0;
+		self.callbacks=0;
+
+	#panel class counting attribute changes, the replay transport is kept over synchro errors
+	def panelClass(self):
+		replay=self;
+
+		class ReplayPanel(PANELS[self.args.mode]):
+			def updateCallback(self,changed=None):
+				replay.callbacks+=1;
+				replay.changes+=len(changed) if changed else 0;
+
+			def closeConnection(self):
+				pass;
+
+		return ReplayPanel;
+
+	def createPanel(self):
+		panel=self.panelClass()('replay',0,self.args.regulatorAddress,self.args.interfaceAddress,'UTC');
+		panel.snooping=self.args.snooping;
+		panel.refreshPeriod=max(self.args.period,10);
+		return panel;
+
+	#capture fed to the panel loop
+	async def runLoop(self,panel):
+		transport=DDModbus.ReplayDDModbus(self.args.capture,self.args.speed);
+		panel.modBusInterface=transport;
+		panel.refreshRequest=True;
+		task=asyncio.ensure_future(panel.loopAsync());
+		await transport.connect();
+		try:
+			await transport.finished.wait();
+			await asyncio.sleep(self.FINISH_DELAY);
+		finally:
+			panel.run=False;
+			task.cancel();
+		return transport.stats;
+
+	#captured frames parsed and merged as snooped frames
+	def runDecode(self,panel):
+		stats={'records':0,'frames':0,'merged':0};
+		buffers={DDModbus.CAPTURE_RX:DDModbus.RtuFrameBuffer('rx'),DDModbus.CAPTURE_TX:DDModbus.RtuFrameBuffer('tx')};
+		for timestamp,direction,data in DDModbus.readCapture(self.args.capture):
+			stats['records']+=1;
+			buffer=buffers.get(direction);
+			if (buffer is None):
+				continue;
+			buffer.feed(data);
+			frame=buffer.getFrame();
+			while (frame is not None):
+				stats['frames']+=1;
+				if panel.snoopFrame(DDModbus.slaveRequest(frame)):
+					stats['merged']+=1;
+					panel.refreshAttributes();
+				frame=buffer.getFrame();
+		stats['resync']=sum(buffer.resyncCount for buffer in buffers.values());
+		return stats;
+
+	def run(self):
+		panel=self.createPanel();
+		cpuStart=time.process_time();
+		start=time.perf_counter();
+		if self.args.decode:
+			stats=self.runDecode(panel);
+		else:
+			stats=asyncio.run(self.runLoop(panel));
+		return {
+			'capture':self.args.capture,
+			'mode':self.args.mode,
+			'decode':self.args.decode,
+			'duration':time.perf_counter()-start,
+			'cpuTime':time.process_time()-cpuStart,
+			'transport':stats,
+			'callbacks':self.callbacks,
+			'changes':self.changes,
+			'attributes':{codec.attribute:getattr(panel,codec.storage) for codec in Diematic.CODECS},
+		};
+
+if __name__ == '__main__':
+	parser=argparse.ArgumentParser(description='Diematic bus capture replay');
+	parser.add_argument('capture',help='capture file');
+	parser.add_argument('--mode',choices=tuple(PANELS.keys()),default='diematic3');
+	parser.add_argument('--speed',type=float,default=1,help='replay speed factor of the panel loop, positive, use --decode for a replay without delay');
+	parser.add_argument('--period',type=int,default=10,help='panel refresh period in s, as set when the capture was recorded');
+	parser.add_argument('--decode',action='store_true',help='parse and decode captured frames without panel loop');
+	parser.add_argument('--snooping',action='store_true',help='merge register values observed on the bus by the panel loop');
+	parser.add_argument('--regulatorAddress',type=lambda x:int(x,0),default=0x0A);
+	parser.add_argument('--interfaceAddress',type=lambda x:int(x,0),default=0x32);
+	parser.add_argument('--output',default=None,help='JSON output file, stdout by default');
+	parser.add_argument('--debug',action='store_true');
+	args=parser.parse_args();
+	if ((args.speed <= 0) and not args.decode):
+		parser.error('--speed shall be positive, use --decode for a replay without delay');
+
+	logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR,format='%(asctime)s - %(name)s - %(levelname)s - %(message)s');
+
+	output=json.dumps(Replay(args).run(),indent=2,default=str);
+	if (args.output is None):
+		print(output);
+	else:
+		with open(args.output,'w') as file:
+			file.write(output+'\n');